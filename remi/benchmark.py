@@ -0,0 +1,350 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   Rendering micro-benchmarks.
+   Times the core costs of remi.gui: widget construction, full and incremental
+   Tag.repr, the _need_update propagation, Table.append_from_list, the callbacks
+   dispatched by the headless driver, and the pages of the example apps as realistic
+   workloads. Each benchmark reports the seconds per operation (best and median of
+   the repetitions), the results can be saved as json and compared with the ones
+   of another commit.
+
+   Usage:
+       python -m remi.benchmark --output before.json
+       python -m remi.benchmark --compare before.json --threshold 0.1
+   The comparison exits with status 1 if a benchmark got slower than the threshold.
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+
+from . import gui
+from . import server
+from .headless import AppDriver
+
+# the example apps used as workloads, if the examples folder is available (source checkout)
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+EXAMPLES = ('widgets_overview_app.py', 'table_widget_app.py', 'template_advanced_app.py')
+
+
+class Benchmark(object):
+    """ setup() returns the callable to be timed, that performs ops operations.
+        setup gets called before each repetition, its time is not measured.
+    """
+
+    def __init__(self, name, setup, ops=1, repeat=None):
+        self.name = name
+        self.setup = setup
+        self.ops = ops
+        # overrides the default repetitions, for the long running ones
+        self.repeat = repeat
+
+    def measure(self, repeat):
+        times = []
+        for _ in range(self.repeat or repeat):
+            run = self.setup()
+            gc.collect()
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                start = timeit.default_timer()
+                run()
+                times.append((timeit.default_timer() - start) / self.ops)
+            finally:
+                if gc_enabled:
+                    gc.enable()
+        times.sort()
+        return {'best': times[0], 'median': times[len(times) // 2], 'repeat': len(times), 'ops': self.ops}
+
+
+def invalidate(tag):
+    """ Marks tag and all its descendants as changed, the next repr renders them from scratch """
+    tag.attributes.__version__ += 1
+    for child in tag.children.values():
+        if isinstance(child, gui.Tag):
+            invalidate(child)
+
+
+def wide_tree(count, groups=1):
+    """ Returns a VBox holding groups VBoxes with the count Labels, and the Labels """
+    labels = [gui.Label('label %d' % i) for i in range(count)]
+    root = gui.VBox()
+    size = max(1, count // groups)
+    for index in range(0, count, size):
+        root.append(gui.VBox(children=labels[index:index + size]))
+    root.repr()
+    return root, labels
+
+
+def deep_tree(depth):
+    """ Returns a chain of depth nested containers, each one holding a Label, and the innermost Label """
+    root = container = gui.Container()
+    label = None
+    for level in range(depth):
+        label = gui.Label('level %d' % level)
+        nested = gui.Container()
+        container.append([label, nested])
+        container = nested
+    root.repr()
+    return root, label
+
+
+def table_rows(count, columns=5):
+    return [tuple('r%dc%d' % (row, column) for column in range(columns)) for row in range(count)]
+
+
+def construction_benchmarks(scale):
+    count = max(1, int(200 * scale))
+    factories = (
+        ('Widget', gui.Widget),
+        ('Label', lambda: gui.Label('text')),
+        ('Button', lambda: gui.Button('text')),
+        ('TextInput', gui.TextInput),
+        ('VBox', gui.VBox),
+        ('Image', lambda: gui.Image('/res:logo.png')),
+        ('ListView', lambda: gui.ListView.new_from_list(['item %d' % i for i in range(10)])),
+        ('TableWidget', lambda: gui.TableWidget(10, 5)),
+        ('SvgPolyline', gui.SvgPolyline),
+    )
+    benchmarks = []
+    for name, factory in factories:
+        def setup(factory=factory):
+            return lambda: [factory() for _ in range(count)]
+        benchmarks.append(Benchmark('construct.%s' % name, setup, count))
+    return benchmarks
+
+
+def repr_benchmarks(scale):
+    benchmarks = []
+    wide = max(1, int(1000 * scale))
+    depth = max(1, int(100 * scale))
+    rows = max(1, int(100 * scale))
+
+    def full_repr(build):
+        def setup():
+            root = build()
+            invalidate(root)
+            return root.repr
+        return setup
+    benchmarks.append(Benchmark('repr.full.wide_%d' % wide, full_repr(lambda: wide_tree(wide)[0])))
+    benchmarks.append(Benchmark('repr.full.deep_%d' % depth, full_repr(lambda: deep_tree(depth)[0])))
+    benchmarks.append(Benchmark('repr.full.table_%dx5' % rows, full_repr(
+        lambda: gui.Table.new_from_list(table_rows(rows)))))
+
+    # the changed widgets are spread over the groups
+    root, labels = wide_tree(wide, groups=10)
+    for touched in (1, 10, 100):
+        touched = min(touched, wide)
+
+        def setup(touched=touched):
+            step = len(labels) // touched
+            for label in labels[::step][:touched]:
+                label.set_text(label.get_text() + '.')
+            return lambda: root.repr({})
+        benchmarks.append(Benchmark('repr.incremental.touch_%d' % touched, setup))
+    return benchmarks
+
+
+def need_update_benchmarks(scale):
+    benchmarks = []
+    count = max(1, int(1000 * scale))
+    for depth in (1, 10, 100):
+        def setup(depth=depth):
+            _, label = deep_tree(depth)
+
+            def run():
+                for i in range(count):
+                    label.attributes['title'] = str(i)
+            return run
+        benchmarks.append(Benchmark('need_update.depth_%d' % depth, setup, count))
+    return benchmarks
+
+
+def table_benchmarks(scale):
+    rows = max(1, int(10000 * scale))
+    content = table_rows(rows)
+
+    def setup():
+        table = gui.Table()
+        return lambda: table.append_from_list(content)
+    benchmarks = [Benchmark('table.append_from_list_%d' % rows, setup, repeat=1)]
+
+    points = max(1, int(1000 * scale))
+
+    def setup_polyline():
+        polyline = gui.SvgPolyline(_maxlen=points // 2)
+
+        def run():
+            for i in range(points):
+                polyline.add_coord(i, i)
+        return run
+    benchmarks.append(Benchmark('svg.add_coord_%d' % points, setup_polyline, points))
+    return benchmarks
+
+
+def example_benchmarks(examples):
+    from .loadtest import load_app_class
+    benchmarks = []
+    for filename in examples:
+        try:
+            app_class = load_app_class(os.path.join(EXAMPLES_DIR, filename))
+        except Exception as e:
+            sys.stderr.write('skipping example %s: %s\n' % (filename, e))
+            continue
+        # the page requests are not logged
+        app_class = type(app_class.__name__, (app_class,), {'log_message': lambda self, *args: None})
+        name = os.path.splitext(filename)[0]
+
+        def setup_build(app_class=app_class):
+            def run():
+                AppDriver(app_class).close()
+            return run
+        benchmarks.append(Benchmark('example.%s.page' % name, setup_build))
+
+        def setup_repr(app_class=app_class):
+            driver = AppDriver(app_class)
+            driver.close()
+            invalidate(driver.root)
+            return driver.root.repr
+        benchmarks.append(Benchmark('example.%s.repr' % name, setup_repr))
+    return benchmarks
+
+
+class _ClickApp(server.App):
+    def main(self):
+        self.label = gui.Label('clicked 0 times')
+        self.button = gui.Button('click')
+        self.button.onclick.do(self.on_click)
+        self.clicks = 0
+        return gui.VBox(children=[self.label, self.button])
+
+    def on_click(self, emitter):
+        self.clicks += 1
+        self.label.set_text('clicked %d times' % self.clicks)
+
+    def log_message(self, *args):
+        pass
+
+
+def interaction_benchmarks(scale):
+    count = max(1, int(1000 * scale))
+
+    def setup():
+        driver = AppDriver(_ClickApp)
+
+        def run():
+            for _ in range(count):
+                driver.dispatch(driver.app.button, 'onclick')
+                driver.take_messages()
+            driver.close()
+        return run
+    return [Benchmark('interaction.click', setup, count)]
+
+
+def all_benchmarks(scale=1.0, examples=EXAMPLES):
+    benchmarks = (construction_benchmarks(scale) + repr_benchmarks(scale) + need_update_benchmarks(scale) +
+                  table_benchmarks(scale) + interaction_benchmarks(scale))
+    if examples and os.path.isdir(EXAMPLES_DIR):
+        benchmarks += example_benchmarks(examples)
+    return benchmarks
+
+
+def run_benchmarks(benchmarks, repeat=5, name_filter=None, out=None):
+    """ Returns {name: {'best': seconds, 'median': seconds, 'repeat': repetitions, 'ops': operations}} """
+    results = {}
+    for benchmark in benchmarks:
+        if name_filter and name_filter not in benchmark.name:
+            continue
+        results[benchmark.name] = result = benchmark.measure(repeat)
+        if out is not None:
+            out.write('%-45s %12s %12s\n' % (benchmark.name, _format_time(result['best']),
+                                            _format_time(result['median'])))
+            out.flush()
+    return results
+
+
+def compare(baseline, results, threshold=0.1):
+    """ Returns [(name, baseline seconds, seconds, ratio)] of the benchmarks in both results,
+        and the names of the ones slower than baseline by more than threshold (best times)
+    """
+    rows = []
+    regressions = []
+    for name in sorted(set(baseline) & set(results)):
+        before = baseline[name]['best']
+        after = results[name]['best']
+        ratio = after / before if before else float('inf')
+        rows.append((name, before, after, ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def _format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * scale >= 1:
+            return '%.3f%s' % (seconds * scale, unit)
+    return '%.1fns' % (seconds * 1e9)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m remi.benchmark', description='remi rendering benchmarks')
+    parser.add_argument('--output', help='json file the results get written to')
+    parser.add_argument('--compare', help='json file of the baseline results')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown ratio considered a regression')
+    parser.add_argument('--filter', help='runs the benchmarks whose name contains this text')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions of each benchmark')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the sizes of the workloads')
+    parser.add_argument('--examples', default=','.join(EXAMPLES),
+                        help='comma separated example apps used as workloads, empty for none')
+    args = parser.parse_args(argv)
+
+    examples = [example for example in args.examples.split(',') if example]
+    sys.stdout.write('%-45s %12s %12s\n' % ('benchmark (seconds per operation)', 'best', 'median'))
+    results = run_benchmarks(all_benchmarks(args.scale, examples), args.repeat, args.filter, sys.stdout)
+    report = {'meta': {'commit': _git_commit(), 'date': datetime.datetime.now().isoformat(),
+                       'python': platform.python_version(), 'platform': platform.platform(),
+                       'scale': args.scale},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows, regressions = compare(baseline['results'], results, args.threshold)
+        sys.stdout.write('\n%-45s %12s %12s %8s\n' % ('benchmark', 'baseline', 'current', 'ratio'))
+        for name, before, after, ratio in rows:
+            sys.stdout.write('%-45s %12s %12s %7.2fx%s\n' % (name, _format_time(before), _format_time(after), ratio,
+                                                            '  REGRESSION' if name in regressions else ''))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,7 @@ except ImportError:
     import cgi
     escape = cgi.escape
 import mimetypes
+import tempfile
 import base64
 try:
     # Python 2.6-2.7
@@ -43,7 +44,7 @@ except ImportError:
         import html
         unescape = html.unescape
 
-from .server import runtimeInstances
+from .server import get_runtime_registry
 
 
 log = logging.getLogger('remi.gui')
@@ -297,6 +298,9 @@ class Tag(object):
             attributes = {}
         self._parent = None
 
+        # the widgets are registered in the registry of the session creating them
+        self._registry = get_runtime_registry()
+
         self.kwargs = kwargs
 
         self._render_children_list = []
@@ -311,15 +315,20 @@ class Tag(object):
         self.style.onchange.connect(self._need_update)
 
         self.type = _type
-        self.identifier = str(id(self))
+        identifier = str(id(self))
+        if identifier in self._registry:
+            # a widget restored from a snapshot keeps the identifier of its original,
+            # that could be the address of this new one
+            identifier = '%s_%d' % (identifier, len(self._registry))
+        self.identifier = identifier
 
         # attribute['id'] can be overwritten to get a static Tag identifier
         self.attributes.update(attributes)
 
         # the runtime instances are processed every time a requests arrives, searching for the called method
-        # if a class instance is not present in the runtimeInstances, it will
+        # if a class instance is not present in the runtime registry, it will
         # we not callable
-        runtimeInstances[self.identifier] = self
+        self._registry[self.identifier] = self
 
         self.attr_class = self.__class__.__name__ if _class == None else _class
 
@@ -339,7 +348,10 @@ class Tag(object):
             new_identifier (str): a unique id for the tag
         """
         self.attributes['id'] = new_identifier
-        runtimeInstances[new_identifier] = self
+        registry = getattr(self, '_registry', None)
+        if registry is None:
+            registry = get_runtime_registry()
+        registry[new_identifier] = self
 
     def innerHTML(self, local_changed_widgets):
         ret = ''
@@ -385,18 +397,21 @@ class Tag(object):
     def _need_update(self, emitter=None):
         # if there is an emitter, it means self is the actual changed widget
         if not emitter is None:
-            tmp = dict(self.attributes)
-            if len(self.style):
-                tmp['style'] = jsonize(self.style)
-            else:
-                tmp.pop('style', None)
-            self._repr_attributes = ' '.join('%s="%s"' % (k, v) if v is not None else k for k, v in
-                                             tmp.items())
-            
+            self._update_repr_attributes()
+
         if not self.ignore_update:
             if self.get_parent():
                 self.get_parent()._need_update()
 
+    def _update_repr_attributes(self):
+        tmp = dict(self.attributes)
+        if len(self.style):
+            tmp['style'] = jsonize(self.style)
+        else:
+            tmp.pop('style', None)
+        self._repr_attributes = ' '.join('%s="%s"' % (k, v) if v is not None else k for k, v in
+                                         tmp.items())
+
     def _ischanged(self):
         return self.children.ischanged() or self.attributes.ischanged() or self.style.ischanged()
 
@@ -1421,6 +1436,52 @@ class HEAD(Tag):
                     return ret;
                 };
 
+                Remi.prototype._isProtocolV2 = function(){
+                    return this._ws !== null && this._ws !== false && this._ws.protocol == 'remi.v2';
+                };
+
+                Remi.prototype._decodeContent = function(content){
+                    /*protocol v2 sends plain utf-8 text, the legacy protocol url-encoded text*/
+                    return this._isProtocolV2() ? content : decodeURIComponent(content);
+                };
+
+                Remi.prototype._saveFocus = function(){
+                    var focus = {'id':-1, 'caretStart':-1, 'caretEnd':-1};
+                    if (document.activeElement)
+                    {
+                        focus.id = document.activeElement.id;
+                        try{
+                            focus.caretStart = document.activeElement.selectionStart;
+                            focus.caretEnd = document.activeElement.selectionEnd;
+                        }catch(e){}
+                    }
+                    return focus;
+                };
+
+                Remi.prototype._restoreFocus = function(focus){
+                    var elemToFocus = document.getElementById(focus.id);
+                    if( elemToFocus != null ){
+                        elemToFocus.focus();
+                        try{
+                            elemToFocus = document.getElementById(focus.id);
+                            if(focus.caretStart>-1 && focus.caretEnd>-1) elemToFocus.setSelectionRange(focus.caretStart, focus.caretEnd);
+                        }catch(e){}
+                    }
+                };
+
+                Remi.prototype._replaceWidget = function(idElem, html){
+                    var elem = document.getElementById(idElem);
+                    try{
+                        elem.insertAdjacentHTML('afterend',html);
+                        elem.parentElement.removeChild(elem);
+                    }catch(e){
+                        /*Microsoft EDGE doesn't support insertAdjacentHTML for SVGElement*/
+                        var ns = document.createElementNS("http://www.w3.org/2000/svg",'tmp');
+                        ns.innerHTML = html;
+                        elem.parentElement.replaceChild(ns.firstChild, elem);
+                    }
+                };
+
                 Remi.prototype._openSocket = function(){
                     var ws_wss = "ws";
                     try{
@@ -1429,7 +1490,8 @@ class HEAD(Tag):
 
                     var self = this;
                     try{
-                        this._ws = new WebSocket(ws_wss + '://%(host)s/');
+                        /*the protocol version 2 is used if the server accepts it, otherwise ws.protocol is empty*/
+                        this._ws = new WebSocket(ws_wss + '://%(host)s/', ['remi.v2']);
                         console.debug('opening websocket');
 
                         this._ws.onopen = function(evt){
@@ -1461,42 +1523,21 @@ class HEAD(Tag):
                                 /*var idRootNodeWidget = received_msg.substr(0,index-1);*/
                                 var content = received_msg.substr(index,received_msg.length-index);
 
-                                document.body.innerHTML = decodeURIComponent(content);
+                                document.body.innerHTML = self._decodeContent(content);
                             }else if( received_msg[0]=='1' ){ /*update_widget*/
-                                var focusedElement=-1;
-                                var caretStart=-1;
-                                var caretEnd=-1;
-                                if (document.activeElement)
-                                {
-                                    focusedElement = document.activeElement.id;
-                                    try{
-                                        caretStart = document.activeElement.selectionStart;
-                                        caretEnd = document.activeElement.selectionEnd;
-                                    }catch(e){}
-                                }
+                                var focus = self._saveFocus();
                                 var index = received_msg.indexOf(',')+1;
                                 var idElem = received_msg.substr(1,index-2);
                                 var content = received_msg.substr(index,received_msg.length-index);
-
-                                var elem = document.getElementById(idElem);
-                                try{
-                                    elem.insertAdjacentHTML('afterend',decodeURIComponent(content));
-                                    elem.parentElement.removeChild(elem);
-                                }catch(e){
-                                    /*Microsoft EDGE doesn't support insertAdjacentHTML for SVGElement*/
-                                    var ns = document.createElementNS("http://www.w3.org/2000/svg",'tmp');
-                                    ns.innerHTML = decodeURIComponent(content);
-                                    elem.parentElement.replaceChild(ns.firstChild, elem);
-                                }
-
-                                var elemToFocus = document.getElementById(focusedElement);
-                                if( elemToFocus != null ){
-                                    elemToFocus.focus();
-                                    try{
-                                        elemToFocus = document.getElementById(focusedElement);
-                                        if(caretStart>-1 && caretEnd>-1) elemToFocus.setSelectionRange(caretStart, caretEnd);
-                                    }catch(e){}
+                                self._replaceWidget(idElem, self._decodeContent(content));
+                                self._restoreFocus(focus);
+                            }else if( received_msg[0]=='4' ){ /*update_widgets, all the changes of an update cycle*/
+                                var focus = self._saveFocus();
+                                var updates = JSON.parse(received_msg.substr(1,received_msg.length-1));
+                                for(var i=0; i<updates.length; i++){
+                                    self._replaceWidget(updates[i][0], updates[i][1]);
                                 }
+                                self._restoreFocus(focus);
                             }else if( received_msg[0]=='2' ){ /*javascript*/
                                 var content = received_msg.substr(1,received_msg.length-1);
                                 try{
@@ -1564,9 +1605,14 @@ class HEAD(Tag):
 
                 /*this uses websockets*/
                 Remi.prototype.sendCallbackParam = function (widgetID,functionName,params /*a dictionary of name:value*/){
-                    var paramStr = '';
-                    if(params!==null) paramStr=this._paramPacketize(params);
-                    var message = encodeURIComponent(unescape('callback' + '/' + widgetID+'/'+functionName + '/' + paramStr));
+                    var message = '';
+                    if(this._isProtocolV2()){
+                        message = JSON.stringify({'id':widgetID, 'fn':functionName, 'params':params});
+                    }else{
+                        var paramStr = '';
+                        if(params!==null) paramStr=this._paramPacketize(params);
+                        message = encodeURIComponent(unescape('callback' + '/' + widgetID+'/'+functionName + '/' + paramStr));
+                    }
                     this._pendingSendMessages.push(message);
                     if( this._pendingSendMessages.length < %(max_pending_messages)s ){
                         if (this._ws !== null && this._ws.readyState == 1)
@@ -1608,28 +1654,96 @@ class HEAD(Tag):
                         this._renewConnection();
                 };
 
-                Remi.prototype.uploadFile = function(widgetID, eventSuccess, eventFail, eventData, file){
-                    var url = '/';
-                    var xhr = new XMLHttpRequest();
-                    var fd = new FormData();
-                    xhr.open('POST', url, true);
-                    xhr.setRequestHeader('filename', file.name);
-                    xhr.setRequestHeader('listener', widgetID);
-                    xhr.setRequestHeader('listener_function', eventData);
-                    xhr.onreadystatechange = function() {
-                        if (xhr.readyState == 4 && xhr.status == 200) {
-                            /* Every thing ok, file uploaded */
-                            var params={};params['filename']=file.name;
-                            remi.sendCallbackParam(widgetID, eventSuccess,params);
-                            console.log('upload success: ' + file.name);
-                        }else if(xhr.status == 400){
-                            var params={};params['filename']=file.name;
-                            remi.sendCallbackParam(widgetID,eventFail,params);
-                            console.log('upload failed: ' + file.name);
+                Remi.prototype.uploadFile = function(widgetID, eventSuccess, eventFail, eventData, file, chunkSize, parallelUploads){
+                    /* the file is sent in slices, up to parallelUploads at a time. The upload id allows
+                       the server to assemble the slices, and to resume an interrupted upload */
+                    chunkSize = chunkSize || 1048576;
+                    parallelUploads = parallelUploads || 3;
+                    var uploadId = encodeURIComponent([widgetID, file.name, file.size, file.lastModified].join('-'));
+                    var offsets = [];
+                    var active = 0;
+                    var finished = false;
+                    var request = function(offset, onload, onerror){
+                        var xhr = new XMLHttpRequest();
+                        xhr.open('POST', '/', true);
+                        xhr.setRequestHeader('filename', encodeURIComponent(file.name));
+                        xhr.setRequestHeader('listener', widgetID);
+                        xhr.setRequestHeader('listener_function', eventData);
+                        xhr.setRequestHeader('upload-id', uploadId);
+                        xhr.setRequestHeader('upload-size', file.size);
+                        if(offset !== null){
+                            xhr.setRequestHeader('upload-offset', offset);
+                        }
+                        xhr.onload = function(){
+                            if(xhr.status == 200){
+                                onload(JSON.parse(xhr.responseText));
+                            }else{
+                                onerror(xhr.status);
+                            }
+                        };
+                        xhr.onerror = function(){onerror(0);};
+                        xhr.send(offset === null ? null : file.slice(offset, offset + chunkSize));
+                    };
+                    var finish = function(success){
+                        if(finished){return;}
+                        finished = true;
+                        var params={};params['filename']=file.name;
+                        remi.sendCallbackParam(widgetID, success ? eventSuccess : eventFail, params);
+                        console.log('upload ' + (success ? 'success: ' : 'failed: ') + file.name);
+                    };
+                    var sendSlice = function(offset, attempt){
+                        request(offset, function(status){
+                            active--;
+                            if(status.complete){
+                                finish(true);
+                            }
+                            sendSlices();
+                        }, function(httpStatus){
+                            if(httpStatus == 400 || attempt >= 5){
+                                finish(false);
+                                return;
+                            }
+                            /* connection dropped, the slice is sent again after a pause */
+                            setTimeout(function(){sendSlice(offset, attempt + 1);}, 1000 * (attempt + 1));
+                        });
+                    };
+                    var sendSlices = function(){
+                        while(!finished && active < parallelUploads && offsets.length > 0){
+                            active++;
+                            sendSlice(offsets.shift(), 0);
                         }
                     };
-                    fd.append('upload_file', file);
-                    xhr.send(fd);
+                    var start = function(attempt){
+                        /* the upload status tells the slices already received */
+                        request(null, function(status){
+                            if(status.complete){
+                                finish(true);
+                                return;
+                            }
+                            if(file.size == 0){
+                                /* an empty slice completes an empty file */
+                                offsets.push(0);
+                            }
+                            for(var offset = 0; offset < file.size; offset += chunkSize){
+                                var end = Math.min(offset + chunkSize, file.size);
+                                var received = false;
+                                for(var i = 0; i < status.received.length; i++){
+                                    received = received || (status.received[i][0] <= offset && end <= status.received[i][1]);
+                                }
+                                if(!received){
+                                    offsets.push(offset);
+                                }
+                            }
+                            sendSlices();
+                        }, function(httpStatus){
+                            if(httpStatus == 400 || attempt >= 5){
+                                finish(false);
+                                return;
+                            }
+                            setTimeout(function(){start(attempt + 1);}, 1000 * (attempt + 1));
+                        });
+                    };
+                    start(0);
                 };
 
                 window.onerror = function(message, source, lineno, colno, error) {
@@ -3943,7 +4057,9 @@ class FileUploader(Container):
     """
     FileUploader widget:
         allows to upload multiple files to a specified folder.
-        implements the onsuccess and onfailed events.
+        implements the onsuccess, onfailed, ondata and onprogress events.
+        The files are sent in slices of chunk_size bytes, up to parallel_uploads at a time,
+        an interrupted upload gets resumed from the slices already received.
     """
     @property
     @editor_attribute_decorator("WidgetSpecific",'''If True multiple files can be 
@@ -3965,6 +4081,19 @@ class FileUploader(Container):
         self._savepath = value
 
     def __init__(self, savepath='./', multiple_selection_allowed=False, *args, **kwargs):
+        """
+        Args:
+            savepath (str): the folder where the uploaded files are saved
+            multiple_selection_allowed (bool): if True multiple files can be selected at the same time
+            chunk_size (int): keyword only, size in bytes of the slices the files are sent in
+            parallel_uploads (int): keyword only, number of slices sent at the same time
+            ondata_content (bool): keyword only, if True the ondata listeners get the content
+                of the file (bytes) instead of its path, as in the previous versions
+            kwargs: See Container.__init__()
+        """
+        chunk_size = kwargs.pop('chunk_size', 1024 * 1024)
+        parallel_uploads = kwargs.pop('parallel_uploads', 3)
+        self._ondata_content = kwargs.pop('ondata_content', False)
         super(FileUploader, self).__init__(*args, **kwargs)
         self._savepath = savepath
         self._multiple_selection_allowed = multiple_selection_allowed
@@ -3976,13 +4105,15 @@ class FileUploader(Container):
         self.EVENT_ON_SUCCESS = 'onsuccess'
         self.EVENT_ON_FAILED = 'onfailed'
         self.EVENT_ON_DATA = 'ondata'
+        self.EVENT_ON_PROGRESS = 'onprogress'
 
         self.attributes[self.EVENT_ONCHANGE] = \
             "var files = this.files;" \
             "for(var i=0; i<files.length; i++){" \
-            "remi.uploadFile('%(id)s','%(evt_success)s','%(evt_failed)s','%(evt_data)s',files[i]);}" % {
+            "remi.uploadFile('%(id)s','%(evt_success)s','%(evt_failed)s','%(evt_data)s',files[i]," \
+            "%(chunk_size)d,%(parallel_uploads)d);}" % {
                 'id': self.identifier, 'evt_success': self.EVENT_ON_SUCCESS, 'evt_failed': self.EVENT_ON_FAILED,
-                'evt_data': self.EVENT_ON_DATA}
+                'evt_data': self.EVENT_ON_DATA, 'chunk_size': chunk_size, 'parallel_uploads': parallel_uploads}
 
     @decorate_set_on_listener("(self, emitter, filename)")
     @decorate_event
@@ -3994,12 +4125,28 @@ class FileUploader(Container):
     def onfailed(self, filename):
         return (filename, )
 
-    @decorate_set_on_listener("(self, emitter, filedata, filename)")
+    def open_upload(self, filename):
+        """ Returns the writable binary file object where the content of an uploaded file
+            gets streamed. By default a temporary file in savepath, renamed by ondata.
+            Can be overloaded to send the uploaded data elsewhere; the file object has to be
+            seekable, the slices of a file can be received out of order.
+        """
+        return tempfile.NamedTemporaryFile(dir=self._savepath, prefix='.upload-', delete=False)
+
+    @decorate_set_on_listener("(self, emitter, filepath, filename)")
     @decorate_event
-    def ondata(self, filedata, filename):
-        with open(os.path.join(self._savepath, filename), 'wb') as f:
-            f.write(filedata)
-        return (filedata, filename)
+    def ondata(self, filepath, filename):
+        """ Called when a file has been received. filepath is the path of the file returned by
+            open_upload, that gets moved to savepath. The listeners get the final path,
+            or the content of the file with ondata_content.
+        """
+        destination = os.path.join(self._savepath, filename)
+        # os.rename does not overwrite existing files on Windows
+        getattr(os, 'replace', os.rename)(filepath, destination)
+        if self._ondata_content:
+            with open(destination, 'rb') as f:
+                return (f.read(), filename)
+        return (destination, filename)
 
     @decorate_explicit_alias_for_listener_registration
     def set_on_success_listener(self, callback, *userdata):
@@ -4009,10 +4156,20 @@ class FileUploader(Container):
     def set_on_failed_listener(self, callback, *userdata):
         self.onfailed.connect(callback, *userdata)
 
+    @decorate_set_on_listener("(self, emitter, filename, received, size)")
+    @decorate_event
+    def onprogress(self, filename, received, size):
+        """ Called each time a slice of a file has been received, received and size are in bytes """
+        return (filename, received, size)
+
     @decorate_explicit_alias_for_listener_registration
     def set_on_data_listener(self, callback, *userdata):
         self.ondata.connect(callback, *userdata)
 
+    @decorate_explicit_alias_for_listener_registration
+    def set_on_progress_listener(self, callback, *userdata):
+        self.onprogress.connect(callback, *userdata)
+
 
 class FileDownloader(Container, _MixinTextualWidget):
     """FileDownloader widget. Allows to start a file download."""
@@ -4027,11 +4184,13 @@ class FileDownloader(Container, _MixinTextualWidget):
         self._path_separator = path_separator
 
     def download(self):
-        with open(self._filename, 'r+b') as f:
-            content = f.read()
+        """ Returns [file object, headers], the file is opened in binary mode and gets streamed
+            and closed by the server. Before, the content of the file was returned as bytes.
+        """
+        f = open(self._filename, 'rb')
         headers = {'Content-type': 'application/octet-stream',
                    'Content-Disposition': 'attachment; filename="%s"' % os.path.basename(self._filename)}
-        return [content, headers]
+        return [f, headers]
 
 
 class Link(Container, _MixinTextualWidget):
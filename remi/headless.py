@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   Headless App driver.
+   Runs a session of an App in the calling thread, without sockets, browser or idle
+   thread: the page gets built by an in-memory request, the events get dispatched
+   as the websocket callbacks are, and the messages sent to the client are collected.
+
+       driver = AppDriver(MyApp)
+       driver.dispatch(driver.app.button, 'onclick')
+       driver.dispatch(text_input.identifier, 'onchange', new_value='text')
+       updates = parse_updates(driver.take_messages())
+       driver.close()
+"""
+import io
+import json
+import logging
+
+from .server import (WebSocketsHandler, WebSocketSendQueue, clients, from_websocket, _MSG_JS, _MSG_SHOW,
+                     _MSG_UPDATE, _MSG_UPDATE_BATCH, _WS_OPCODE_TEXT)
+
+
+class _PageRequest(object):
+    """ Socket stand-in sending a page request, the response is discarded """
+
+    def makefile(self, mode='rb', *args, **kwargs):
+        if 'w' in mode:
+            return io.BytesIO()
+        return io.BytesIO(b'GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+
+    def sendall(self, data):
+        pass
+
+    def getsockname(self):
+        return ('127.0.0.1', 0)
+
+
+class HeadlessServer(object):
+    """ Server stand-in of the headless sessions. The idle loop is not started,
+        the driver runs the idle steps (see App._idle_step and start_idle_loop of the asyncio server)
+    """
+    auth = None
+    multiple_instance = True
+    server_address = ('127.0.0.1', 0)
+    websocket_timeout_timer_ms = 1000
+    pending_messages_queue_length = 1000
+
+    def __init__(self, title='', userdata=(), update_interval=0.1):
+        self.title = title
+        self.userdata = userdata
+        # must be > 0, the changes get collected by the next update as with the idle loop
+        self.update_interval = update_interval
+        self.session_snapshots = {}
+
+    def start_idle_loop(self, app):
+        pass
+
+
+class HeadlessWebSocket(WebSocketsHandler):
+    """ Websocket of a headless session, the messages are decoded and collected instead of being written.
+        app: the session, None for a websocket of no session
+        queue_length: the length of the send queue, by default the pending_messages_queue_length of the server
+    """
+
+    def __init__(self, app=None, protocol_version=2, queue_length=None, policy='drop_superseded'):
+        self.session = getattr(app, 'session', None)
+        self.server = getattr(app, 'server', None)
+        self.protocol_version = protocol_version
+        self.handshake_done = True
+        self.client_address = ('127.0.0.1', 0)
+        self._log = logging.getLogger('remi.server.ws')
+        if queue_length is None:
+            queue_length = getattr(self.server, 'pending_messages_queue_length', None) or 1000
+        self.send_queue = WebSocketSendQueue(queue_length, policy)
+        self.messages = []
+        # True once disconnected by the server, i.e. for a full send queue
+        self.aborted = False
+
+    def send_frame(self, payload, opcode=_WS_OPCODE_TEXT):
+        self.messages.append(payload.decode('utf-8'))
+
+    def abort(self):
+        self.aborted = True
+
+    def close(self, terminate_server=True):
+        self.send_queue.close()
+
+    def flush(self):
+        """ Writes the queued messages """
+        entries = self.send_queue.get(block=False)
+        while entries:
+            self.write_entries(entries)
+            entries = self.send_queue.get(block=False)
+
+
+class AppDriver(object):
+    """ Creates a session of app_class and drives it in the calling thread.
+        userdata: the arguments of App.main
+        protocol_version: the websocket protocol of the simulated client, 1 for the legacy one
+        The widget updates get sent after each dispatch, as the idle loop would do.
+    """
+
+    def __init__(self, app_class, userdata=(), title='', protocol_version=2):
+        self.server = HeadlessServer(title, userdata)
+        request_handler = app_class(_PageRequest(), ('127.0.0.1', 0), self.server)
+        self.app = clients[request_handler.session]
+        if self.app.root is None:
+            raise RuntimeError('the page of %s could not be built, see the remi.request log' % app_class.__name__)
+        self.ws = HeadlessWebSocket(self.app, protocol_version)
+        self.app.websockets.add(self.ws)
+        self.app.websocket_handshake_done(self.ws)
+
+    @property
+    def root(self):
+        return self.app.root
+
+    def get_widget(self, identifier):
+        return self.app.get_widget(identifier)
+
+    def find_all(self, widget_class, root=None):
+        """ Returns the widgets of the page that are instances of widget_class, in tree order """
+        found = []
+        pending = [root or self.app.root]
+        while pending:
+            widget = pending.pop(0)
+            if isinstance(widget, widget_class):
+                found.append(widget)
+            pending[0:0] = [child for child in widget.children.values() if hasattr(child, 'children')]
+        return found
+
+    def dispatch(self, widget, event_name, **params):
+        """ Calls the event of widget, given as instance or identifier, as a client callback would.
+            The params values get sent as strings and parsed, as the ones of the clients.
+            Returns the value returned by the event.
+        """
+        identifier = getattr(widget, 'identifier', widget)
+        message = json.dumps({'id': str(identifier), 'fn': event_name,
+                              'params': dict((name, value if isinstance(value, type(u'')) else str(value))
+                                             for name, value in params.items())})
+        return self.send(message)
+
+    def send(self, message):
+        """ Handles a callback message, in the json or the legacy format,
+            as WebSocketsHandler.on_message does but raising the errors
+        """
+        if not message.startswith('{'):
+            message = from_websocket(message)
+        result = self.ws.dispatch_message(message, strict=True)
+        self.update()
+        return result
+
+    def update(self, force=False):
+        """ Sends the pending widget updates. The idle loop updates the gui only when a widget
+            asked for a refresh, force sends also the changes made with the refresh disabled
+        """
+        if force or self.app._need_update_flag:
+            self.app.do_gui_update()
+
+    def idle(self, steps=1):
+        """ Runs steps cycles of the idle loop: App.idle and the gui update """
+        for _ in range(steps):
+            self.app._idle_step()
+
+    def take_messages(self):
+        """ Returns the messages sent to the client since the last call """
+        self.ws.flush()
+        messages, self.ws.messages = self.ws.messages, []
+        return messages
+
+    def close(self):
+        clients.pop(self.app.session, None)
+        self.app.websockets.discard(self.ws)
+        self.app.on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def parse_updates(messages):
+    """ Returns the (identifier, html) widget updates of the messages, in order.
+        The html sent to the protocol v1 clients is url encoded (see server.to_websocket)
+    """
+    updates = []
+    for message in messages:
+        if message.startswith(_MSG_UPDATE_BATCH):
+            updates.extend((identifier, html) for identifier, html in json.loads(message[1:]))
+        elif message.startswith(_MSG_UPDATE):
+            identifier, html = message[1:].split(',', 1)
+            updates.append((identifier, html))
+    return updates
+
+
+def parse_javascript(messages):
+    """ Returns the code of the javascript messages """
+    return [message[1:] for message in messages if message.startswith(_MSG_JS)]
+
+
+def parse_show(messages):
+    """ Returns the (root identifier, body html) of the page show messages """
+    return [tuple(message[1:].split(',', 1)) for message in messages if message.startswith(_MSG_SHOW)]
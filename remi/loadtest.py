@@ -0,0 +1,474 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   Synthetic load generator.
+   Each simulated user behaves as the javascript client, without a browser: it gets
+   the page (and its remi_session cookie), opens the websocket with the remi.v2
+   subprotocol and sends callbacks to the widgets found in the page. The time from
+   a callback to its ACK, and to the first update following it, gets measured.
+   The callbacks are either random, among the events without parameters of the
+   widgets in the page, or replayed from a script: a json list of steps like
+       {"widget": "Button", "event": "onclick", "params": {}, "think": 0.5}
+   where widget is a widget identifier or the class of the first widget of that class.
+
+   Usage:
+       python -m remi.loadtest examples/widgets_overview_app.py --users 50 --duration 30
+       python -m remi.loadtest http://127.0.0.1:8081/ --users 50 --pid 1234
+   An application given as file or module gets served by a child process in
+   multiple_instance mode, and the memory per session is measured from its resident
+   memory (Linux only). For a running server the memory is measured if its pid is given.
+"""
+import argparse
+import base64
+import importlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import timeit
+
+try:
+    from html.parser import HTMLParser
+    from urllib.parse import urlparse
+except ImportError:
+    from HTMLParser import HTMLParser
+    from urlparse import urlparse
+
+from .server import WebSocketFrameDecoder, websocket_unmask, encode_text, App, Server, \
+    _MSG_ACK, _MSG_SHOW, _MSG_UPDATE, _MSG_UPDATE_BATCH, _WS_SUBPROTOCOL_V2, _WS_OPCODE_TEXT, _WS_OPCODE_CLOSE, \
+    _WS_OPCODE_PING, _WS_OPCODE_PONG
+
+_CALLBACK = re.compile(r"remi\.sendCallback(Param)?\('([^']+)','([^']+)'")
+
+
+class _CallbackScraper(HTMLParser):
+    """ Collects the (identifier, widget class, event name, has parameters) of the callbacks in a page """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.callbacks = []
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+        identifier = attributes.get('id')
+        widget_class = (attributes.get('class') or '').split(' ')[0]
+        for name, value in attrs:
+            if not name.startswith('on') or not value:
+                continue
+            for params, emitter, event_name in _CALLBACK.findall(value):
+                # the handlers of a widget send its own events
+                if emitter == identifier:
+                    self.callbacks.append((identifier, widget_class, event_name, bool(params)))
+
+
+def scrape_callbacks(html):
+    """ Returns the (identifier, widget class, event name, has parameters) of the callbacks in html """
+    scraper = _CallbackScraper()
+    scraper.feed(html)
+    scraper.close()
+    return scraper.callbacks
+
+
+def client_frame(payload, opcode=_WS_OPCODE_TEXT):
+    """ Returns a masked frame, as the clients have to send them """
+    mask = os.urandom(4)
+    length = len(payload)
+    if length <= 125:
+        header = struct.pack('>BB', 0x80 | opcode, 0x80 | length)
+    elif length <= 65535:
+        header = struct.pack('>BBH', 0x80 | opcode, 0x80 | 126, length)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 0x80 | 127, length)
+    return header + mask + websocket_unmask(payload, mask)
+
+
+class WebSocketClient(object):
+    """ Minimal blocking websocket client speaking the remi.v2 protocol """
+
+    def __init__(self, address, cookie, timeout=10):
+        self.sock = socket.create_connection(address, timeout)
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        self.sock.sendall(encode_text(
+            'GET / HTTP/1.1\r\nHost: %s:%s\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            'Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\nSec-WebSocket-Protocol: %s\r\n'
+            'Cookie: remi_session=%s\r\n\r\n' % (address[0], address[1], key, _WS_SUBPROTOCOL_V2, cookie)))
+        response = b''
+        while b'\r\n\r\n' not in response:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise IOError('connection closed during the websocket handshake')
+            response += chunk
+        head, _, rest = response.partition(b'\r\n\r\n')
+        if not head.startswith(b'HTTP/1.1 101'):
+            raise IOError('websocket handshake refused: %s' % head.split(b'\r\n')[0].decode('latin-1'))
+        self._decoder = WebSocketFrameDecoder()
+        self._decoder.feed(rest)
+
+    def send(self, text):
+        self.sock.sendall(client_frame(encode_text(text)))
+
+    def receive(self, timeout=None):
+        """ Returns the next text message, None on timeout """
+        self.sock.settimeout(timeout)
+        while True:
+            message = self._decoder.next_message()
+            if message is None:
+                try:
+                    data = self.sock.recv(65536)
+                except socket.timeout:
+                    return None
+                if not data:
+                    raise IOError('connection closed')
+                self._decoder.feed(data)
+                continue
+            opcode, payload = message
+            if opcode == _WS_OPCODE_PING:
+                self.sock.sendall(client_frame(payload, _WS_OPCODE_PONG))
+            elif opcode == _WS_OPCODE_CLOSE:
+                raise IOError('connection closed')
+            elif opcode == _WS_OPCODE_TEXT:
+                return payload.decode('utf-8')
+
+    def close(self):
+        try:
+            self.sock.sendall(client_frame(b'\x03\xe8', _WS_OPCODE_CLOSE))
+        except (IOError, OSError):
+            pass
+        self.sock.close()
+
+
+def http_get_page(address, timeout=10):
+    """ Returns (session cookie, html) of a new session """
+    sock = socket.create_connection(address, timeout)
+    try:
+        sock.sendall(encode_text('GET / HTTP/1.1\r\nHost: %s:%s\r\nConnection: close\r\n\r\n' % address))
+        data = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    head, _, body = data.partition(b'\r\n\r\n')
+    cookie = re.search(br'remi_session=(\d+)', head)
+    if cookie is None:
+        raise IOError('no session cookie in the page response')
+    return cookie.group(1).decode('ascii'), body.decode('utf-8')
+
+
+class LoadResults(object):
+    """ Measurements shared by the simulated users """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ack_times = []
+        self.update_times = []
+        self.callbacks = 0
+        self.errors = 0
+        self.failed_users = 0
+
+    def add(self, ack_time, update_time):
+        with self._lock:
+            self.callbacks += 1
+            if ack_time is None:
+                self.errors += 1
+            else:
+                self.ack_times.append(ack_time)
+            if update_time is not None:
+                self.update_times.append(update_time)
+
+    def add_failed_user(self):
+        with self._lock:
+            self.failed_users += 1
+
+
+def percentile(values, fraction):
+    """ Nearest rank percentile of a sorted list """
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+def _latency_summary(values):
+    values = sorted(values)
+    summary = {'count': len(values)}
+    for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)):
+        summary[name] = percentile(values, fraction)
+    return summary
+
+
+class SimulatedUser(object):
+    """ A session driven by random or scripted callbacks until stop gets set """
+
+    def __init__(self, address, results, stop, script=None, events=('onclick',), think=0.0,
+                 update_timeout=1.0, seed=None):
+        self.address = address
+        self.results = results
+        self.stop = stop
+        self.script = script
+        self.events = events
+        self.think = think
+        self.update_timeout = update_timeout
+        self.random = random.Random(seed)
+        self.callbacks = []
+        self.connected = threading.Event()
+        # set when an update arrived while waiting for the ack of a callback
+        self._update_received = False
+
+    def _scrape(self, html):
+        self.callbacks = scrape_callbacks(html)
+
+    def run(self):
+        try:
+            cookie, html = http_get_page(self.address)
+            self._scrape(html)
+            ws = WebSocketClient(self.address, cookie)
+        except (IOError, OSError):
+            self.results.add_failed_user()
+            self.connected.set()
+            return
+        try:
+            # the handshake is followed by the whole page
+            self._receive_until(ws, (_MSG_SHOW,), time.time() + 10)
+            ws.send('connected')
+            self._receive_until(ws, (_MSG_ACK,), time.time() + 10)
+            self.connected.set()
+            step = 0
+            while not self.stop.is_set():
+                if self.script:
+                    action = self.script[step % len(self.script)]
+                    step += 1
+                    callback = self._resolve(action.get('widget'), action['event'])
+                    params = action.get('params')
+                    think = action.get('think', self.think)
+                else:
+                    callback, params, think = self._random_callback(), None, self.think
+                if callback is not None:
+                    self._send_callback(ws, callback[0], callback[2], params)
+                if think:
+                    self.stop.wait(think)
+                elif callback is None:
+                    # nothing to click
+                    self.stop.wait(0.1)
+        except (IOError, OSError):
+            self.results.add_failed_user()
+        finally:
+            self.connected.set()
+            ws.close()
+
+    def _random_callback(self):
+        candidates = [callback for callback in self.callbacks if callback[2] in self.events and not callback[3]]
+        if not candidates:
+            return None
+        return self.random.choice(candidates)
+
+    def _resolve(self, widget, event_name):
+        for callback in self.callbacks:
+            if callback[2] == event_name and callback[0] == widget:
+                return callback
+        for callback in self.callbacks:
+            if callback[2] == event_name and (widget is None or callback[1] == widget):
+                return callback
+        return None
+
+    def _send_callback(self, ws, identifier, event_name, params):
+        start = timeit.default_timer()
+        ws.send(json.dumps({'id': identifier, 'fn': event_name, 'params': params}))
+        ack_time = None
+        update_time = None
+        deadline = time.time() + 10
+        if self._receive_until(ws, (_MSG_ACK,), deadline) is not None:
+            ack_time = timeit.default_timer() - start
+            # the update could also be sent before the ack gets read
+            if self._update_received or self._receive_until(
+                    ws, (_MSG_UPDATE, _MSG_UPDATE_BATCH, _MSG_SHOW), time.time() + self.update_timeout) is not None:
+                update_time = timeit.default_timer() - start
+        self.results.add(ack_time, update_time)
+
+    def _receive_until(self, ws, prefixes, deadline):
+        """ Returns the first message starting with one of the prefixes, None on timeout """
+        self._update_received = False
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return None
+            message = ws.receive(timeout)
+            if message is None:
+                return None
+            if message.startswith(_MSG_SHOW):
+                # the root widget changed, its callbacks replace the previous ones
+                self._scrape(message[message.index(',') + 1:])
+            if message[:1] in (_MSG_UPDATE, _MSG_UPDATE_BATCH, _MSG_SHOW):
+                self._update_received = True
+            if message[:1] in prefixes:
+                return message
+
+
+def process_memory(pid):
+    """ Returns the resident memory of a process in bytes, None if not available """
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def run(address, users=10, duration=10.0, script=None, events=('onclick',), think=0.0, update_timeout=1.0,
+        ramp_up=1.0, pid=None, seed=None):
+    """ Simulates users against the server at address (host, port) for duration seconds.
+        Returns a dict with the throughput, the ack and update round trip percentiles in seconds,
+        and the memory per session in bytes if the server pid is known.
+    """
+    results = LoadResults()
+    stop = threading.Event()
+    memory_before = process_memory(pid) if pid is not None else None
+    simulated = [SimulatedUser(address, results, stop, script, events, think, update_timeout,
+                               None if seed is None else seed + index) for index in range(users)]
+    threads = []
+    for user in simulated:
+        thread = threading.Thread(target=user.run)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+        if users > 1:
+            time.sleep(float(ramp_up) / users)
+    for user in simulated:
+        user.connected.wait(30)
+    start = time.time()
+    stop.wait(duration)
+    memory_after = process_memory(pid) if pid is not None else None
+    stop.set()
+    for thread in threads:
+        thread.join(15)
+    elapsed = time.time() - start
+
+    summary = {'users': users, 'failed_users': results.failed_users, 'duration': elapsed,
+               'callbacks': results.callbacks, 'errors': results.errors,
+               'throughput': results.callbacks / elapsed if elapsed else 0.0,
+               'ack': _latency_summary(results.ack_times),
+               'update': _latency_summary(results.update_times),
+               'memory_per_session': None}
+    if memory_before is not None and memory_after is not None and users:
+        summary['memory_per_session'] = (memory_after - memory_before) / float(users)
+    return summary
+
+
+def load_app_class(spec):
+    """ Returns the App subclass given as 'path/to/file.py[:ClassName]' or 'package.module[:ClassName]' """
+    target, _, class_name = spec.partition(':')
+    if target.endswith('.py'):
+        directory, filename = os.path.split(os.path.abspath(target))
+        # the examples import their neighbour modules
+        sys.path.insert(0, directory)
+        target = filename[:-3]
+    module = importlib.import_module(target)
+    if class_name:
+        return getattr(module, class_name)
+    classes = [obj for obj in vars(module).values() if isinstance(obj, type) and issubclass(obj, App) and
+               obj.__module__ == module.__name__]
+    if len(classes) != 1:
+        raise ValueError('%s defines %d App classes, select one as %s:ClassName' % (spec, len(classes), spec))
+    return classes[0]
+
+
+def _serve_app(spec, server_options, address_queue):
+    if spec.partition(':')[0].endswith('.py'):
+        # the examples refer to their resources by relative paths
+        os.chdir(os.path.dirname(os.path.abspath(spec.partition(':')[0])))
+        spec = os.path.basename(spec)
+    server = Server(load_app_class(spec), start=False, address='127.0.0.1', port=0, start_browser=False,
+                    multiple_instance=True, **server_options)
+    server.start()
+    address_queue.put(server._sserver.server_address[:2])
+    threading.Event().wait()
+
+
+def print_summary(summary, out=sys.stdout):
+    out.write('users %(users)d (%(failed_users)d failed), %(callbacks)d callbacks in %(duration).1fs, '
+              '%(throughput).1f callbacks/s, %(errors)d without ack\n' % summary)
+    for name in ('ack', 'update'):
+        latency = summary[name]
+        if not latency['count']:
+            out.write('%-6s no samples\n' % name)
+            continue
+        out.write('%-6s %6d samples  p50 %7.1fms  p90 %7.1fms  p99 %7.1fms  max %7.1fms\n' % (
+            name, latency['count'], latency['p50'] * 1000, latency['p90'] * 1000, latency['p99'] * 1000,
+            latency['max'] * 1000))
+    if summary['memory_per_session'] is not None:
+        out.write('memory per session %.1f KiB\n' % (summary['memory_per_session'] / 1024.0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m remi.loadtest', description='Synthetic load for remi apps')
+    parser.add_argument('target', help='http://host:port/ of a running server, or the App to serve, '
+                                       'as file.py[:ClassName] or module[:ClassName]')
+    parser.add_argument('--users', type=int, default=10, help='simulated users')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load, after all users connect')
+    parser.add_argument('--ramp-up', type=float, default=1, help='seconds to connect all the users')
+    parser.add_argument('--script', help='json file of the steps replayed by each user')
+    parser.add_argument('--events', default='onclick', help='comma separated events sent randomly')
+    parser.add_argument('--think', type=float, default=0, help='seconds between the callbacks of a user')
+    parser.add_argument('--update-timeout', type=float, default=1,
+                        help='seconds an update is awaited after a callback')
+    parser.add_argument('--update-interval', type=float, default=0.1, help='update_interval of the served App')
+    parser.add_argument('--engine', default='threading', help='engine of the served App')
+    parser.add_argument('--pid', type=int, help='pid of the running server, to measure its memory')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args(argv)
+
+    script = None
+    if args.script:
+        with open(args.script) as f:
+            script = json.load(f)
+
+    process = None
+    if args.target.startswith('http://'):
+        url = urlparse(args.target)
+        address = (url.hostname, url.port or 80)
+        pid = args.pid
+    else:
+        address_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_serve_app, args=(
+            args.target, {'update_interval': args.update_interval, 'engine': args.engine}, address_queue))
+        process.daemon = True
+        process.start()
+        address = address_queue.get(timeout=60)
+        pid = process.pid
+    try:
+        summary = run(address, args.users, args.duration, script, tuple(args.events.split(',')), args.think,
+                      args.update_timeout, args.ramp_up, pid, args.seed)
+    finally:
+        if process is not None:
+            process.terminate()
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        print_summary(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   Server metrics.
+   Enabled by start(MyApp, metrics=True): the server collects counters and latency
+   histograms of its hot paths, available from Python as Server.metrics.collect()
+   and at the /remi:metrics url in the Prometheus text format.
+   When disabled the server holds no Metrics instance, and the instrumented code
+   paths only check for it.
+"""
+import bisect
+import threading
+import timeit
+
+
+# seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# bytes
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+_HELP = {
+    'remi_sessions': 'Active sessions',
+    'remi_websockets': 'Connected websockets',
+    'remi_websocket_messages_received_total': 'Websocket messages received from the clients',
+    'remi_websocket_messages_sent_total': 'Websocket messages sent to the clients',
+    'remi_websocket_bytes_sent_total': 'Websocket payload bytes sent to the clients, after compression',
+    'remi_websocket_send_queue_entries': 'Entries waiting in the websocket send queues',
+    'remi_websocket_send_queue_max_entries': 'Entries waiting in the longest websocket send queue',
+    'remi_websocket_send_queue_overflows_total': 'Websockets disconnected because of a full send queue',
+    'remi_gui_update_seconds': 'Duration of App.do_gui_update, the wait for App.update_lock excluded',
+    'remi_gui_update_bytes': 'Widget html bytes sent by a gui update',
+    'remi_repr_seconds': 'Duration of the Tag.repr of the root widget in a gui update',
+    'remi_callback_seconds': 'Duration of the websocket callbacks, by event name',
+    'remi_update_lock_wait_seconds': 'Time waited for App.update_lock by the callbacks and the idle loop',
+    'remi_static_cache_hits_total': 'Static files served from the memory cache',
+    'remi_static_cache_misses_total': 'Static files loaded from disk',
+    'remi_static_cache_bytes': 'Bytes held by the static file cache',
+}
+
+
+class Histogram(object):
+    """ Cumulative histogram, as exposed by Prometheus.
+        counts[i] is the number of observations <= buckets[i], the last one is +Inf.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @property
+    def counts(self):
+        counts = []
+        total = 0
+        for count in self._counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class _TimedLock(object):
+    """ Context manager acquiring a lock and measuring the wait """
+
+    def __init__(self, metrics, lock, name):
+        self._metrics = metrics
+        self._lock = lock
+        self._name = name
+
+    def __enter__(self):
+        start = self._metrics.clock()
+        self._lock.acquire()
+        self._metrics.observe(self._name, self._metrics.clock() - start)
+        return self._lock
+
+    def __exit__(self, *args):
+        self._lock.release()
+
+
+class Metrics(object):
+    """ Registry of the server counters and histograms.
+        The samples are identified by name and labels, a tuple of (label, value) pairs.
+        The collectors are callables returning the current state of the server as
+        (name, type, {labels: value}) tuples, evaluated at collection time.
+    """
+
+    clock = staticmethod(timeit.default_timer)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels) -> value
+        self._counters = {}
+        # (name, labels) -> Histogram
+        self._histograms = {}
+        self._collectors = []
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def timed_lock(self, lock, name='remi_update_lock_wait_seconds'):
+        """ Returns a context manager holding lock, the time waited for it gets observed as name """
+        return _TimedLock(self, lock, name)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def collect(self):
+        """ Returns {name: {labels: value}}, the histograms values are
+            {'buckets': [(upper bound, cumulative count)], 'sum': sum, 'count': count}
+        """
+        return dict((name, samples) for name, _, samples in self._families())
+
+    def _families(self):
+        families = {}
+        types = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                families.setdefault(name, {})[labels] = value
+                types[name] = 'counter'
+            for (name, labels), histogram in self._histograms.items():
+                families.setdefault(name, {})[labels] = {
+                    'buckets': list(zip(histogram.buckets + (float('inf'),), histogram.counts)),
+                    'sum': histogram.sum, 'count': histogram.count}
+                types[name] = 'histogram'
+        for collector in self._collectors:
+            for name, metric_type, samples in collector():
+                families.setdefault(name, {}).update(samples)
+                types[name] = metric_type
+        return [(name, types[name], families[name]) for name in sorted(families)]
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text exposition format """
+        lines = []
+        for name, metric_type, samples in self._families():
+            if name in _HELP:
+                lines.append('# HELP %s %s' % (name, _HELP[name]))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels in sorted(samples):
+                value = samples[labels]
+                if metric_type != 'histogram':
+                    lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+                    continue
+                for bound, count in value['buckets']:
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', _format_value(bound)),)), count))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(value['sum'])))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), value['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                          .replace('\n', '\\n')) for label, value in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
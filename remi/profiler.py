@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   Callback profiler.
+   Enabled by start(MyApp, profiler=True) or passing a configured CallbackProfiler:
+   the websocket callbacks, App.idle and the gui updates of the idle loop get timed
+   (wall and cpu time) by (widget class, event name, listener). The slowest ones are
+   logged periodically, returned by CallbackProfiler.top() and served as a text report
+   at the /remi:profile url.
+   With cprofile_threshold set, the next call of a listener that took longer than
+   the threshold gets run under cProfile, and its statistics are added to the report.
+"""
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import time
+import timeit
+
+try:
+    # the time spent by the calling thread, the other sessions are served concurrently
+    _cpu_clock = time.thread_time
+except AttributeError:
+    _cpu_clock = getattr(time, 'process_time', time.clock)
+
+
+def listener_name(callback):
+    """ Returns the qualified name of the function handling an event:
+        the listener registered to an event connector, or the callback itself
+    """
+    listener = getattr(callback, 'callback', None) or callback
+    # the listener can be the event of another widget
+    listener = getattr(listener, 'event_method_bound', listener)
+    function = getattr(listener, '__func__', listener)
+    name = getattr(function, '__qualname__', None)
+    if name is None:
+        name = getattr(function, '__name__', type(function).__name__)
+        owner = getattr(listener, '__self__', None)
+        if owner is not None:
+            # the class defining the method, as in the __qualname__ of python 3
+            classes = [cls for cls in getattr(type(owner), '__mro__', ()) if vars(cls).get(name) is function]
+            name = '%s.%s' % ((classes[0] if classes else type(owner)).__name__, name)
+    return '%s.%s' % (getattr(function, '__module__', '?'), name)
+
+
+class CallbackStats(object):
+    """ Times of the calls of a (widget class, event name, listener) """
+
+    def __init__(self, key):
+        self.key = key
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max_wall = 0.0
+
+    def add(self, wall, cpu):
+        self.count += 1
+        self.wall += wall
+        self.cpu += cpu
+        self.max_wall = max(self.max_wall, wall)
+
+    def as_dict(self):
+        widget_class, event_name, listener = self.key
+        return {'widget_class': widget_class, 'event': event_name, 'listener': listener, 'count': self.count,
+                'wall': self.wall, 'cpu': self.cpu, 'max_wall': self.max_wall,
+                'mean_wall': self.wall / self.count if self.count else 0.0}
+
+
+class CallbackProfiler(object):
+    """ Records the wall and cpu time of the calls by (widget class, event name, listener).
+        top: number of entries of the reports
+        report_interval: seconds between the reports logged by remi.server.profiler, None disables them
+        cprofile_threshold: wall time in seconds, the next call of a listener taking longer
+            gets profiled by cProfile. None disables the profiling
+        cprofile_lines: number of functions listed by the profiles, sorted by cumulative time
+    """
+
+    def __init__(self, top=10, report_interval=60, cprofile_threshold=None, cprofile_lines=20):
+        self.top_count = top
+        self.report_interval = report_interval
+        self.cprofile_threshold = cprofile_threshold
+        self.cprofile_lines = cprofile_lines
+        self._lock = threading.Lock()
+        self._stats = {}
+        # key -> pstats text of the last profiled call
+        self.profiles = {}
+        self._profile_pending = set()
+        self._profiling = threading.Lock()
+        self._last_report = time.time()
+        self._log = logging.getLogger('remi.server.profiler')
+
+    def call(self, key, function, *args, **kwargs):
+        """ Calls function and records its times under key, a tuple (widget class, event name, listener) """
+        profiler = None
+        if key in self._profile_pending and self._profiling.acquire(False):
+            profiler = cProfile.Profile()
+        wall_start = timeit.default_timer()
+        cpu_start = _cpu_clock()
+        try:
+            if profiler is None:
+                return function(*args, **kwargs)
+            try:
+                return profiler.runcall(function, *args, **kwargs)
+            finally:
+                self._profiling.release()
+                self._profile_pending.discard(key)
+                self.profiles[key] = self._format_profile(profiler)
+        finally:
+            self.record(key, timeit.default_timer() - wall_start, _cpu_clock() - cpu_start)
+
+    def record(self, key, wall, cpu):
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = CallbackStats(key)
+            stats.add(wall, cpu)
+        if self.cprofile_threshold is not None and wall > self.cprofile_threshold and key not in self.profiles:
+            self._profile_pending.add(key)
+        if self.report_interval is not None and time.time() - self._last_report > self.report_interval:
+            self._last_report = time.time()
+            self._log.info('slowest callbacks:\n%s' % self.format_top())
+
+    def _format_profile(self, profiler):
+        output = io.BytesIO() if str is bytes else io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(self.cprofile_lines)
+        return output.getvalue()
+
+    def top(self, count=None, sort='wall'):
+        """ Returns the stats dicts of the entries with the highest value of sort,
+            one of 'wall', 'cpu', 'mean_wall', 'max_wall' or 'count'
+        """
+        with self._lock:
+            stats = [entry.as_dict() for entry in self._stats.values()]
+        stats.sort(key=lambda entry: entry[sort], reverse=True)
+        return stats[:count or self.top_count]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.profiles.clear()
+            self._profile_pending.clear()
+
+    def format_top(self, count=None):
+        lines = ['%8s %10s %10s %10s %10s  %s' % ('calls', 'wall', 'cpu', 'mean', 'max', 'widget.event -> listener')]
+        for entry in self.top(count):
+            lines.append('%8d %10.4f %10.4f %10.4f %10.4f  %s.%s -> %s' % (
+                entry['count'], entry['wall'], entry['cpu'], entry['mean_wall'], entry['max_wall'],
+                entry['widget_class'], entry['event'], entry['listener']))
+        return '\n'.join(lines)
+
+    def report(self, count=None):
+        """ Returns the text report: the slowest callbacks followed by the cProfile statistics """
+        sections = [self.format_top(count)]
+        for key, profile in sorted(self.profiles.items()):
+            sections.append('cProfile of %s.%s -> %s\n%s' % (key + (profile,)))
+        return '\n\n'.join(sections) + '\n'
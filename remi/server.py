@@ -30,6 +30,7 @@ import webbrowser
 import struct
 import socket
 import base64
+import binascii
 import hashlib
 import sys
 import threading
@@ -48,19 +49,65 @@ except ImportError:
     from urllib.parse import unquote_to_bytes
     from urllib.parse import urlparse
     from urllib.parse import parse_qs
-import cgi
+import json
+import tempfile
 import weakref
+import collections
+import contextlib
+import email.utils
+import uuid
 
 import zlib
 
+from .metrics import Metrics, SIZE_BUCKETS
+from .profiler import CallbackProfiler, listener_name
+
+
+def new_session_id(session_affinity=None):
+    """ Returns the id of a new session: its creation time in milliseconds, increased if
+        another session got created in the same millisecond. The prefork workers, given
+        session_affinity (worker index, worker count), get the ids equal to their index modulo count
+    """
+    global _last_session
+    with _session_lock:
+        session = max(int(time.time() * 1000), _last_session + 1)
+        if session_affinity is not None:
+            index, count = session_affinity
+            session += (index - session) % count
+        _last_session = session
+        return session
+
 
 def gzip_encode(content):
     gzip_compress = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
     data = gzip_compress.compress(content) + gzip_compress.flush()
     return data
 
+
+def accepts_encoding(accept_encoding, coding):
+    """ Returns True if the Accept-Encoding header value accepts coding, by name or by '*',
+        with a q-value greater than 0
+    """
+    qvalues = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.partition(';')
+        qvalue = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name.strip().lower()] = qvalue
+    return qvalues.get(coding, qvalues.get('*', 0.0)) > 0
+
 clients = {}
+_last_session = 0
+_session_lock = threading.Lock()
+# widgets created outside of a session (i.e. by user threads), each App has its own registry
 runtimeInstances = weakref.WeakValueDictionary()
+_runtime_context = threading.local()
 
 pyLessThan3 = sys.version_info < (3,)
 
@@ -68,6 +115,14 @@ pyLessThan3 = sys.version_info < (3,)
 _MSG_ACK = '3'
 _MSG_JS = '2'
 _MSG_UPDATE = '1'
+_MSG_SHOW = '0'
+# all the widget updates of a gui update cycle, as a json list of [identifier, html] (protocol v2 only)
+_MSG_UPDATE_BATCH = '4'
+
+# websocket subprotocol negotiated by the clients supporting the protocol version 2:
+# updates are sent as plain utf-8 text (not url-encoded) and callbacks are json objects.
+# Clients not requesting it get the legacy url-encoded protocol (version 1)
+_WS_SUBPROTOCOL_V2 = 'remi.v2'
 
 
 def to_websocket(data):
@@ -85,11 +140,333 @@ def from_websocket(data):
 
 
 def encode_text(data):
-    if not pyLessThan3:
+    # Python 2 byte strings are returned as they are
+    if not isinstance(data, bytes):
         return data.encode('utf-8')
     return data
 
 
+_WS_OPCODE_CONTINUATION = 0x0
+_WS_OPCODE_TEXT = 0x1
+_WS_OPCODE_BINARY = 0x2
+_WS_OPCODE_CLOSE = 0x8
+_WS_OPCODE_PING = 0x9
+_WS_OPCODE_PONG = 0xA
+# close status code of the messages exceeding the size the server accepts
+_WS_CLOSE_MESSAGE_TOO_BIG = 1009
+
+
+def websocket_unmask(payload, mask):
+    """ Unmasks a whole websocket payload at once.
+        The payload and the repeated mask are XORed as two wide integers,
+        avoiding a python loop over the single bytes.
+    """
+    length = len(payload)
+    if length == 0:
+        return b''
+    repeated_mask = mask * (length // 4) + mask[:length % 4]
+    if pyLessThan3:
+        value = int(binascii.hexlify(payload), 16) ^ int(binascii.hexlify(repeated_mask), 16)
+        return binascii.unhexlify('%0*x' % (length * 2, value))
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated_mask, 'big')).to_bytes(length, 'big')
+
+
+# payloads smaller than this get sent in a single buffer together with the frame header
+_WS_COALESCE_SIZE = 4096
+
+
+def websocket_frame_header(length, opcode=_WS_OPCODE_TEXT, rsv=0):
+    """ Returns the header of an unmasked and unfragmented frame (server to client).
+        rsv holds the reserved bits of the first byte (0x40 marks a compressed message).
+    """
+    if length <= 125:
+        return struct.pack('>BB', 0x80 | rsv | opcode, length)
+    if length <= 65535:
+        return struct.pack('>BBH', 0x80 | rsv | opcode, 126, length)
+    return struct.pack('>BBQ', 0x80 | rsv | opcode, 127, length)
+
+
+_WS_RSV1 = 0x40
+_WS_DEFLATE_TAIL = b'\x00\x00\xff\xff'
+
+
+def parse_websocket_extensions(header):
+    """ Parses a Sec-WebSocket-Extensions header.
+        Returns a list of (extension_name, {param: value}) in order of preference.
+    """
+    extensions = []
+    if not header:
+        return extensions
+    for offer in header.split(','):
+        tokens = [t.strip() for t in offer.split(';')]
+        params = {}
+        for token in tokens[1:]:
+            if not token:
+                continue
+            name, _, value = token.partition('=')
+            params[name.strip()] = value.strip().strip('"') or None
+        extensions.append((tokens[0], params))
+    return extensions
+
+
+class WebSocketDeflate(object):
+    """ permessage-deflate (RFC 7692) state of a connection.
+        The compression window is kept across messages (context takeover), unless the
+        client asks for server_no_context_takeover. Messages shorter than threshold
+        are sent uncompressed. The received messages are inflated up to max_message_size bytes.
+    """
+
+    max_message_size = 16 * 1024 * 1024
+    # the offers with other parameters get declined (RFC 7692 5.1)
+    PARAMETERS = ('server_no_context_takeover', 'client_no_context_takeover',
+                  'server_max_window_bits', 'client_max_window_bits')
+
+    def __init__(self, level, window_bits, threshold, context_takeover=True):
+        self.level = level
+        # raw deflate streams do not support a window of 8 bits
+        self.window_bits = max(9, min(15, window_bits))
+        self.threshold = threshold
+        self.context_takeover = context_takeover
+        self._compressor = None
+        self._decompressor = zlib.decompressobj(-15)
+
+    def compress(self, payload):
+        if self._compressor is None or not self.context_takeover:
+            # the memory level is reduced together with the window size
+            self._compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.window_bits,
+                                                max(1, min(9, self.window_bits - 7)))
+        data = self._compressor.compress(payload) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(_WS_DEFLATE_TAIL):
+            data = data[:-4]
+        return data
+
+    def decompress(self, payload):
+        """ Returns the inflated message, None if it exceeds max_message_size """
+        data = self._decompressor.decompress(payload + _WS_DEFLATE_TAIL, self.max_message_size + 1)
+        if len(data) > self.max_message_size:
+            return None
+        return data
+
+    @classmethod
+    def negotiate(cls, extensions_header, settings):
+        """ Returns (WebSocketDeflate instance, response header value) if permessage-deflate
+            has been offered by the client and can be accepted, else (None, None).
+        """
+        if not settings:
+            return None, None
+        for name, params in parse_websocket_extensions(extensions_header):
+            if name != 'permessage-deflate' or [param for param in params if param not in cls.PARAMETERS]:
+                continue
+            window_bits = settings.get('window_bits', 15)
+            if 'server_max_window_bits' in params:
+                try:
+                    offered_bits = int(params['server_max_window_bits'])
+                except (TypeError, ValueError):
+                    continue
+                # zlib compresses raw deflate streams with at least 9 bits, and the
+                # response must not exceed the offer (RFC 7692 7.1.2.1): the offer gets declined
+                if offered_bits < 9:
+                    continue
+                window_bits = min(window_bits, offered_bits)
+            deflate = cls(settings.get('level', 6), window_bits, settings.get('threshold', 0),
+                          context_takeover='server_no_context_takeover' not in params)
+            response = 'permessage-deflate'
+            if not deflate.context_takeover:
+                response += '; server_no_context_takeover'
+            if deflate.window_bits < 15:
+                response += '; server_max_window_bits=%d' % deflate.window_bits
+            return deflate, response
+        return None, None
+
+
+class WebSocketFrameDecoder(object):
+    """ Incremental RFC 6455 frame decoder.
+        Received bytes are appended by feed(), next_message() returns the complete
+        messages as (opcode, payload) tuples. Fragmented messages are reassembled,
+        control frames (ping/pong/close) are returned as soon as they arrive,
+        also in between the fragments of a data message.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self._fragments = []
+        self._fragments_opcode = None
+        self._fragments_compressed = False
+        # WebSocketDeflate instance, if permessage-deflate has been negotiated
+        self.deflate = None
+
+    def feed(self, data):
+        self.buffer += data
+
+    def _next_frame(self):
+        buf = self.buffer
+        if len(buf) < 2:
+            return None
+        fin = buf[0] & 0x80
+        rsv1 = buf[0] & _WS_RSV1
+        opcode = buf[0] & 0x0f
+        masked = buf[1] & 0x80
+        length = buf[1] & 0x7f
+        offset = 2
+        if length == 126:
+            if len(buf) < 4:
+                return None
+            length = struct.unpack_from('>H', buf, 2)[0]
+            offset = 4
+        elif length == 127:
+            if len(buf) < 10:
+                return None
+            length = struct.unpack_from('>Q', buf, 2)[0]
+            offset = 10
+        mask = None
+        if masked:
+            if len(buf) < offset + 4:
+                return None
+            mask = bytes(buf[offset:offset + 4])
+            offset += 4
+        if len(buf) < offset + length:
+            return None
+        payload = bytes(buf[offset:offset + length])
+        del buf[:offset + length]
+        if mask is not None:
+            payload = websocket_unmask(payload, mask)
+        return fin, rsv1, opcode, payload
+
+    def next_message(self):
+        """ Returns the next complete message as (opcode, payload) or None if more data is required
+        """
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return None
+            fin, rsv1, opcode, payload = frame
+            if opcode >= _WS_OPCODE_CLOSE:
+                # control frames are never fragmented
+                return opcode, payload
+            if opcode != _WS_OPCODE_CONTINUATION:
+                self._fragments_opcode = opcode
+                self._fragments_compressed = bool(rsv1)
+                self._fragments = []
+            self._fragments.append(payload)
+            if fin:
+                opcode = self._fragments_opcode
+                payload = b''.join(self._fragments)
+                self._fragments = []
+                self._fragments_opcode = None
+                if self._fragments_compressed:
+                    if self.deflate is None:
+                        raise ValueError('compressed message without permessage-deflate')
+                    payload = self.deflate.decompress(payload)
+                    if payload is None:
+                        # the connection gets closed as for a close frame of the client
+                        return _WS_OPCODE_CLOSE, struct.pack('>H', _WS_CLOSE_MESSAGE_TOO_BIG)
+                return opcode, payload
+
+
+class WebSocketSendQueue(object):
+    """ Bounded queue of the messages waiting to be written to a websocket.
+        The entries are (identifier, text) tuples: identifier is None for plain messages,
+        the widget identifier for the widget updates, whose text is the widget html.
+        The queue is filled by the App threads and drained by the connection writer,
+        so that the rendering never waits for the client to read its data.
+        With the policy 'drop_superseded' a client falling behind gets only the latest
+        render of each widget: a new update replaces the queued update of the same widget
+        and the queued updates of its descendants, a page show replaces all the queued updates.
+        With the policy 'disconnect' every update is kept.
+        Entries not fitting the queue are refused, and the client gets disconnected.
+    """
+
+    POLICIES = ('drop_superseded', 'disconnect')
+
+    def __init__(self, max_length, policy='drop_superseded'):
+        if policy not in self.POLICIES:
+            raise ValueError("policy must be one of %s" % ', '.join(self.POLICIES))
+        self.max_length = max_length
+        self.policy = policy
+        self.closed = False
+        # optional callable invoked after the entries are queued, used to wake up event loop writers
+        self.wakeup = None
+        self._entries = collections.deque()
+        # identifier -> identifiers of the ancestor widgets, for the queued updates
+        self._ancestors = {}
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put_message(self, message, replaces_updates=False):
+        """ Queues a plain message. replaces_updates is True for the messages
+            showing the whole page, making the queued updates superfluous.
+        """
+        return self.put([(None, message)], replaces_updates=replaces_updates)
+
+    def put_updates(self, updates, ancestors=None):
+        """ Queues the (identifier, html) updates of a gui update cycle as a whole.
+            ancestors maps the identifiers to the identifiers of their ancestor widgets.
+        """
+        return self.put(updates, ancestors)
+
+    def put(self, entries, ancestors=None, replaces_updates=False):
+        """ Returns False if the entries do not fit the queue """
+        with self._condition:
+            if self.closed:
+                return True
+            if self.policy == 'drop_superseded':
+                self._drop_superseded(entries, replaces_updates)
+            if len(self._entries) + len(entries) > self.max_length:
+                return False
+            self._entries.extend(entries)
+            if ancestors:
+                self._ancestors.update(ancestors)
+            self._condition.notify()
+        if self.wakeup is not None:
+            self.wakeup()
+        return True
+
+    def _drop_superseded(self, entries, replaces_updates):
+        identifiers = set(identifier for identifier, _ in entries if identifier is not None)
+        if not (identifiers or replaces_updates):
+            return
+        kept = collections.deque()
+        for entry in self._entries:
+            identifier = entry[0]
+            if identifier is not None and (replaces_updates or identifier in identifiers or
+                                           not identifiers.isdisjoint(self._ancestors.get(identifier, ()))):
+                self._ancestors.pop(identifier, None)
+            else:
+                kept.append(entry)
+        self._entries = kept
+
+    def get(self, block=True):
+        """ Returns the next entries to be written: a plain message, or all the consecutive
+            widget updates, so that they can be sent together.
+            Returns an empty list if block is False and the queue is empty, None once closed.
+        """
+        with self._condition:
+            while not self._entries and not self.closed:
+                if not block:
+                    return []
+                self._condition.wait()
+            if self.closed:
+                return None
+            entries = [self._entries.popleft()]
+            if entries[0][0] is not None:
+                while self._entries and self._entries[0][0] is not None:
+                    entries.append(self._entries.popleft())
+                for identifier, _ in entries:
+                    self._ancestors.pop(identifier, None)
+            return entries
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._entries.clear()
+            self._ancestors.clear()
+            self._condition.notify_all()
+        if self.wakeup is not None:
+            self.wakeup()
+
+
 def get_method_by_name(root_node, name):
     val = None
     if hasattr(root_node, name):
@@ -99,7 +476,29 @@ def get_method_by_name(root_node, name):
 
 def get_method_by_id(_id):
     global runtimeInstances
-    return runtimeInstances.get(str(_id), None)
+    instance = get_runtime_registry().get(str(_id), None)
+    if instance is None:
+        instance = runtimeInstances.get(str(_id), None)
+    return instance
+
+
+def get_runtime_registry():
+    """ Returns the widget registry of the session running in the current thread,
+        or the global runtimeInstances outside of a session
+    """
+    registry = getattr(_runtime_context, 'registry', None)
+    return runtimeInstances if registry is None else registry
+
+
+@contextlib.contextmanager
+def runtime_registry(registry):
+    """ The widgets created within the context get registered in registry """
+    previous = getattr(_runtime_context, 'registry', None)
+    _runtime_context.registry = registry
+    try:
+        yield registry
+    finally:
+        _runtime_context.registry = previous
 
 
 def parse_session_cookie(cookie_to_cook):
@@ -121,17 +520,26 @@ def parse_session_cookie(cookie_to_cook):
 class WebSocketsHandler(socketserver.StreamRequestHandler):
 
     magic = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+    # set by the constructor, the handlers built around a bare socket have no server
+    server = None
 
     def __init__(self, headers, *args, **kwargs):
         self.headers = headers
         self.handshake_done = False
         self._log = logging.getLogger('remi.server.ws')
+        self._send_lock = threading.Lock()
+        self.protocol_version = 1
         socketserver.StreamRequestHandler.__init__(self, *args, **kwargs)
 
     def setup(self):
         socketserver.StreamRequestHandler.setup(self)
         self._log.info('connection established: %r' % (self.client_address,))
         self.handshake_done = False
+        self._decoder = WebSocketFrameDecoder()
+        self._recv_buffer = bytearray(65536)
+        self._recv_view = memoryview(self._recv_buffer)
+        self.send_queue = WebSocketSendQueue(getattr(self.server, 'websocket_send_queue_length', 1000),
+                                             getattr(self.server, 'websocket_send_queue_policy', 'drop_superseded'))
 
     def handle(self):
         global clients
@@ -142,7 +550,11 @@ class WebSocketsHandler(socketserver.StreamRequestHandler):
         if self.handshake():
             while True:
                 if not self.read_next_message():
-                    clients[self.session].websockets.discard(self)
+                    self.send_queue.close()
+                    client = clients.get(self.session)
+                    # the session could have been evicted meanwhile
+                    if client is not None:
+                        client.websockets.discard(self)
                     self.handshake_done = False
                     self._log.debug('ws ending websocket service')
                     break
@@ -156,60 +568,159 @@ class WebSocketsHandler(socketserver.StreamRequestHandler):
     def read_next_message(self):
         # noinspection PyBroadException
         try:
-            try:
-                length = self.rfile.read(2)
-            except ValueError:
-                # socket was closed, just return without errors
-                return False
-            length = self.bytetonum(length[1]) & 127
-            if length == 126:
-                length = struct.unpack('>H', self.rfile.read(2))[0]
-            elif length == 127:
-                length = struct.unpack('>Q', self.rfile.read(8))[0]
-            masks = [self.bytetonum(byte) for byte in self.rfile.read(4)]
-            decoded = ''
-            for char in self.rfile.read(length):
-                decoded += chr(self.bytetonum(char) ^ masks[len(decoded) % 4])
-            self.on_message(from_websocket(decoded))
+            message = self._decoder.next_message()
+            while message is None:
+                # the socket is read directly in a reusable buffer, the frames get decoded as a whole
+                received = self.request.recv_into(self._recv_buffer)
+                if received == 0:
+                    # socket was closed, just return without errors
+                    return False
+                self._decoder.feed(self._recv_view[:received])
+                message = self._decoder.next_message()
+            return self.process_message(*message)
         except socket.timeout:
             return False
         except Exception:
             return False
+
+    def process_message(self, opcode, payload):
+        """ Processes a complete message received from the client.
+            Returns False if the connection has to be closed.
+        """
+        if opcode == _WS_OPCODE_CLOSE:
+            # the close frame is the last one, the queued messages are not sent
+            self.send_queue.close()
+            self.send_frame(payload[:2], _WS_OPCODE_CLOSE)
+            return False
+        if opcode == _WS_OPCODE_PING:
+            self.send_frame(payload, _WS_OPCODE_PONG)
+            return True
+        if opcode == _WS_OPCODE_PONG:
+            return True
+        if not pyLessThan3:
+            payload = payload.decode('utf-8')
+        if self.protocol_version < 2 or not payload.startswith('{'):
+            payload = from_websocket(payload)
+        self.on_message(payload)
         return True
 
     def send_message(self, message):
+        """ Queues a message, it gets written by the connection writer """
         if not self.handshake_done:
             self._log.warning("ignoring message %s (handshake not done)" % message[:10])
             return
 
         self._log.debug('send_message: %s... -> %s' % (message[:10], self.client_address))
-        out = bytearray()
-        out.append(129)
-        length = len(message)
-        if length <= 125:
-            out.append(length)
-        elif 126 <= length <= 65535:
-            out.append(126)
-            out += struct.pack('>H', length)
+        if not self.send_queue.put_message(message, replaces_updates=message.startswith(_MSG_SHOW)):
+            self._send_queue_overflow()
+
+    def send_updates(self, updates, ancestors=None):
+        """ Queues the (identifier, html) widget updates of a gui update cycle,
+            ancestors maps the identifiers to the identifiers of their ancestor widgets
+        """
+        if not self.handshake_done:
+            return
+        if not self.send_queue.put_updates(updates, ancestors):
+            self._send_queue_overflow()
+
+    def _send_queue_overflow(self):
+        self._log.warning('websocket send queue full, disconnecting %r' % (self.client_address,))
+        metrics = getattr(self.server, 'metrics', None)
+        if metrics is not None:
+            metrics.inc('remi_websocket_send_queue_overflows_total')
+        self.send_queue.close()
+        self.abort()
+
+    def abort(self):
+        """ Drops the connection without waiting for the pending data to be sent """
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+
+    def start_writer(self):
+        writer = threading.Thread(target=self._writer_loop)
+        writer.daemon = True
+        writer.start()
+
+    def _writer_loop(self):
+        """ Writes the queued messages until the queue gets closed """
+        # noinspection PyBroadException
+        try:
+            while True:
+                entries = self.send_queue.get()
+                if entries is None:
+                    break
+                self.write_entries(entries)
+        except Exception:
+            self._log.debug('error writing to websocket %r' % (self.client_address,), exc_info=True)
+            self.send_queue.close()
+            self.abort()
+
+    def write_entries(self, entries):
+        """ Writes the entries returned by the send queue.
+            The websockets using protocol v2 get all the widget updates in a single message,
+            the legacy ones a message for each widget.
+        """
+        identifier, text = entries[0]
+        if identifier is None:
+            self.send_frame(encode_text(text))
+        elif self.protocol_version >= 2 and len(entries) > 1:
+            self.send_frame(encode_text(_MSG_UPDATE_BATCH + json.dumps(entries, ensure_ascii=False,
+                                                                       separators=(',', ':'))))
         else:
-            out.append(127)
-            out += struct.pack('>Q', length)
-        if not pyLessThan3:
-            message = message.encode('utf-8')
-        out = out + message
-        self.request.send(out)
+            for identifier, html in entries:
+                self.send_frame(encode_text(_MSG_UPDATE + identifier + ',' + self.encode_content(html)))
+
+    def send_frame(self, payload, opcode=_WS_OPCODE_TEXT):
+        # The frames can be sent by multiple threads (gui updates, acks), so the
+        # write is serialized in order to not interleave partially sent frames.
+        # Compression happens under the same lock, the deflate context must follow the wire order
+        with self._send_lock:
+            rsv = 0
+            deflate = self._decoder.deflate
+            if deflate is not None and opcode < _WS_OPCODE_CLOSE and len(payload) >= deflate.threshold:
+                payload = deflate.compress(payload)
+                rsv = _WS_RSV1
+            self.write_frame(websocket_frame_header(len(payload), opcode, rsv), payload)
+        metrics = getattr(self.server, 'metrics', None)
+        if metrics is not None and opcode < _WS_OPCODE_CLOSE:
+            metrics.inc('remi_websocket_messages_sent_total')
+            metrics.inc('remi_websocket_bytes_sent_total', len(payload))
+
+    def write_frame(self, header, payload):
+        """ Writes header and payload without joining them in a new buffer """
+        sock = self.request
+        if len(payload) < _WS_COALESCE_SIZE:
+            # for small payloads a copy is cheaper than a further syscall
+            sock.sendall(header + payload)
+        elif hasattr(sock, 'sendmsg') and not isinstance(sock, ssl.SSLSocket):
+            # scatter-gather write, looping on short writes
+            buffers = [memoryview(header), memoryview(payload)]
+            while buffers:
+                sent = sock.sendmsg(buffers)
+                while buffers and sent >= len(buffers[0]):
+                    sent -= len(buffers[0])
+                    buffers.pop(0)
+                if buffers:
+                    buffers[0] = buffers[0][sent:]
+        else:
+            sock.sendall(header)
+            sock.sendall(payload)
 
-    def handshake(self):
-        self._log.debug('handshake')
+    def handshake_response(self):
+        """ Validates the upgrade request against the known sessions
+            and returns the handshake response, or None if the session is unknown
+        """
         key = self.headers['Sec-WebSocket-Key']
         self.session = None
         if 'cookie' in self.headers:
             if self.headers['cookie']!=None:
                 self.session = parse_session_cookie(self.headers['cookie'])
         if self.session == None:
-            return False
+            return None
         if not self.session in clients.keys():
-            return False
+            return None
 
         digest = hashlib.sha1((key.encode("utf-8")+self.magic))
         digest = digest.digest()
@@ -217,10 +728,29 @@ class WebSocketsHandler(socketserver.StreamRequestHandler):
         response = 'HTTP/1.1 101 Switching Protocols\r\n'
         response += 'Upgrade: websocket\r\n'
         response += 'Connection: Upgrade\r\n'
-        response += 'Sec-WebSocket-Accept: %s\r\n\r\n' % digest.decode("utf-8")
+        response += 'Sec-WebSocket-Accept: %s\r\n' % digest.decode("utf-8")
+        requested_protocols = [p.strip() for p in (self.headers.get('Sec-WebSocket-Protocol') or '').split(',')]
+        self.protocol_version = 1
+        if _WS_SUBPROTOCOL_V2 in requested_protocols:
+            self.protocol_version = 2
+            response += 'Sec-WebSocket-Protocol: %s\r\n' % _WS_SUBPROTOCOL_V2
+        deflate, extension_response = WebSocketDeflate.negotiate(self.headers.get('Sec-WebSocket-Extensions'),
+                                                                 getattr(self.server, 'websocket_compression', None))
+        self._decoder.deflate = deflate
+        if deflate is not None:
+            response += 'Sec-WebSocket-Extensions: %s\r\n' % extension_response
+        response += '\r\n'
+        return response.encode("utf-8")
+
+    def handshake(self):
+        self._log.debug('handshake')
+        response = self.handshake_response()
+        if response is None:
+            return False
         self._log.info('handshake complete')
-        self.request.sendall(response.encode("utf-8"))
+        self.request.sendall(response)
         self.handshake_done = True
+        self.start_writer()
 
         #if an update happens since the websocket connection to its handshake, 
         # it gets not displayed. it is required to inform App about handshake done, 
@@ -230,40 +760,72 @@ class WebSocketsHandler(socketserver.StreamRequestHandler):
         return True
 
     def on_message(self, message):
-        global runtimeInstances
+        # noinspection PyBroadException
+        try:
+            self.dispatch_message(message)
+        except Exception:
+            self._log.error('error parsing websocket', exc_info=True)
 
+    def dispatch_message(self, message, strict=False):
+        """ Calls the widget event of a callback message, as decoded by process_message.
+            Returns the value returned by the event, None if the session got evicted.
+            The other messages (i.e. 'connected' sent by the client) and the events the widget does not
+            have are ignored, unless strict: then they raise ValueError and AttributeError.
+        """
         self.send_message(_MSG_ACK)
 
-        with clients[self.session].update_lock:
-            # noinspection PyBroadException
-            try:
-                # saving the websocket in order to update the client
-                if self not in clients[self.session].websockets:
-                    clients[self.session].websockets.add(self)
-
-                # parsing messages
-                chunks = message.split('/')
-                self._log.debug('on_message: %s' % chunks[0])
-
-                if len(chunks) > 3:  # msgtype,widget,function,params
-                    # if this is a callback
-                    msg_type = 'callback'
-                    if chunks[0] == msg_type:
-                        widget_id = chunks[1]
-                        function_name = chunks[2]
-                        params = message[
-                            len(msg_type) + len(widget_id) + len(function_name) + 3:]
-
-                        param_dict = parse_parametrs(params)
-
-                        callback = get_method_by_name(runtimeInstances[widget_id], function_name)
-                        if callback is not None:
-                            callback(**param_dict)
-
-            except Exception:
-                self._log.error('error parsing websocket', exc_info=True)
+        metrics = getattr(self.server, 'metrics', None)
+        if metrics is not None:
+            metrics.inc('remi_websocket_messages_received_total')
+        profiler = getattr(self.server, 'profiler', None)
+        client = clients.get(self.session)
+        if client is None:
+            # the session got evicted
+            return None
+        client.last_activity = time.time()
+        update_lock = client.update_lock if metrics is None else metrics.timed_lock(client.update_lock)
+        with update_lock, runtime_registry(client.runtime_instances):
+            # saving the websocket in order to update the client
+            if self not in client.websockets:
+                client.websockets.add(self)
+
+            # parsing messages
+            self._log.debug('on_message: %s' % message[:20])
+            callback_request = parse_callback_message(message)
+            if callback_request is None:
+                if strict:
+                    raise ValueError('not a callback message: %r' % message[:40])
+                return None
+            widget_id, function_name, param_dict = callback_request
+            widget = client.get_widget(widget_id)
+            callback = get_method_by_name(widget, function_name)
+            if callback is None:
+                if strict:
+                    raise AttributeError('%s has no event %s' % (type(widget).__name__, function_name))
+                return None
+            if metrics is None and profiler is None:
+                return callback(**param_dict)
+            return self._dispatch_measured(widget, function_name, callback, param_dict, metrics, profiler)
+
+    def _dispatch_measured(self, widget, function_name, callback, param_dict, metrics, profiler):
+        start = Metrics.clock()
+        if profiler is None:
+            result = callback(**param_dict)
+        else:
+            result = profiler.call((type(widget).__name__, function_name, listener_name(callback)), callback,
+                                   **param_dict)
+        if metrics is not None:
+            metrics.observe('remi_callback_seconds', Metrics.clock() - start, (('event', function_name),))
+        return result
+
+    def encode_content(self, content):
+        """ Encodes the content of a show/update message for the negotiated protocol """
+        if self.protocol_version >= 2:
+            return content
+        return to_websocket(content)
 
     def close(self, terminate_server=True):
+        self.send_queue.close()
         try:
             self.request.shutdown(socket.SHUT_WR)
             self.finish()
@@ -276,23 +838,534 @@ class WebSocketsHandler(socketserver.StreamRequestHandler):
 def parse_parametrs(p):
     """
     Parses the parameters given from POST or websocket reqs
-    expecting the parameters as:  "11|par1='asd'|6|par2=1"
+    expecting the parameters as:  "10|par1='asd'|6|par2=1"
     returns a dict like {par1:'asd',par2:1}
+    The field lengths are expressed in utf-8 bytes.
     """
     ret = {}
-    while len(p) > 1 and p.count('|') > 0:
-        s = p.split('|')
-        l = int(s[0])  # length of param field
+    # Python 2 websocket messages are byte strings, their fields stay byte strings
+    is_text = not isinstance(p, bytes)
+    data = p.encode('utf-8') if is_text else p
+    pos = 0
+    while pos < len(data):
+        sep = data.find(b'|', pos)
+        if sep < 0:
+            break
+        l = int(data[pos:sep])  # length of param field
+        field = data[sep + 1:sep + 1 + l]
+        pos = sep + 1 + l + 1
         if l > 0:
-            p = p[len(s[0]) + 1:]
-            field_name = p.split('|')[0].split('=')[0]
-            field_value = p[len(field_name) + 1:l]
-            p = p[l + 1:]
+            field_name, _, field_value = field.partition(b'=')
+            if is_text:
+                field_name = field_name.decode('utf-8')
+                field_value = field_value.decode('utf-8')
             ret[field_name] = field_value
     return ret
 
 
+def to_js_string(value):
+    """ Converts a json parameter value to the string the legacy protocol would have sent,
+        so that the listeners keep receiving the same values regardless of the protocol.
+    """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if value is None:
+        return 'null'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, type(u'')):
+        return value
+    return str(value)
+
+
+def parse_callback_message(message):
+    """
+    Parses a callback message received from the client, returns a tuple
+    (widget_id, function_name, param_dict) or None if the message is not a callback.
+    Accepts both the json (protocol version 2) and the legacy format:
+        {"id": widget_id, "fn": function_name, "params": {...}}
+        callback/widget_id/function_name/params
+    """
+    if message.startswith('{'):
+        data = json.loads(message)
+        params = data.get('params') or {}
+        return data['id'], data['fn'], dict((k, to_js_string(v)) for k, v in params.items())
+
+    chunks = message.split('/')
+    msg_type = 'callback'
+    if len(chunks) > 3 and chunks[0] == msg_type:  # msgtype,widget,function,params
+        widget_id = chunks[1]
+        function_name = chunks[2]
+        params = message[len(msg_type) + len(widget_id) + len(function_name) + 3:]
+        return widget_id, function_name, parse_parametrs(params)
+    return None
+
+
 # noinspection PyPep8Naming
+class MultipartParser(object):
+    """ Incremental multipart/form-data parser.
+        The request body is read in chunks of bounded size. The content of the file parts
+        is written to the binary file objects returned by open_file(name, filename),
+        the other fields are kept in memory, up to max_field_size bytes.
+        parse() yields (name, filename, value) as soon as each part is complete: value is
+        the file object, already closed, for the file parts and bytes for the other fields.
+    """
+
+    chunk_size = 65536
+    max_header_size = 16384
+    max_field_size = 1024 * 1024
+
+    re_boundary = re.compile(r'boundary="?([^";,]+)"?')
+    re_disposition_param = re.compile(r';\s*(\w+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;\s]*))')
+
+    def __init__(self, rfile, content_type, content_length, open_file):
+        match = self.re_boundary.search(content_type or '')
+        if match is None:
+            raise ValueError('multipart boundary missing')
+        self._delimiter = b'\r\n--' + match.group(1).encode('latin-1')
+        self._rfile = rfile
+        # None if unknown, the body gets read until the end of the stream
+        self._remaining = content_length
+        self._open_file = open_file
+        # the first delimiter is not preceded by a line break
+        self._buffer = bytearray(b'\r\n')
+
+    def _read(self):
+        """ Appends the next chunk of the body to the buffer, returns False at the end of the body """
+        size = self.chunk_size
+        if self._remaining is not None:
+            if self._remaining <= 0:
+                return False
+            size = min(size, self._remaining)
+        data = self._rfile.read(size)
+        if not data:
+            return False
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        self._buffer += data
+        return True
+
+    def _read_until(self, separator, max_size):
+        while True:
+            index = self._buffer.find(separator)
+            if index >= 0:
+                data = bytes(self._buffer[:index])
+                del self._buffer[:index + len(separator)]
+                return data
+            if len(self._buffer) > max_size or not self._read():
+                raise ValueError('malformed multipart body')
+
+    def _copy_until_delimiter(self, write):
+        """ Passes the data preceding the next delimiter to write, and consumes the delimiter """
+        delimiter = self._delimiter
+        # the tail of the buffer could be the beginning of a delimiter
+        keep = len(delimiter) - 1
+        while True:
+            index = self._buffer.find(delimiter)
+            if index >= 0:
+                if index:
+                    write(self._buffer[:index])
+                del self._buffer[:index + len(delimiter)]
+                return
+            if len(self._buffer) > keep:
+                write(self._buffer[:-keep])
+                del self._buffer[:-keep]
+            if not self._read():
+                raise ValueError('multipart body truncated')
+
+    def _parse_part_headers(self, headers):
+        name = filename = None
+        for line in headers.decode('utf-8', 'replace').split('\r\n'):
+            if not line.lower().startswith('content-disposition:'):
+                continue
+            for match in self.re_disposition_param.finditer(line):
+                key = match.group(1).lower()
+                value = match.group(2) if match.group(2) is not None else match.group(3)
+                if key == 'name':
+                    name = value
+                elif key == 'filename':
+                    filename = value
+        return name, filename
+
+    def parse(self):
+        # the preamble is ignored
+        self._copy_until_delimiter(lambda data: None)
+        while True:
+            while len(self._buffer) < 2:
+                if not self._read():
+                    raise ValueError('multipart body truncated')
+            if self._buffer[:2] == b'--':
+                # closing delimiter, the epilogue is discarded
+                while self._read():
+                    del self._buffer[:]
+                return
+            name, filename = self._parse_part_headers(self._read_until(b'\r\n\r\n', self.max_header_size))
+            if filename is not None:
+                f = self._open_file(name, filename)
+                try:
+                    self._copy_until_delimiter(f.write)
+                except BaseException:
+                    # truncated or malformed body, or the client went away: the partial file is removed
+                    discard_file(f)
+                    raise
+                f.close()
+                yield name, filename, f
+                continue
+            chunks = []
+            def append(data):
+                if sum(len(chunk) for chunk in chunks) + len(data) > self.max_field_size:
+                    raise ValueError('multipart field %s too big' % name)
+                chunks.append(bytes(data))
+            self._copy_until_delimiter(append)
+            yield name, None, b''.join(chunks)
+
+
+def discard_file(f):
+    """ Closes the file object f and removes its file, if any """
+    # noinspection PyBroadException
+    try:
+        f.close()
+    except Exception:
+        pass
+    path = getattr(f, 'name', None)
+    if isinstance(path, (str, type(u''))) and os.path.exists(path):
+        # noinspection PyBroadException
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
+
+class ChunkedUpload(object):
+    """ A file uploaded in slices, sent in parallel and possibly across reconnections.
+        The slices are written at their offset in the file returned by open_file, which has to be
+        seekable, and the received byte ranges are tracked so that the client can resume the upload.
+        The uploads are identified by the session, the listener widget and an id chosen by the client,
+        a session cannot query or resume the uploads of the others; uploads inactive for
+        expire_time seconds get discarded. The completed uploads are kept for finished_expire_time
+        seconds, the slices sent again by the client after the completion are not written.
+    """
+
+    expire_time = 3600
+    finished_expire_time = 300
+    max_chunk_size = 64 * 1024 * 1024
+
+    _uploads = {}
+    _uploads_lock = threading.Lock()
+
+    def __init__(self, key, size, f):
+        self.key = key
+        self.size = size
+        self.file = f
+        # sorted list of the received [first, end) byte ranges, not overlapping
+        self.ranges = []
+        self.completed = False
+        self.last_activity = time.time()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, key, size, open_file=None):
+        """ Returns the upload identified by key, creating it with open_file() if unknown.
+            Returns None for an unknown upload if open_file is None.
+        """
+        with cls._uploads_lock:
+            now = time.time()
+            for expired in [upload for upload in cls._uploads.values() if now - upload.last_activity > (
+                    cls.finished_expire_time if upload.completed else cls.expire_time)]:
+                del cls._uploads[expired.key]
+                if not expired.completed:
+                    expired.discard()
+            upload = cls._uploads.get(key)
+            if upload is not None and upload.size != size:
+                # the client is uploading a different file with the same id
+                del cls._uploads[key]
+                if not upload.completed:
+                    upload.discard()
+                upload = None
+            if upload is None:
+                if open_file is None:
+                    return None
+                upload = cls(key, size, open_file())
+                cls._uploads[key] = upload
+            upload.last_activity = now
+            return upload
+
+    def write(self, offset, rfile, length):
+        """ Copies length bytes from rfile to the file at offset, in blocks of bounded size.
+            Raises IOError if rfile ends before, the bytes received are kept
+        """
+        if offset < 0 or length > self.max_chunk_size or offset + length > self.size:
+            raise ValueError('upload slice %d+%d out of the file size %d' % (offset, length, self.size))
+        position = offset
+        while position < offset + length:
+            data = rfile.read(min(65536, offset + length - position))
+            if not data:
+                break
+            with self._lock:
+                self.file.seek(position)
+                self.file.write(data)
+            position += len(data)
+            self.last_activity = time.time()
+        with self._lock:
+            self._add_range(offset, position)
+        if position < offset + length:
+            raise IOError('upload slice truncated at %d of %d+%d' % (position, offset, length))
+
+    def _add_range(self, first, end):
+        if first >= end:
+            return
+        merged = []
+        for range_first, range_end in self.ranges:
+            if range_end < first or range_first > end:
+                merged.append([range_first, range_end])
+            else:
+                first, end = min(first, range_first), max(end, range_end)
+        merged.append([first, end])
+        self.ranges = sorted(merged)
+
+    def received(self):
+        with self._lock:
+            return sum(end - first for first, end in self.ranges)
+
+    def status(self):
+        with self._lock:
+            return {'received': [list(r) for r in self.ranges], 'complete': self.completed}
+
+    def finish(self):
+        """ Returns True, just once, when all the file has been received: the file gets
+            closed and the caller hands it over to the listener
+        """
+        with self._lock:
+            if self.completed or sum(end - first for first, end in self.ranges) != self.size:
+                return False
+            self.completed = True
+            self.last_activity = time.time()
+            self.file.close()
+        return True
+
+    def discard(self):
+        self.completed = True
+        discard_file(self.file)
+
+    def abort(self):
+        """ Discards the file and forgets the upload, the client can send it again """
+        with self._uploads_lock:
+            if self._uploads.get(self.key) is self:
+                del self._uploads[self.key]
+        self.discard()
+
+
+def parse_range_header(header, size):
+    """ Parses a Range request header for a content of size bytes.
+        Returns the list of the requested (first, last) byte positions, both inclusive,
+        an empty list if none of the ranges is satisfiable, or None if the whole
+        content has to be sent (no header, unsupported unit, malformed or too many ranges).
+
+            parse_range_header('bytes=0-99,-100', 1000) -> [(0, 99), (900, 999)]
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    specs = header[len('bytes='):].split(',')
+    if len(specs) > 16:
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if not first:
+                # suffix range, the last bytes of the content
+                length = int(last)
+                if length > 0 and size > 0:
+                    ranges.append((max(0, size - length), size - 1))
+                continue
+            first = int(first)
+            last = int(last) if last else None
+        except ValueError:
+            return None
+        if last is None:
+            last = size - 1
+        elif first > last:
+            return None
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+    return ranges
+
+
+class StaticFile(object):
+    """ A static file as served by the App: its metadata, the content if it is small
+        enough to be kept in memory and, for the text formats, the gzip compressed content.
+    """
+
+    compressible_types = ('application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+    min_compress_size = 256
+
+    def __init__(self, filename, stat, content=None):
+        self.filename = filename
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        # the etag changes with the file modification time and size
+        self.etag = '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)
+        self.gzip_etag = self.etag[:-1] + '-gz"'
+        mimetype, _ = mimetypes.guess_type(filename)
+        self.mimetype = mimetype if mimetype else 'application/octet-stream'
+        self.content = content
+        self.gzip_content = None
+        if content is not None and self.size >= self.min_compress_size and \
+                (self.mimetype.startswith('text/') or self.mimetype in self.compressible_types):
+            compressed = gzip_encode(content)
+            if len(compressed) < self.size:
+                self.gzip_content = compressed
+
+    def memory_size(self):
+        return len(self.content or b'') + len(self.gzip_content or b'')
+
+    def is_current(self, stat):
+        return self.mtime == stat.st_mtime and self.size == stat.st_size
+
+
+class StaticFileCache(object):
+    """ In-memory LRU cache of the static files, limited to max_size bytes.
+        The files get reloaded when their modification time or size changes.
+        Files bigger than max_file_size are not loaded in memory, their StaticFile
+        has no content and gets served from disk.
+    """
+
+    def __init__(self, max_size=32 * 1024 * 1024, max_file_size=1024 * 1024):
+        self.max_size = max_size
+        self.max_file_size = min(max_file_size, max_size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._files = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """ Returns the StaticFile for filename, raises IOError/OSError if the file is not available """
+        stat = os.stat(filename)
+        with self._lock:
+            static_file = self._files.pop(filename, None)
+            if static_file is not None:
+                if static_file.is_current(stat):
+                    # most recently used files are the last ones
+                    self._files[filename] = static_file
+                    self.hits += 1
+                    return static_file
+                self.size -= static_file.memory_size()
+            self.misses += 1
+        content = None
+        if stat.st_size <= self.max_file_size:
+            with open(filename, 'rb') as f:
+                content = f.read()
+        static_file = StaticFile(filename, stat, content)
+        if content is None:
+            return static_file
+        with self._lock:
+            previous = self._files.pop(filename, None)
+            if previous is not None:
+                self.size -= previous.memory_size()
+            self._files[filename] = static_file
+            self.size += static_file.memory_size()
+            while self.size > self.max_size:
+                _, evicted = self._files.popitem(last=False)
+                self.size -= evicted.memory_size()
+        return static_file
+
+
+class SessionReaper(object):
+    """ Evicts the sessions of the clients registry in multiple_instance mode.
+        A session without websockets is evicted once idle for session_timeout seconds,
+        the least recently active sessions are evicted beyond max_sessions and beyond
+        max_memory bytes (as estimated by App.memory_usage). Evicted sessions get
+        their App.on_close called, stopping their update loop.
+        The memory usage walks the widget trees of all the sessions, it gets measured
+        only by the reaper thread, not when a new session gets added.
+    """
+
+    def __init__(self, session_timeout=None, max_sessions=None, max_memory=None, interval=5):
+        self.session_timeout = session_timeout
+        self.max_sessions = max_sessions
+        self.max_memory = max_memory
+        self.interval = interval if session_timeout is None else min(interval, session_timeout)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._log = logging.getLogger('remi.server.sessions')
+
+    def enabled(self):
+        return not (self.session_timeout is None and self.max_sessions is None and self.max_memory is None)
+
+    def start(self):
+        if not self.enabled() or self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._reaper_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread = None
+
+    def _reaper_loop(self):
+        while not self._stop_event.wait(self.interval):
+            # noinspection PyBroadException
+            try:
+                self.reap()
+            except Exception:
+                self._log.error('error evicting sessions', exc_info=True)
+
+    def select(self, sessions, now, keep=None, check_memory=True):
+        """ Returns the session ids to evict, given a list of (session, app)
+            sorted from the least recently active. The session keep is never evicted.
+            check_memory: False to skip the max_memory limit
+        """
+        evicted = []
+        remaining = []
+        for session, app in sessions:
+            if session != keep and self.session_timeout is not None and not app.websockets and \
+                    now - app.last_activity > self.session_timeout:
+                evicted.append(session)
+            else:
+                remaining.append((session, app))
+        candidates = [item for item in remaining if item[0] != keep]
+        if self.max_sessions is not None:
+            while len(remaining) > self.max_sessions and candidates:
+                item = candidates.pop(0)
+                remaining.remove(item)
+                evicted.append(item[0])
+        if self.max_memory is not None and check_memory:
+            usage = {}
+            for session, app in remaining:
+                # the widget tree must not change while being measured
+                with app.update_lock:
+                    usage[session] = app.memory_usage()
+            total = sum(usage.values())
+            while total > self.max_memory and candidates:
+                item = candidates.pop(0)
+                remaining.remove(item)
+                evicted.append(item[0])
+                total -= usage[item[0]]
+        return evicted
+
+    def reap(self, keep=None, check_memory=True):
+        """ Evicts the expired sessions and the ones exceeding the limits """
+        sessions = sorted(list(clients.items()), key=lambda item: getattr(item[1], 'last_activity', 0))
+        evicted = []
+        for session in self.select(sessions, time.time(), keep, check_memory):
+            app = clients.pop(session, None)
+            if app is not None:
+                evicted.append((session, app))
+        for session, app in evicted:
+            self._log.info('session %s evicted' % session)
+            # noinspection PyBroadException
+            try:
+                app.on_close()
+            except Exception:
+                self._log.error('error closing session %s' % session, exc_info=True)
+        return [session for session, _ in evicted]
+
+
 class App(BaseHTTPRequestHandler, object):
 
     """
@@ -306,12 +1379,30 @@ class App(BaseHTTPRequestHandler, object):
     re_static_file = re.compile(r"^([\/]*[\w\d]+:[-_. $@?#£'%=()\/\[\]!+°§^,\w\d]+)") #https://regex101.com/r/uK1sX1/6
     re_attr_call = re.compile(r"^/*(\w+)\/(\w+)\?{0,1}(\w*\={1}(\w|\.)+\&{0,1})*$")
 
+    # persistent connections: every response has a Content-Length or is chunked
+    protocol_version = 'HTTP/1.1'
+
+    # if True, main() builds the widget tree of the first session only, the new sessions
+    # get restored from its snapshot (see remi.snapshot). The sessions are built by main()
+    # if the snapshot fails, i.e. if main() sets App attributes that cannot be stored or starts threads
+    restore_new_sessions = False
+
     def __init__(self, request, client_address, server, **app_args):
         self._app_args = app_args
         self.root = None
         self._log = logging.getLogger('remi.request')
         super(App, self).__init__(request, client_address, server)
 
+    def setup(self):
+        # idle keep-alive connections get closed after the timeout
+        self.timeout = getattr(self.server, 'keep_alive_timeout', None)
+        super(App, self).setup()
+
+    def send_response(self, code, message=None):
+        super(App, self).send_response(code, message)
+        if getattr(self, '_session_created', False):
+            self.send_header('Connection', 'close')
+
     def _get_list_from_app_args(self, name):
         try:
             v = self._app_args[name]
@@ -325,7 +1416,6 @@ class App(BaseHTTPRequestHandler, object):
 
     def _instance(self):
         global clients
-        global runtimeInstances
         """
         This method is used to get the Application instance previously created
         managing on this, it is possible to switch to "single instance for
@@ -345,31 +1435,41 @@ class App(BaseHTTPRequestHandler, object):
         #if no session id
         if self.session == 0:
             if self.server.multiple_instance:
-                self.session = int(time.time()*1000)
+                self.session = new_session_id(getattr(self.server, 'session_affinity', None))
             #send session to browser
             del self.headers['cookie']
 
+        # the handler creating a session becomes its App, the connection gets closed after the response
+        # since the next requests of a keep-alive connection reuse the handler. In prefork mode this lets
+        # the front process route the next connection by the new session cookie, too
+        self._session_created = not self.session in clients
+
         #if the client instance doesn't exist
         if not(self.session in clients):
             self.update_interval = self.server.update_interval
 
             from remi import gui
-            
-            head = gui.HEAD(self.server.title)
-            # use the default css, but append a version based on its hash, to stop browser caching
-            head.add_child('internal_css', "<link href='/res:style.css' rel='stylesheet' />\n")
-
-            body = gui.BODY()
-            body.add_class('remi-main')
-            body.onload.connect(self.onload)
-            body.ononline.connect(self.ononline)
-            body.onpagehide.connect(self.onpagehide)
-            body.onpageshow.connect(self.onpageshow)
-            body.onresize.connect(self.onresize)
-
-            self.page = gui.HTML()
-            self.page.add_child('head', head)
-            self.page.add_child('body', body)
+
+            # the widgets of the session are looked up in its own registry
+            self.runtime_instances = weakref.WeakValueDictionary()
+            self.runtime_instances[str(id(self))] = self
+
+            with runtime_registry(self.runtime_instances):
+                head = gui.HEAD(self.server.title)
+                # use the default css, but append a version based on its hash, to stop browser caching
+                head.add_child('internal_css', "<link href='/res:style.css' rel='stylesheet' />\n")
+
+                body = gui.BODY()
+                body.add_class('remi-main')
+                body.onload.connect(self.onload)
+                body.ononline.connect(self.ononline)
+                body.onpagehide.connect(self.onpagehide)
+                body.onpageshow.connect(self.onpageshow)
+                body.onresize.connect(self.onresize)
+
+                self.page = gui.HTML()
+                self.page.add_child('head', head)
+                self.page.add_child('body', body)
 
             if not hasattr(self, 'websockets'):
                 self.websockets = set()
@@ -380,18 +1480,30 @@ class App(BaseHTTPRequestHandler, object):
                 self._need_update_flag = False
                 self._stop_update_flag = False
                 if self.update_interval > 0:
-                    self._update_thread = threading.Thread(target=self._idle_loop)
-                    self._update_thread.setDaemon(True)
-                    self._update_thread.start()
-
-            runtimeInstances[str(id(self))] = self
+                    if hasattr(self.server, 'start_idle_loop'):
+                        # the server engine schedules the idle loop by itself (i.e. asyncio)
+                        self.server.start_idle_loop(self)
+                    else:
+                        self._update_thread = threading.Thread(target=self._idle_loop)
+                        self._update_thread.setDaemon(True)
+                        self._update_thread.start()
+
+            self.last_activity = time.time()
             clients[self.session] = self
+
+            session_reaper = getattr(self.server, 'session_reaper', None)
+            if session_reaper is not None and session_reaper.enabled():
+                # the limits are enforced as soon as a session gets added,
+                # but the memory one that is left to the reaper thread
+                session_reaper.reap(keep=self.session, check_memory=False)
         else:
             #restore instance attributes
             client = clients[self.session]
+            client.last_activity = time.time()
 
             self.websockets = client.websockets
             self.page = client.page
+            self.runtime_instances = client.runtime_instances
 
             self.update_lock = client.update_lock
 
@@ -405,6 +1517,47 @@ class App(BaseHTTPRequestHandler, object):
         pending_messages_queue_length = str(self.server.pending_messages_queue_length)
         self.page.children['head'].set_internal_js(str(id(self)), net_interface_ip, pending_messages_queue_length, websocket_timeout_timer_ms)
 
+    def _build_root_widget(self):
+        # App class -> snapshot of its first session, None if its sessions cannot be restored
+        session_snapshots = getattr(self.server, 'session_snapshots', None)
+        if not self.restore_new_sessions or session_snapshots is None:
+            self._run_main()
+            return
+        from remi import snapshot
+        app_class = type(self)
+        if app_class in session_snapshots:
+            if session_snapshots[app_class] is None:
+                self._run_main()
+            else:
+                snapshot.loads(self, session_snapshots[app_class])
+            return
+        threads = set(threading.enumerate())
+        self._run_main()
+        try:
+            if [thread for thread in threading.enumerate() if thread not in threads]:
+                raise ValueError('main() started threads, they would not run for the restored sessions')
+            session_snapshots[app_class] = snapshot.dumps(self)
+        except ValueError:
+            self._log.warning('the sessions cannot be restored from a snapshot', exc_info=True)
+            session_snapshots[app_class] = None
+
+    def _run_main(self):
+        fields = set(self.__dict__)
+        root = self.main(*self.server.userdata)
+        # the App attributes set by main() are stored in the session snapshots
+        self._main_fields = [name for name in self.__dict__ if name not in fields]
+        self.set_root_widget(root)
+
+    def get_widget(self, identifier):
+        """ Returns the widget of the session with the given identifier,
+            looking in the global runtimeInstances for the ones created outside of the session.
+            Raises KeyError if there is no such widget.
+        """
+        widget = self.runtime_instances.get(str(identifier))
+        if widget is None:
+            widget = runtimeInstances[str(identifier)]
+        return widget
+
     def main(self, *_):
         """ Subclasses of App class *must* declare a main function
             that will be the entry point of the application.
@@ -417,17 +1570,32 @@ class App(BaseHTTPRequestHandler, object):
         """
         while not self._stop_update_flag:
             time.sleep(self.update_interval)
-            with self.update_lock:
-                try:
+            self._idle_step()
+
+    def _idle_step(self):
+        """ Executes a single idle cycle, calling App.idle and the gui update if required
+        """
+        metrics = getattr(self.server, 'metrics', None)
+        update_lock = self.update_lock if metrics is None else metrics.timed_lock(self.update_lock)
+        profiler = getattr(self.server, 'profiler', None)
+        with update_lock, runtime_registry(self.runtime_instances):
+            try:
+                if profiler is None:
                     self.idle()
-                except Exception:
-                    self._log.error("exception in App.idle method", exc_info=True)
-                if self._need_update_flag:
-                    try:
+                else:
+                    profiler.call((type(self).__name__, 'idle', listener_name(self.idle)), self.idle)
+            except Exception:
+                self._log.error("exception in App.idle method", exc_info=True)
+            if self._need_update_flag:
+                try:
+                    if profiler is None:
                         self.do_gui_update()
-                    except Exception:
-                        self._log.error('''exception during gui update. It is advisable to 
-                            use App.update_lock using external threads.''', exc_info=True)
+                    else:
+                        profiler.call((type(self).__name__, 'do_gui_update', listener_name(self.do_gui_update)),
+                                      self.do_gui_update)
+                except Exception:
+                    self._log.error('''exception during gui update. It is advisable to 
+                        use App.update_lock using external threads.''', exc_info=True)
 
     def idle(self):
         """ Idle function called every UPDATE_INTERVAL before the gui update.
@@ -445,18 +1613,64 @@ class App(BaseHTTPRequestHandler, object):
     def do_gui_update(self):
         """ This method gets called also by Timer, a new thread, and so needs to lock the update
         """
+        metrics = getattr(self.server, 'metrics', None)
+        if metrics is not None:
+            self._do_gui_update_measured(metrics)
+            return
+        with self.update_lock:
+            changed_widget_dict = {}
+            self.root.repr(changed_widget_dict)
+            if changed_widget_dict:
+                self._send_widget_updates(changed_widget_dict)
+        self._need_update_flag = False
+
+    def _do_gui_update_measured(self, metrics):
         with self.update_lock:
+            start = metrics.clock()
             changed_widget_dict = {}
             self.root.repr(changed_widget_dict)
-            for widget in changed_widget_dict.keys():
-                html = changed_widget_dict[widget]
-                __id = str(widget.identifier)
-                self._send_spontaneous_websocket_message(_MSG_UPDATE + __id + ',' + to_websocket(html))
+            metrics.observe('remi_repr_seconds', metrics.clock() - start)
+            if changed_widget_dict:
+                self._send_widget_updates(changed_widget_dict)
+                metrics.observe('remi_gui_update_bytes', sum(len(html) for html in changed_widget_dict.values()),
+                                buckets=SIZE_BUCKETS)
+            metrics.observe('remi_gui_update_seconds', metrics.clock() - start)
         self._need_update_flag = False
 
+    def _send_widget_updates(self, changed_widget_dict):
+        """ Queues the updates of a gui update cycle, the websocket writers
+            encode them for the negotiated protocol.
+        """
+        updates = []
+        ancestors = {}
+        for widget, html in changed_widget_dict.items():
+            identifier = str(widget.identifier)
+            updates.append((identifier, html))
+            ancestors[identifier] = self._widget_ancestors(widget)
+        for ws in list(self.websockets):
+            # noinspection PyBroadException
+            try:
+                ws.send_updates(updates, ancestors)
+            except Exception:
+                self._log.error("sending websocket updates", exc_info=True)
+                self.websockets.discard(ws)
+                ws.close(terminate_server=False)
+
+    def _widget_ancestors(self, widget):
+        """ Returns the identifiers of the widgets containing widget, used to drop
+            the queued updates of a widget when one of its ancestors gets updated
+        """
+        ancestors = set()
+        parent = widget.get_parent()
+        while parent is not None and parent is not self:
+            ancestors.add(str(parent.identifier))
+            parent = parent.get_parent()
+        return ancestors
+
     def websocket_handshake_done(self, ws_instance_to_update):
         with self.update_lock:
-            msg = "0" + self.root.identifier + ',' + to_websocket(self.page.children['body'].innerHTML({}))
+            msg = _MSG_SHOW + self.root.identifier + ',' + \
+                ws_instance_to_update.encode_content(self.page.children['body'].innerHTML({}))
         ws_instance_to_update.send_message(msg)
 
     def set_root_widget(self, widget):
@@ -467,23 +1681,38 @@ class App(BaseHTTPRequestHandler, object):
         self.root._parent = self
         self.root.enable_refresh()
 
-        msg = "0" + self.root.identifier + ',' + to_websocket(self.page.children['body'].innerHTML({}))
-        self._send_spontaneous_websocket_message(msg)
-        
+        self._send_spontaneous_websocket_content(_MSG_SHOW + self.root.identifier + ',',
+                                                 self.page.children['body'].innerHTML({}))
+
     def _send_spontaneous_websocket_message(self, message):
         for ws in list(self.websockets):
-            # noinspection PyBroadException
+            self._send_websocket_message(ws, message)
+
+    def _send_spontaneous_websocket_content(self, prefix, content):
+        """ Sends a message made of a prefix and a content that gets encoded
+            once for each protocol version negotiated by the websockets
+        """
+        messages = {}
+        for ws in list(self.websockets):
+            if ws.protocol_version not in messages:
+                messages[ws.protocol_version] = prefix + ws.encode_content(content)
+            self._send_websocket_message(ws, messages[ws.protocol_version])
+
+    def _send_websocket_message(self, ws, message):
+        # noinspection PyBroadException
+        try:
+            #self._log.debug("sending websocket spontaneous message")
+            ws.send_message(message)
+        except Exception:
+            self._log.error("sending websocket spontaneous message", exc_info=True)
             try:
-                #self._log.debug("sending websocket spontaneous message")
-                ws.send_message(message)
+                self.websockets.remove(ws)
             except Exception:
-                self._log.error("sending websocket spontaneous message", exc_info=True)
-                try:
-                    self.websockets.remove(ws)
-                except Exception:
-                    pass # happens when there are multiple clients
-                else:
-                    ws.close(terminate_server=False)
+                pass # happens when there are multiple clients
+            else:
+                ws.close(terminate_server=False)
+            return False
+        return True
 
     def execute_javascript(self, code):
         self._send_spontaneous_websocket_message(_MSG_JS + code)
@@ -513,49 +1742,135 @@ class App(BaseHTTPRequestHandler, object):
 
     def do_POST(self):
         self._instance()
-        file_data = None
+        with runtime_registry(self.runtime_instances):
+            self._process_post()
+
+    def _process_post(self):
+        file_received = False
         # listener_widget = None
         # listener_function = None
         try:
             # Parse the form data posted
             filename = self.headers['filename']
-            listener_widget = runtimeInstances[self.headers['listener']]
+            listener_widget = self.get_widget(self.headers['listener'])
             listener_function = self.headers['listener_function']
-            form = cgi.FieldStorage(fp=self.rfile,
-                                    headers=self.headers,
-                                    environ={'REQUEST_METHOD': 'POST',
-                                             'CONTENT_TYPE': self.headers['Content-Type']})
-            # Echo back information about what was posted in the form
-            for field in form.keys():
-                field_item = form[field]
-                if field_item.filename:
-                    # The field contains an uploaded file
-                    file_data = field_item.file.read()
-                    file_len = len(file_data)
-                    self._log.debug('post: uploaded %s as "%s" (%d bytes)\n' % (field, field_item.filename, file_len))
-                    get_method_by_name(listener_widget, listener_function)(file_data, filename)
+            if 'upload-id' in self.headers:
+                self._process_chunked_upload(listener_widget, listener_function, unquote(filename))
+                return
+            # the listener widget can provide the files where the uploads get streamed,
+            # otherwise they are written to temporary files, removed after the listener call
+            open_upload = getattr(listener_widget, 'open_upload', None)
+            def open_file(name, part_filename):
+                if open_upload is not None:
+                    return open_upload(filename)
+                return tempfile.NamedTemporaryFile(prefix='remi-upload-', delete=False)
+            content_length = self.headers.get('Content-Length')
+            parser = MultipartParser(self.rfile, self.headers['Content-Type'],
+                                     int(content_length) if content_length else None, open_file)
+            for field, part_filename, value in parser.parse():
+                if part_filename is not None:
+                    # The field contains an uploaded file, the listener gets its path
+                    path = getattr(value, 'name', None)
+                    self._log.debug('post: uploaded %s as "%s" (%s)\n' % (field, part_filename, path))
+                    try:
+                        get_method_by_name(listener_widget, listener_function)(
+                            path if isinstance(path, str) else value, filename)
+                    except BaseException:
+                        # the file has not been taken over by the listener
+                        discard_file(value)
+                        raise
+                    finally:
+                        if open_upload is None:
+                            discard_file(value)
+                    file_received = True
                 else:
                     # Regular form value
-                    self._log.debug('post: %s=%s\n' % (field, form[field].value))
+                    self._log.debug('post: %s=%s\n' % (field, value))
 
-            if file_data is not None:
+            if file_received:
                 # the filedata is sent to the listener
                 self._log.debug('GUI - server.py do_POST: fileupload name= %s' % (filename))
-                self.send_response(200)
+                self._send_status(200)
+            else:
+                self._send_status(400)
         except Exception:
             self._log.error('post: failed', exc_info=True)
-            self.send_response(400)
-        self.send_header('Content-type', 'text/plain')
+            # the request body could be partially read, the connection cannot be reused
+            self.close_connection = True
+            self._send_status(400)
+
+    def _process_chunked_upload(self, listener_widget, listener_function, filename):
+        """ Receives a slice of a file uploaded in chunks, or just reports the upload status
+            if the request has no upload-offset header. The response is the json upload status,
+            the file gets handed over to the listener once complete.
+        """
+        open_upload = getattr(listener_widget, 'open_upload', None)
+        def open_file():
+            if open_upload is not None:
+                return open_upload(filename)
+            return tempfile.NamedTemporaryFile(prefix='remi-upload-', delete=False)
+        offset = self.headers.get('upload-offset')
+        upload = ChunkedUpload.get((self.session, self.headers['listener'], self.headers['upload-id']),
+                                   int(self.headers['upload-size']), open_file if offset is not None else None)
+        if offset is not None and upload.completed:
+            # a slice sent again after the completion, it is read but not written
+            remaining = int(self.headers.get('Content-Length') or 0)
+            while remaining > 0:
+                data = self.rfile.read(min(65536, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+        elif offset is not None:
+            try:
+                upload.write(int(offset), self.rfile, int(self.headers.get('Content-Length') or 0))
+            except IOError:
+                # the client sends the slice again for any error status but 400
+                self._log.warning('post: upload slice of "%s" not received' % filename, exc_info=True)
+                self.close_connection = True
+                self._send_status(408)
+                return
+            onprogress = getattr(listener_widget, 'onprogress', None)
+            if onprogress is not None:
+                with self.update_lock:
+                    onprogress(filename, upload.received(), upload.size)
+            if upload.finish():
+                self._log.debug('post: uploaded "%s" in chunks (%d bytes)' % (filename, upload.size))
+                try:
+                    get_method_by_name(listener_widget, listener_function)(upload.file.name, filename)
+                except BaseException:
+                    # the file has not been taken over by the listener
+                    upload.abort()
+                    raise
+                finally:
+                    if open_upload is None:
+                        discard_file(upload.file)
+        # the status of an upload not started yet is reported without creating it
+        status = upload.status() if upload is not None else {'received': [], 'complete': False}
+        content = encode_text(json.dumps(status))
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
         self.end_headers()
+        self.wfile.write(content)
 
     def do_HEAD(self):
         self.send_response(200)
         self.end_headers()
 
-    def do_AUTHHEAD(self):
+    def do_AUTHHEAD(self, message=''):
+        content = encode_text(message)
         self.send_response(401)
         self.send_header('WWW-Authenticate', 'Basic realm=\"Protected\"')
         self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_status(self, code):
+        """ Sends a response without content """
+        self.send_response(code)
+        self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
     def do_GET(self):
@@ -566,6 +1881,7 @@ class App(BaseHTTPRequestHandler, object):
                 #passing arguments to websocket handler, otherwise it will lost the last message, 
                 # and will be unable to handshake
                 ws = WebSocketsHandler(self.headers, self.request, self.client_address, self.server)
+                self.close_connection = True
                 return
 
         """Handler for the GET requests."""
@@ -575,29 +1891,47 @@ class App(BaseHTTPRequestHandler, object):
         else:
             if not ('Authorization' in self.headers) or self.headers['Authorization'] is None:
                 self._log.info("Authenticating")
-                self.do_AUTHHEAD()
-                self.wfile.write(encode_text('no auth header received'))
+                self.do_AUTHHEAD('no auth header received')
             elif self.headers['Authorization'] == 'Basic ' + self.server.auth.decode():
                 do_process = True
             else:
-                self.do_AUTHHEAD()
-                self.wfile.write(encode_text(self.headers['Authorization']))
-                self.wfile.write(encode_text('not authenticated'))
+                self.do_AUTHHEAD(self.headers['Authorization'] + 'not authenticated')
 
         if do_process:
             path = str(unquote(self.path))
+            if path == '/remi:metrics' and getattr(self.server, 'metrics', None) is not None:
+                # served without a session, the scrapers do not keep cookies
+                self._send_text(self.server.metrics.render(), 'text/plain; version=0.0.4; charset=utf-8')
+                return
+            if path == '/remi:profile' and getattr(self.server, 'profiler', None) is not None:
+                self._send_text(self.server.profiler.report(), 'text/plain; charset=utf-8',
+                                {'Content-Disposition': 'attachment; filename="remi_profile.txt"'})
+                return
             # noinspection PyBroadException
             try:
                 self._instance()
-                # build the page (call main()) in user code, if not built yet
-                with self.update_lock:
-                    # build the root page once if necessary
-                    if not 'root' in self.page.children['body'].children.keys():
-                        self._log.info('built UI (path=%s)' % path)
-                        self.set_root_widget(self.main(*self.server.userdata))
-                self._process_all(path)
+                with runtime_registry(self.runtime_instances):
+                    # build the page (call main()) in user code, if not built yet
+                    with self.update_lock:
+                        # build the root page once if necessary
+                        if not 'root' in self.page.children['body'].children.keys():
+                            self._log.info('built UI (path=%s)' % path)
+                            self._build_root_widget()
+                    self._process_all(path)
             except Exception:
                 self._log.error('error processing GET request', exc_info=True)
+                # the response could be incomplete
+                self.close_connection = True
+
+    def _send_text(self, text, content_type, headers={}):
+        content = encode_text(text)
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
 
     def _get_static_file(self, filename):
         filename = filename.replace("..", "") #avoid backdirs
@@ -607,15 +1941,28 @@ class App(BaseHTTPRequestHandler, object):
         key = filename[:__i]
         path = filename[__i+1:]
         key = key.replace("/","")
+        paths = self._static_paths()
+        if not key in paths:
+            return None
+        return os.path.join(paths[key], path)
+
+    def _static_paths(self):
+        """ Returns the folders of the static files by key. The static_file_path parameter
+            is given by the App class, the folders are collected once per server and App class
+        """
+        cache = getattr(self.server, 'static_paths', None)
+        paths = cache.get(type(self)) if cache is not None else None
+        if paths is not None:
+            return paths
         paths = {'res': os.path.join(os.path.dirname(__file__), "res")}
         static_paths = self._app_args.get('static_file_path', {})
         if not type(static_paths)==dict:
             self._log.error("App's parameter static_file_path must be a Dictionary.", exc_info=False)
             static_paths = {}
         paths.update(static_paths)
-        if not key in paths:
-            return None
-        return os.path.join(paths[key], path)
+        if cache is not None:
+            cache[type(self)] = paths
+        return paths
 
     def _process_all(self, func):
         self._log.debug('get: %s' % func)
@@ -624,32 +1971,29 @@ class App(BaseHTTPRequestHandler, object):
         attr_call = self.re_attr_call.match(func)
 
         if (func == '/') or (not func):
+            with self.update_lock:
+                # render the HTML
+                page_content = encode_text("<!DOCTYPE html>\n" + self.page.repr())
+
             self.send_response(200)
             self.send_header("Set-Cookie", "remi_session=%s; SameSite=Lax"%(self.session))
             self.send_header('Content-type', 'text/html')
+            self.send_header('Content-Length', str(len(page_content)))
             self.end_headers()
-            
-            with self.update_lock:
-                # render the HTML
-                page_content = self.page.repr()
+            self.wfile.write(page_content)
 
-            self.wfile.write(encode_text("<!DOCTYPE html>\n"))
-            self.wfile.write(encode_text(page_content))
-            
         elif static_file:
             filename = self._get_static_file(static_file.groups()[0])
             if not filename:
-                self.send_response(404)
+                self._send_status(404)
                 return
-            mimetype, encoding = mimetypes.guess_type(filename)
-            self.send_response(200)
-            self.send_header('Content-type', mimetype if mimetype else 'application/octet-stream')
-            if self.server.enable_file_cache:
-                self.send_header('Cache-Control', 'public, max-age=86400')
-            self.end_headers()
-            with open(filename, 'rb') as f:
-                content = f.read()
-                self.wfile.write(content)
+            try:
+                static_file = self.server.static_file_cache.get(filename)
+            except (IOError, OSError):
+                self._log.error('static file %s not available' % filename)
+                self._send_status(404)
+                return
+            self._send_static_file(static_file)
         elif attr_call:
             with self.update_lock:
                 param_dict = parse_qs(urlparse(func).query)
@@ -659,27 +2003,205 @@ class App(BaseHTTPRequestHandler, object):
 
                 widget, func = attr_call.group(1, 2)
                 try:
-                    content, headers = get_method_by_name(get_method_by_id(widget), func)(**param_dict)
+                    content, headers = get_method_by_name(self.get_widget(widget), func)(**param_dict)
                     if content is None:
-                        self.send_response(503)
+                        self._send_status(503)
                         return
-                    self.send_response(200)
                 except IOError:
                     self._log.error('attr %s/%s call error' % (widget, func), exc_info=True)
-                    self.send_response(404)
+                    self._send_status(404)
                     return
-                except (TypeError, AttributeError):
+                except (KeyError, TypeError, AttributeError):
                     self._log.error('attr %s/%s not available' % (widget, func))
-                    self.send_response(503)
+                    self._send_status(503)
                     return
 
+            # the content can be bytes, text, a binary file object, a list of chunks
+            # or an iterator (i.e. a generator) producing the chunks
+            if hasattr(content, 'read'):
+                try:
+                    try:
+                        content.seek(0, os.SEEK_END)
+                        size = content.tell()
+                    except (AttributeError, IOError, OSError, ValueError):
+                        # pipes, sockets and other unseekable streams
+                        self._send_chunks(iter(lambda: content.read(65536), b''), headers)
+                    else:
+                        self._send_content(content, size, headers, parse_range_header(self.headers.get('Range'), size))
+                finally:
+                    content.close()
+                return
+            if hasattr(content, '__next__') or hasattr(content, 'next'):
+                self._send_chunks(content, headers)
+                return
+            if isinstance(content, (list, tuple)):
+                content = b''.join(encode_text(chunk) for chunk in content)
+            elif isinstance(content, bytearray):
+                content = bytes(content)
+            elif not isinstance(content, (bytes, type(u''))):
+                content = str(content)
+            content = encode_text(content)
+            self._send_content(content, len(content), headers,
+                               parse_range_header(self.headers.get('Range'), len(content)))
+
+        else:
+            self._send_status(404)
+
+    def _static_file_not_modified(self, static_file):
+        """ Evaluates the conditional request headers, If-None-Match takes precedence over If-Modified-Since """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            etags = [etag.strip() for etag in if_none_match.split(',')]
+            etags = [etag[2:] if etag.startswith('W/') else etag for etag in etags]
+            return '*' in etags or static_file.etag in etags or static_file.gzip_etag in etags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            date = email.utils.parsedate_tz(if_modified_since)
+            if date is not None:
+                return int(static_file.mtime) <= email.utils.mktime_tz(date)
+        return False
+
+    def _if_range_matches(self, static_file):
+        """ A Range request is served only if the If-Range validator, if any, matches the file """
+        if_range = self.headers.get('If-Range')
+        if not if_range:
+            return True
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return if_range == static_file.etag
+        date = email.utils.parsedate_tz(if_range)
+        return date is not None and int(static_file.mtime) == email.utils.mktime_tz(date)
+
+    def _send_static_file(self, static_file):
+        headers = {'Content-type': static_file.mimetype,
+                   'ETag': static_file.etag,
+                   'Last-Modified': self.date_time_string(static_file.mtime)}
+        if static_file.gzip_content is not None:
+            headers['Vary'] = 'Accept-Encoding'
+        if self.server.enable_file_cache:
+            headers['Cache-Control'] = 'public, max-age=86400'
+        if self._static_file_not_modified(static_file):
+            self.send_response(304)
             for k in headers:
                 self.send_header(k, headers[k])
             self.end_headers()
-            try:
-                self.wfile.write(content)
-            except TypeError:
-                self.wfile.write(encode_text(content))
+            return
+        ranges = None
+        if self._if_range_matches(static_file):
+            ranges = parse_range_header(self.headers.get('Range'), static_file.size)
+        # byte ranges always refer to the identity encoding
+        if ranges is None and static_file.gzip_content is not None and \
+                accepts_encoding(self.headers.get('Accept-Encoding'), 'gzip'):
+            headers['ETag'] = static_file.gzip_etag
+            headers['Content-Encoding'] = 'gzip'
+            self._send_content(static_file.gzip_content, len(static_file.gzip_content), headers)
+            return
+        if static_file.content is not None:
+            self._send_content(static_file.content, static_file.size, headers, ranges)
+            return
+        # files too big to be cached are copied from disk
+        with open(static_file.filename, 'rb') as f:
+            self._send_content(f, static_file.size, headers, ranges)
+
+    def _send_content(self, source, size, headers, ranges=None):
+        """ Sends a response with the given headers, whose content is source: bytes
+            or a seekable binary file object, of size bytes.
+            ranges are the requested byte ranges as returned by parse_range_header,
+            None to send the whole content.
+        """
+        if ranges is not None and not ranges:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206 if ranges else 200)
+        content_type = 'application/octet-stream'
+        for k in headers:
+            if k.lower() == 'content-type':
+                content_type = headers[k]
+            elif k.lower() != 'content-length':
+                self.send_header(k, headers[k])
+        self.send_header('Accept-Ranges', 'bytes')
+        if not ranges:
+            self.send_header('Content-type', content_type)
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            self._write_content(source, 0, size)
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            self.send_header('Content-type', content_type)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+            self.send_header('Content-Length', str(last - first + 1))
+            self.end_headers()
+            self._write_content(source, first, last - first + 1)
+        else:
+            boundary = uuid.uuid4().hex
+            part_headers = [encode_text('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' %
+                                        (boundary, content_type, first, last, size)) for first, last in ranges]
+            end = encode_text('--%s--\r\n' % boundary)
+            length = len(end) + sum(len(part_header) + last - first + 1 + 2
+                                    for part_header, (first, last) in zip(part_headers, ranges))
+            self.send_header('Content-type', 'multipart/byteranges; boundary=%s' % boundary)
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+            for part_header, (first, last) in zip(part_headers, ranges):
+                self.wfile.write(part_header)
+                self._write_content(source, first, last - first + 1)
+                self.wfile.write(b'\r\n')
+            self.wfile.write(end)
+
+    def _send_chunks(self, chunks, headers):
+        """ Sends a content of unknown length, produced by the iterable chunks.
+            HTTP/1.1 clients get chunked transfer encoding, for the others the end
+            of the content is marked by closing the connection.
+        """
+        self.send_response(200)
+        for k in headers:
+            if k.lower() != 'content-length':
+                self.send_header(k, headers[k])
+        chunked = self.protocol_version >= 'HTTP/1.1' and self.request_version >= 'HTTP/1.1'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_headers()
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if not isinstance(chunk, bytes):
+                chunk = encode_text(chunk)
+            if chunked:
+                self.wfile.write(encode_text('%x\r\n' % len(chunk)) + chunk + b'\r\n')
+            else:
+                self.wfile.write(chunk)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def _write_content(self, source, offset, count):
+        if isinstance(source, bytes):
+            self.wfile.write(source[offset:offset + count] if offset or count < len(source) else source)
+        else:
+            self._send_file(source, offset, count)
+
+    def _send_file(self, f, offset, count):
+        """ Writes count bytes of the file object f starting at offset, with a constant memory use.
+            On plain tcp connections the data gets copied by the kernel (sendfile),
+            on TLS connections it is read and written in chunks.
+        """
+        if count <= 0:
+            return
+        self.wfile.flush()
+        sock = self.connection
+        if hasattr(sock, 'sendfile') and not isinstance(sock, ssl.SSLSocket):
+            sock.sendfile(f, offset, count)
+            return
+        f.seek(offset)
+        while count > 0:
+            chunk = f.read(min(count, 65536))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            count -= len(chunk)
 
     def close(self):
         """ Command to initiate an App to close
@@ -688,11 +2210,33 @@ class App(BaseHTTPRequestHandler, object):
         self.server.server_starter_instance.stop()
 
     def on_close(self):
-        """ Called by the server when the App have to be terminated
+        """ Called by the server when the App have to be terminated,
+            or when its session gets evicted
         """
         self._stop_update_flag = True
-        for ws in self.websockets:
-            ws.close()
+        for ws in list(self.websockets):
+            ws.close(terminate_server=False)
+
+    def memory_usage(self):
+        """ Returns an estimate of the memory held by the session in bytes,
+            used to enforce the max_sessions_memory limit. Applications keeping
+            large data in the App instance can override it.
+        """
+        size = 0
+        pending = [self.page]
+        while pending:
+            tag = pending.pop()
+            size += sys.getsizeof(tag) + sys.getsizeof(tag.__dict__)
+            for container in (tag.attributes, tag.style, tag.children):
+                size += sys.getsizeof(container)
+                for key, value in container.items():
+                    size += sys.getsizeof(key)
+                    if hasattr(value, 'children'):
+                        pending.append(value)
+                    else:
+                        size += sys.getsizeof(value)
+            size += sys.getsizeof(getattr(tag, '_backup_repr', ''))
+        return size
 
     def onload(self, emitter):
         """ WebPage Event that occurs on webpage loaded
@@ -726,6 +2270,20 @@ class App(BaseHTTPRequestHandler, object):
         self._log.debug('App.onresize event occurred. Width:%s Height:%s'%(width, height))
 
 
+def server_metrics(server):
+    """ Metrics collector of the current state of the sessions, the websockets and the static file cache """
+    websockets = [ws for client in list(clients.values()) for ws in list(getattr(client, 'websockets', ()))]
+    queue_lengths = [len(ws.send_queue) for ws in websockets]
+    cache = server.static_file_cache
+    return [('remi_sessions', 'gauge', {(): len(clients)}),
+            ('remi_websockets', 'gauge', {(): len(websockets)}),
+            ('remi_websocket_send_queue_entries', 'gauge', {(): sum(queue_lengths)}),
+            ('remi_websocket_send_queue_max_entries', 'gauge', {(): max(queue_lengths or [0])}),
+            ('remi_static_cache_hits_total', 'counter', {(): cache.hits}),
+            ('remi_static_cache_misses_total', 'counter', {(): cache.misses}),
+            ('remi_static_cache_bytes', 'gauge', {(): cache.size})]
+
+
 class ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
 
     daemon_threads = False
@@ -734,8 +2292,16 @@ class ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
     def __init__(self, server_address, RequestHandlerClass,
                  auth, multiple_instance, enable_file_cache, update_interval,
                  websocket_timeout_timer_ms, pending_messages_queue_length,
-                 title, server_starter_instance, certfile, keyfile, ssl_version, *userdata):
-        HTTPServer.__init__(self, server_address, RequestHandlerClass)
+                 title, server_starter_instance, certfile, keyfile, ssl_version, websocket_compression,
+                 websocket_send_queue_length, websocket_send_queue_policy,
+                 static_file_cache_size, keep_alive_timeout, session_reaper, metrics, profiler, *userdata):
+        # without server_address there is no listener, the server handles the connections
+        # passed to accept_connection only (i.e. the prefork workers)
+        self.listening = server_address is not None
+        HTTPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate=self.listening)
+        if not self.listening:
+            self.socket.close()
+        self._stopped = threading.Event()
         self.auth = auth
         self.multiple_instance = multiple_instance
         self.enable_file_cache = enable_file_cache
@@ -744,7 +2310,26 @@ class ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
         self.pending_messages_queue_length = pending_messages_queue_length
         self.title = title
         self.server_starter_instance = server_starter_instance
+        self.websocket_compression = websocket_compression
+        self.websocket_send_queue_length = websocket_send_queue_length
+        self.websocket_send_queue_policy = websocket_send_queue_policy
+        # the static files are kept in memory only if the file cache is enabled
+        self.static_file_cache = StaticFileCache(static_file_cache_size if enable_file_cache else 0)
+        self.keep_alive_timeout = keep_alive_timeout
+        self.session_reaper = session_reaper
+        self.session_snapshots = {}
+        # App class -> the static file folders by key
+        self.static_paths = {}
+        # (worker index, worker count) in prefork mode, the worker owns the session ids equal to its index modulo count
+        self.session_affinity = None
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.add_collector(lambda: server_metrics(self))
+        self.profiler = profiler
         self.userdata = userdata
+        # the connections being served, the idle keep-alive ones get closed on stop
+        self._connections = set()
+        self._connections_lock = threading.Lock()
 
         self.certfile = certfile
         self.keyfile = keyfile
@@ -752,13 +2337,56 @@ class ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
         if self.ssl_version!=None:
             self.socket = ssl.wrap_socket(self.socket, keyfile=self.keyfile, certfile=self.certfile, server_side=True, ssl_version=self.ssl_version, do_handshake_on_connect=True)
 
+    def accept_connection(self, sock):
+        """ Serves a connection accepted by another process (i.e. the prefork front process) """
+        self.process_request(sock, sock.getpeername())
+
+    def serve_forever(self, poll_interval=0.5):
+        if self.listening:
+            HTTPServer.serve_forever(self, poll_interval)
+        else:
+            self._stopped.wait()
+
+    def shutdown(self):
+        if self.listening:
+            HTTPServer.shutdown(self)
+        else:
+            self._stopped.set()
+
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            self._connections.add(request)
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self._connections_lock:
+            self._connections.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        """ Shuts down the connections being served, the handler threads waiting
+            for the next request of a keep-alive connection return at once
+        """
+        with self._connections_lock:
+            connections = list(self._connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+
 
 class Server(object):
     # noinspection PyShadowingNames
     def __init__(self, gui_class, title='', start=True, address='127.0.0.1', port=0, username=None, password=None,
                  multiple_instance=False, enable_file_cache=True, update_interval=0.1, start_browser=True,
                  websocket_timeout_timer_ms=1000, pending_messages_queue_length=1000, 
-                 certfile=None, keyfile=None, ssl_version=None,  userdata=()):
+                 certfile=None, keyfile=None, ssl_version=None,  userdata=(), engine='threading', loop=None,
+                 websocket_compression_level=None, websocket_compression_window_bits=15,
+                 websocket_compression_threshold=512, websocket_send_queue_length=1000,
+                 websocket_send_queue_policy='drop_superseded', static_file_cache_size=32*1024*1024,
+                 keep_alive_timeout=30, session_timeout=None, max_sessions=None, max_sessions_memory=None,
+                 workers=None, metrics=False, profiler=False):
 
         self._gui = gui_class
         self._title = title or gui_class.__name__
@@ -777,6 +2405,39 @@ class Server(object):
         self._keyfile = keyfile
         self._ssl_version = ssl_version
         self._userdata = userdata
+        if engine not in ('threading', 'asyncio'):
+            raise ValueError("engine must be 'threading' or 'asyncio'")
+        self._engine = engine
+        self._loop = loop
+        self._websocket_compression = None
+        if websocket_compression_level is not None:
+            self._websocket_compression = {'level': websocket_compression_level,
+                                           'window_bits': websocket_compression_window_bits,
+                                           'threshold': websocket_compression_threshold}
+        if websocket_send_queue_policy not in WebSocketSendQueue.POLICIES:
+            raise ValueError("websocket_send_queue_policy must be one of %s" % ', '.join(WebSocketSendQueue.POLICIES))
+        self._websocket_send_queue_length = websocket_send_queue_length
+        self._websocket_send_queue_policy = websocket_send_queue_policy
+        self._static_file_cache_size = static_file_cache_size
+        self._keep_alive_timeout = keep_alive_timeout
+        self._session_reaper = None
+        if multiple_instance:
+            self._session_reaper = SessionReaper(session_timeout, max_sessions, max_sessions_memory)
+        if workers is not None:
+            if not multiple_instance:
+                raise ValueError('workers requires multiple_instance, each session is owned by a worker')
+            if ssl_version is not None or loop is not None:
+                raise ValueError('workers is not available with ssl or with an external event loop')
+            if sys.version_info < (3, 4) or not hasattr(os, 'fork'):
+                raise ValueError('workers requires Python 3.4+ and the fork start method (POSIX)')
+        self._workers = workers
+        # the server counters and histograms, None if not enabled. In prefork mode each worker
+        # collects its own ones, /remi:metrics reports the worker serving the request
+        self.metrics = Metrics() if metrics else None
+        # True for a CallbackProfiler with the default settings
+        self.profiler = profiler or None
+        if profiler is True:
+            self.profiler = CallbackProfiler()
         if username and password:
             self._auth = base64.b64encode(encode_text("%s:%s" % (username, password)))
         else:
@@ -790,7 +2451,8 @@ class Server(object):
         if start:
             self._myid = threading.Thread.ident
             self.start()
-            self.serve_forever()
+            if self._loop is None:
+                self.serve_forever()
 
     @property
     def title(self):
@@ -801,13 +2463,57 @@ class Server(object):
         return self._base_address
 
     def start(self):
+        self._create_http_server()
+        if self._session_reaper is not None and self._workers is None:
+            # in prefork mode the sessions are reaped by the workers
+            self._session_reaper.start()
+        if self._engine == 'asyncio' and self._loop is not None:
+            # the event loop is owned by the host application, the server runs as a task on it
+            self._sserver.serve_in_loop(self._loop)
+            return
+        self._sth = threading.Thread(target=self._sserver.serve_forever)
+        self._sth.daemon = False
+        self._sth.start()
+
+    def serve_async(self):
+        """ Returns an awaitable that serves the application on the running event loop.
+            Available only with engine='asyncio', to be used as:
+
+                server = Server(MyApp, start=False, engine='asyncio')
+                await server.serve_async()
+        """
+        if self._engine != 'asyncio' or self._workers is not None:
+            raise RuntimeError("serve_async requires engine='asyncio' without workers")
+        if self._sserver is None:
+            self._create_http_server()
+        if self._session_reaper is not None:
+            self._session_reaper.start()
+        return self._sserver.serve()
+
+    def _create_http_server(self):
         # Create a web server and define the handler to manage the incoming
         # request
-        self._sserver = ThreadedHTTPServer((self._address, self._sport), self._gui, self._auth,
-                                           self._multiple_instance, self._enable_file_cache,
-                                           self._update_interval, self._websocket_timeout_timer_ms,
-                                           self._pending_messages_queue_length, self._title, 
-                                           self, self._certfile, self._keyfile, self._ssl_version, *self._userdata)
+        if self._engine == 'asyncio':
+            try:
+                from .server_asyncio import AsyncioHTTPServer as server_class
+            except (ImportError, SyntaxError):
+                raise ImportError("The asyncio engine requires Python 3.5 or later")
+        else:
+            server_class = ThreadedHTTPServer
+        server_args = (self._gui, self._auth,
+                       self._multiple_instance, self._enable_file_cache,
+                       self._update_interval, self._websocket_timeout_timer_ms,
+                       self._pending_messages_queue_length, self._title,
+                       self, self._certfile, self._keyfile, self._ssl_version,
+                       self._websocket_compression, self._websocket_send_queue_length,
+                       self._websocket_send_queue_policy, self._static_file_cache_size,
+                       self._keep_alive_timeout, self._session_reaper, self.metrics,
+                       self.profiler) + tuple(self._userdata)
+        if self._workers is not None:
+            from .server_prefork import PreforkHTTPServer
+            self._sserver = PreforkHTTPServer(self._workers, server_class, (self._address, self._sport), *server_args)
+        else:
+            self._sserver = server_class((self._address, self._sport), *server_args)
         shost, sport = self._sserver.socket.getsockname()[:2]
         self._log.info('Started httpserver http://%s:%s/'%(shost,sport))
         # when listening on multiple net interfaces the browsers connects to localhost
@@ -824,9 +2530,6 @@ class Server(object):
                     webbrowser.get('windows-default').open(self._base_address)
                 else:
                     webbrowser.open(self._base_address)
-        self._sth = threading.Thread(target=self._sserver.serve_forever)
-        self._sth.daemon = False
-        self._sth.start()
 
     def serve_forever(self):
         # we could join on the threads, but join blocks all interrupts (including
@@ -853,8 +2556,13 @@ class Server(object):
     def stop(self):
         global clients
         self._alive = False
+        if self._session_reaper is not None:
+            self._session_reaper.stop()
         self._sserver.shutdown()
-        for client in clients.values():
+        close_connections = getattr(self._sserver, 'close_connections', None)
+        if close_connections is not None:
+            close_connections()
+        for client in list(clients.values()):
             client.on_close()
 
 
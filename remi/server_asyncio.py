@@ -0,0 +1,435 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   asyncio server engine.
+   HTTP requests, static files and websockets are served by a single event loop,
+   instead of a thread per connection. The App request handler is reused as is:
+   each HTTP request is processed in an executor thread, reading and writing the
+   connection through blocking file-like views of the asyncio streams.
+   The HTTP requests and the websocket callbacks run in separate executors, the slow
+   downloads cannot hold the threads that dispatch the callbacks and the idle loops.
+   Selected by start(MyApp, engine='asyncio'). Requires Python 3.5+.
+"""
+import asyncio
+import concurrent.futures
+import http.client
+import io
+import logging
+import socket
+import ssl
+import threading
+
+from .server import WebSocketsHandler, WebSocketFrameDecoder, WebSocketSendQueue, StaticFileCache, clients, \
+    server_metrics
+
+
+class _StreamReaderFile(object):
+    """ Blocking file-like view of an asyncio.StreamReader.
+        The already received bytes (the request head) are consumed first.
+        Used by the request handlers running in the executor threads.
+        When the handler looks for the next request of a persistent connection
+        (a readline past the request head) the end of file is returned and
+        next_request is set: the next request head is awaited by the loop,
+        without holding an executor thread for the idle connection.
+    """
+
+    def __init__(self, prefix, reader, loop):
+        self._prefix = io.BytesIO(prefix)
+        self._reader = reader
+        self._loop = loop
+        self.closed = False
+        self.next_request = False
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _read_exactly(self, size):
+        try:
+            return await self._reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    def readline(self, limit=-1):
+        line = self._prefix.readline(limit)
+        if line.endswith(b'\n') or (0 <= limit <= len(line)):
+            return line
+        if not line:
+            self.next_request = True
+        return line
+
+    def read(self, size=-1):
+        data = self._prefix.read(size)
+        if size is None or size < 0:
+            return data + self._run(self._reader.read(-1))
+        if len(data) < size:
+            data += self._run(self._read_exactly(size - len(data)))
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class _TransportSocket(object):
+    """ Minimal socket-like object writing to an asyncio StreamWriter.
+        Writes issued from threads other than the loop block until the data is
+        handed to the transport and drained (backpressure for large responses).
+    """
+
+    def __init__(self, reader, writer, loop, prefix=b''):
+        self._writer = writer
+        self._loop = loop
+        self._rfile = _StreamReaderFile(prefix, reader, loop)
+
+    async def _write(self, data):
+        if self._writer.transport.is_closing():
+            raise ConnectionResetError('connection closed')
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def makefile(self, mode='r', *args, **kwargs):
+        if 'r' in mode:
+            return self._rfile
+        raise io.UnsupportedOperation('write access goes through sendall')
+
+    def sendall(self, data):
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self._loop).result()
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendfile(self, file, offset=0, count=None):
+        """ Zero-copy file transmission with loop.sendfile, falling back to
+            read and write on TLS connections and on Python versions before 3.7
+        """
+        if not hasattr(self._loop, 'sendfile'):
+            file.seek(offset)
+            remaining = count
+            while remaining is None or remaining > 0:
+                chunk = file.read(65536 if remaining is None else min(remaining, 65536))
+                if not chunk:
+                    break
+                self.sendall(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+            return
+        asyncio.run_coroutine_threadsafe(self._loop.sendfile(self._writer.transport, file, offset, count),
+                                         self._loop).result()
+
+    def getsockname(self):
+        return self._writer.get_extra_info('sockname')
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def shutdown(self, how):
+        self._loop.call_soon_threadsafe(self._writer.close)
+
+    def close(self):
+        pass
+
+
+class AsyncioWebSocketsHandler(WebSocketsHandler):
+    """ WebSocketsHandler running on the event loop.
+        The messages are read by a coroutine, callbacks are dispatched in the executor
+        in order to keep the loop responsive. send_message can be called by any thread,
+        the queued messages are written by a writer task waiting for the transport to drain.
+    """
+
+    def __init__(self, headers, reader, writer, server):
+        self.headers = headers
+        self.handshake_done = False
+        self.protocol_version = 1
+        self._send_lock = threading.Lock()
+        self._log = logging.getLogger('remi.server.ws')
+        self.server = server
+        self.client_address = writer.get_extra_info('peername')
+        self._reader = reader
+        self._writer = writer
+        self._loop = server.loop
+        self._decoder = WebSocketFrameDecoder()
+        self.send_queue = WebSocketSendQueue(server.websocket_send_queue_length, server.websocket_send_queue_policy)
+        self._writer_wakeup = asyncio.Event()
+        self.send_queue.wakeup = self._wakeup_writer
+        self._writer_task = None
+
+    def _write(self, header, payload):
+        if not self._writer.transport.is_closing():
+            self._writer.writelines((header, payload))
+
+    def write_frame(self, header, payload):
+        # the transport serializes the writes, frames cannot interleave
+        self._loop.call_soon_threadsafe(self._write, header, payload)
+
+    def _wakeup_writer(self):
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._writer_wakeup.set)
+
+    def abort(self):
+        self._loop.call_soon_threadsafe(self._writer.transport.abort)
+
+    async def _writer_loop(self):
+        """ Writes the queued messages, waiting for the client to read them before the next ones """
+        try:
+            while True:
+                self._writer_wakeup.clear()
+                entries = self.send_queue.get(block=False)
+                if entries is None:
+                    break
+                if not entries:
+                    await self._writer_wakeup.wait()
+                    continue
+                # encoding and compression run in the executor, the frames are
+                # scheduled on the loop before the executor call completes
+                await self._loop.run_in_executor(self.server.callback_executor, self.write_entries, entries)
+                await self._writer.drain()
+        except ConnectionError:
+            self.send_queue.close()
+
+    async def serve(self):
+        self._log.info('connection established: %r' % (self.client_address,))
+        response = self.handshake_response()
+        if response is None:
+            return
+        self._writer.write(response)
+        self._log.info('handshake complete')
+        self.handshake_done = True
+        # the loop keeps weak references to its tasks
+        self._writer_task = self._loop.create_task(self._writer_loop())
+        self._writer_task.add_done_callback(self._writer_done)
+        executor = self.server.callback_executor
+        await self._loop.run_in_executor(executor, clients[self.session].websocket_handshake_done, self)
+        while True:
+            message = await self.read_next_message_async()
+            if message is None:
+                break
+            if not await self._loop.run_in_executor(executor, self.process_message, *message):
+                break
+        self.send_queue.close()
+        client = clients.get(self.session)
+        # the session could have been evicted meanwhile
+        if client is not None:
+            client.websockets.discard(self)
+        self.handshake_done = False
+        self._log.debug('ws ending websocket service')
+
+    def _writer_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self._log.error('error writing to websocket %r' % (self.client_address,), exc_info=task.exception())
+            self.send_queue.close()
+            self.abort()
+
+    async def read_next_message_async(self):
+        """ Returns the next complete message as (opcode, payload), or None if the connection got closed
+        """
+        message = self._decoder.next_message()
+        while message is None:
+            try:
+                data = await self._reader.read(65536)
+            except ConnectionError:
+                return None
+            if not data:
+                return None
+            self._decoder.feed(data)
+            message = self._decoder.next_message()
+        return message
+
+    def close(self, terminate_server=True):
+        self.send_queue.close()
+        self._loop.call_soon_threadsafe(self._writer.close)
+        if terminate_server:
+            self.server.shutdown()
+
+
+class AsyncioHTTPServer(object):
+    """ Event loop based replacement of ThreadedHTTPServer, with the same constructor signature.
+        The listening socket gets bound at construction, so that the address is known
+        before the loop starts serving.
+    """
+
+    # threads processing the HTTP requests, static files and downloads included
+    http_workers = 32
+    # threads dispatching the websocket callbacks and running the idle loops, None for the executor default
+    callback_workers = None
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 auth, multiple_instance, enable_file_cache, update_interval,
+                 websocket_timeout_timer_ms, pending_messages_queue_length,
+                 title, server_starter_instance, certfile, keyfile, ssl_version, websocket_compression,
+                 websocket_send_queue_length, websocket_send_queue_policy,
+                 static_file_cache_size, keep_alive_timeout, session_reaper, metrics, profiler, *userdata):
+        self.RequestHandlerClass = RequestHandlerClass
+        self.auth = auth
+        self.multiple_instance = multiple_instance
+        self.enable_file_cache = enable_file_cache
+        self.update_interval = update_interval
+        self.websocket_timeout_timer_ms = websocket_timeout_timer_ms
+        self.pending_messages_queue_length = pending_messages_queue_length
+        self.title = title
+        self.server_starter_instance = server_starter_instance
+        self.websocket_compression = websocket_compression
+        self.websocket_send_queue_length = websocket_send_queue_length
+        self.websocket_send_queue_policy = websocket_send_queue_policy
+        # the static files are kept in memory only if the file cache is enabled
+        self.static_file_cache = StaticFileCache(static_file_cache_size if enable_file_cache else 0)
+        self.keep_alive_timeout = keep_alive_timeout
+        self.session_reaper = session_reaper
+        self.session_snapshots = {}
+        self.static_paths = {}
+        self.session_affinity = None
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.add_collector(lambda: server_metrics(self))
+        self.profiler = profiler
+        self.userdata = userdata
+
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.ssl_version = ssl_version
+        self.ssl_context = None
+        if self.ssl_version != None:
+            self.ssl_context = ssl.SSLContext(self.ssl_version)
+            self.ssl_context.load_cert_chain(self.certfile, self.keyfile)
+
+        # without server_address there is no listener, the server handles the connections
+        # passed to accept_connection only (i.e. the prefork workers)
+        self.socket = None
+        self.server_address = None
+        if server_address is not None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(server_address)
+            self.socket.listen(128)
+            self.socket.setblocking(False)
+            self.server_address = self.socket.getsockname()
+
+        self.http_executor = None
+        self.callback_executor = None
+        self.loop = None
+        self._loop_thread_ident = None
+        self._stop_event = None
+        self._shutdown_request = False
+        self._writers = set()
+        self._shut_down = threading.Event()
+        self._serving = threading.Event()
+        self._log = logging.getLogger('remi.server.asyncio')
+
+    def serve_forever(self):
+        """ Runs a private event loop until shutdown, as ThreadedHTTPServer.serve_forever does """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.serve())
+            # idle loops and connections still pending get cancelled before closing the loop
+            all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+            pending = all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        finally:
+            loop.close()
+
+    def serve_in_loop(self, loop):
+        """ Schedules the server on an event loop owned by the host application """
+        return asyncio.run_coroutine_threadsafe(self.serve(), loop)
+
+    async def serve(self):
+        self.loop = asyncio.get_event_loop()
+        self._loop_thread_ident = threading.current_thread().ident
+        self._stop_event = asyncio.Event()
+        self._shut_down.clear()
+        self.http_executor = concurrent.futures.ThreadPoolExecutor(self.http_workers)
+        self.callback_executor = concurrent.futures.ThreadPoolExecutor(self.callback_workers)
+        if self._shutdown_request:
+            # shutdown requested before the loop started serving
+            self._stop_event.set()
+        server = None
+        if self.socket is not None:
+            server = await asyncio.start_server(self._handle_connection, sock=self.socket, ssl=self.ssl_context)
+        self._serving.set()
+        try:
+            await self._stop_event.wait()
+        finally:
+            self._serving.clear()
+            if server is not None:
+                server.close()
+            for writer in list(self._writers):
+                writer.close()
+            # the handlers still running complete in their threads
+            self.http_executor.shutdown(wait=False)
+            self.callback_executor.shutdown(wait=False)
+            self._shut_down.set()
+
+    def shutdown(self):
+        self._shutdown_request = True
+        if self.loop is None or self._stop_event is None:
+            return
+        self.loop.call_soon_threadsafe(self._stop_event.set)
+        if threading.current_thread().ident != self._loop_thread_ident:
+            self._shut_down.wait()
+
+    def accept_connection(self, sock):
+        """ Serves a connection accepted by another process (i.e. the prefork front process) """
+        self._serving.wait()
+        asyncio.run_coroutine_threadsafe(self._accept_connection(sock), self.loop)
+
+    async def _accept_connection(self, sock):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self._handle_connection(reader, writer)
+
+    def start_idle_loop(self, app):
+        """ Schedules the App idle loop as a task on the event loop, instead of a dedicated thread """
+        asyncio.run_coroutine_threadsafe(self._idle_loop(app), self.loop)
+
+    async def _idle_loop(self, app):
+        while not app._stop_update_flag:
+            await asyncio.sleep(app.update_interval)
+            if not self._serving.is_set():
+                # the server got shut down along with its executors, the host loop keeps running
+                break
+            await self.loop.run_in_executor(self.callback_executor, app._idle_step)
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    # persistent connections are closed once idle for keep_alive_timeout
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keep_alive_timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                        ConnectionError):
+                    return
+                headers = http.client.parse_headers(io.BytesIO(head.partition(b'\r\n')[2]))
+                if headers.get('Upgrade', '').lower() == 'websocket':
+                    await AsyncioWebSocketsHandler(headers, reader, writer, self).serve()
+                    return
+                connection = _TransportSocket(reader, writer, self.loop, head)
+                await self.loop.run_in_executor(self.http_executor, self.RequestHandlerClass, connection,
+                                                writer.get_extra_info('peername'), self)
+                # the handler returns after a single request, the connection
+                # is kept if it was looking for the next one
+                if not connection._rfile.next_request or writer.transport.is_closing():
+                    return
+        except asyncio.CancelledError:
+            # server shutdown
+            pass
+        except Exception:
+            self._log.error('error processing connection', exc_info=True)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   prefork server mode.
+   The sessions are served by N worker processes, each one running the selected
+   engine (threading or asyncio) and owning the session ids equal to its index modulo N.
+   The front process accepts the connections, peeks the first request head for the
+   remi_session cookie and passes the connection to the worker owning the session.
+   Only the socket descriptor gets transferred, the data is not proxied.
+   Connections without a session are distributed round robin, the worker receiving
+   the page request creates the session. Websocket upgrades, uploads and attr calls
+   carry the session cookie, and so they land on the worker owning the session.
+   The workers close the connections of the requests creating a session after the
+   response, the next request on a new connection gets routed by its cookie.
+   Selected by start(MyApp, multiple_instance=True, workers=N). Requires the fork
+   start method of multiprocessing (POSIX).
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import select
+import socket
+import threading
+import time
+from multiprocessing import reduction
+
+from .server import parse_session_cookie, clients
+
+
+def peek_request_head(sock, timeout, limit=65536):
+    """ Returns the head of the first request without consuming it,
+        b'' if the connection got closed, None on timeout
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if select.select([sock], [], [], max(0, deadline - time.time()))[0]:
+            data = sock.recv(limit, socket.MSG_PEEK)
+            if not data or b'\r\n\r\n' in data or len(data) >= limit:
+                return data
+            # partial head, the rest is still to be received
+            time.sleep(0.01)
+    return None
+
+
+def parse_head_session(head):
+    """ Returns the remi_session of a request head, or None """
+    for line in head.split(b'\r\n\r\n')[0].split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'cookie':
+            return parse_session_cookie(value.decode('latin-1'))
+    return None
+
+
+class PreforkHTTPServer(object):
+    """ Front process routing the connections to the worker processes by session.
+        The workers get an instance of server_class built with the remaining arguments,
+        without a listener of its own.
+    """
+
+    # the time a client has to send the first request head
+    head_timeout = 10
+
+    def __init__(self, workers, server_class, server_address, *server_args):
+        self.workers = workers
+        self.server_class = server_class
+        self.server_args = server_args
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(128)
+        self.server_address = self.socket.getsockname()
+
+        self._parent_pid = os.getpid()
+        self._processes = []
+        self._connections = []
+        self._send_locks = []
+        self._round_robin = itertools.count()
+        self._shutdown_request = threading.Event()
+        self._shut_down = threading.Event()
+        self._worker_stop = None
+        self._log = logging.getLogger('remi.server.prefork')
+
+    def worker_for(self, head):
+        """ Returns the index of the worker serving the request """
+        session = parse_head_session(head)
+        if session is None:
+            return next(self._round_robin) % self.workers
+        return session % self.workers
+
+    def serve_forever(self):
+        context = multiprocessing.get_context('fork')
+        for index in range(self.workers):
+            parent_connection, worker_connection = context.Pipe()
+            # the workers close the front process ends, the own one included
+            self._connections.append(parent_connection)
+            self._send_locks.append(threading.Lock())
+            process = context.Process(target=self._worker_main, args=(index, worker_connection))
+            process.daemon = True
+            process.start()
+            worker_connection.close()
+            self._processes.append(process)
+        self._log.info('started %d workers' % self.workers)
+
+        self.socket.settimeout(0.5)
+        try:
+            while not self._shutdown_request.is_set():
+                try:
+                    sock, _ = self.socket.accept()
+                except socket.timeout:
+                    # as in a single process, a worker terminated by App.close stops the server
+                    if not all(process.is_alive() for process in self._processes):
+                        self._log.info('worker terminated, shutting down')
+                        break
+                    continue
+                sock.settimeout(None)
+                thread = threading.Thread(target=self._route, args=(sock,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            for connection in self._connections:
+                connection.close()
+            for process in self._processes:
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+            self.socket.close()
+            self._shut_down.set()
+
+    def _route(self, sock):
+        # noinspection PyBroadException
+        try:
+            head = peek_request_head(sock, self.head_timeout)
+            if not head:
+                return
+            index = self.worker_for(head)
+            with self._send_locks[index]:
+                reduction.send_handle(self._connections[index], sock.fileno(), self._processes[index].pid)
+        except Exception:
+            self._log.error('error routing connection', exc_info=True)
+        finally:
+            # the worker got its own descriptor
+            sock.close()
+
+    def _worker_main(self, index, connection):
+        # the listening socket and the pipe ends of the front process are not used by the workers
+        self.socket.close()
+        for other in self._connections:
+            other.close()
+        self._worker_stop = threading.Event()
+
+        server = self.server_class(None, *self.server_args)
+        # the connections are accepted by the front process, on its address
+        server.server_address = self.server_address
+        server.session_affinity = (index, self.workers)
+        session_reaper = getattr(server, 'session_reaper', None)
+        if session_reaper is not None:
+            session_reaper.start()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            while not self._worker_stop.is_set():
+                if not connection.poll(0.5):
+                    continue
+                try:
+                    fd = reduction.recv_handle(connection)
+                except EOFError:
+                    # the front process is shutting down
+                    break
+                sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+                os.close(fd)
+                server.accept_connection(sock)
+        finally:
+            server.shutdown()
+            for client in list(clients.values()):
+                client.on_close()
+
+    def shutdown(self):
+        if os.getpid() != self._parent_pid:
+            # App.close called in a worker, the front process notices the worker termination
+            if self._worker_stop is not None:
+                self._worker_stop.set()
+            return
+        self._shutdown_request.set()
+        if self._processes:
+            self._shut_down.wait()
@@ -0,0 +1,503 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   Session snapshots.
+   dumps(app) serializes the widget tree of a session (the root widget, the widgets
+   it references and the App attributes set by App.main) to a compact binary
+   format: class, identifier, attributes, style, children order and the other widget
+   fields, with the event listeners stored by name. loads(app, data) restores the tree
+   in another App instance, possibly in another process, without calling the widget
+   constructors nor App.main.
+   The listeners have to be methods of the App or of the widgets, or module level
+   functions. Values that cannot be stored (i.e. lambdas, threads, files) raise ValueError,
+   the App attributes included. The only classes that can be stored are the widgets and
+   the App classes.
+   Snapshots must come from a trusted source: loads imports the modules they name and
+   restores objects without calling their constructors.
+"""
+import collections
+import importlib
+import struct
+import sys
+
+from . import gui
+from .server import App
+
+_MAGIC = b'REMIS\x01'
+
+# value type codes
+_NONE = b'N'
+_TRUE = b'T'
+_FALSE = b'F'
+_INT = b'I'
+_FLOAT = b'D'
+_STR = b'S'
+_STR_REF = b'R'
+_BYTES = b'B'
+_LIST = b'L'
+_TUPLE = b'U'
+_DICT = b'M'
+_ORDERED_DICT = b'O'
+_TAG = b'W'
+_APP = b'A'
+_PAGE = b'P'
+_GLOBAL = b'G'
+_METHOD = b'X'
+_EVENT_DICT = b'E'
+_CONNECTOR = b'C'
+_TEMPLATE = b'Y'
+_NATIVE_STR = b'Z'
+
+# fields rebuilt at restore
+_SKIPPED_FIELDS = ('_registry', '_backup_repr', '_repr_attributes')
+
+pyLessThan3 = sys.version_info < (3,)
+_text_type = unicode if pyLessThan3 else str  # noqa: F821
+
+
+def _qualname(obj):
+    return getattr(obj, '__qualname__', obj.__name__)
+
+
+def _is_tag(value):
+    return isinstance(value, gui.Tag)
+
+
+_event_names_cache = {}
+
+
+def _event_names(cls):
+    """ Returns the names of the event methods of a class, they get a connector in each instance """
+    names = _event_names_cache.get(cls)
+    if names is None:
+        names = _event_names_cache[cls] = [name for name in dir(cls)
+                                           if getattr(getattr(cls, name, None), '__is_event', False)]
+    return names
+
+
+def _is_default_connector(connector):
+    return connector.callback is None and not connector.userdata and not connector.kwuserdata
+
+
+class _Writer(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.out = bytearray()
+        self.strings = {}
+        self.tags = []
+        self.tag_index = {}
+        # identifiers of the widget being stored and of its parent
+        self.ids = None
+        self.page_parts = {}
+        page = getattr(app, 'page', None)
+        if page is not None:
+            # the page, head and body are built for each session, they are referred by name
+            self.page_parts[id(page)] = 'page'
+            for name in ('head', 'body'):
+                if name in page.children:
+                    self.page_parts[id(page.children[name])] = name
+
+    def varint(self, n):
+        while True:
+            byte = n & 0x7f
+            n >>= 7
+            if n:
+                self.out.append(byte | 0x80)
+            else:
+                self.out.append(byte)
+                return
+
+    def string(self, s):
+        index = self.strings.get(s)
+        if index is not None:
+            self.out += _STR_REF
+            self.varint(index)
+            return
+        self.strings[s] = len(self.strings)
+        data = s.encode('utf-8')
+        self.out += _STR
+        self.varint(len(data))
+        self.out += data
+
+    def text(self, s):
+        """ Stores a string value. The event attributes and the parent reference contain the
+            identifiers of the widget and of its parent, they are replaced by markers in order
+            to share the same string among the widgets
+        """
+        if self.ids is not None and '\x00' not in s and '\x01' not in s:
+            template = s.replace(self.ids[0], '\x00')
+            if self.ids[1]:
+                template = template.replace(self.ids[1], '\x01')
+            if template != s:
+                self.out += _TEMPLATE
+                self.string(template)
+                return
+        self.string(s)
+
+    def add_tag(self, tag):
+        index = self.tag_index.get(id(tag))
+        if index is None:
+            index = self.tag_index[id(tag)] = len(self.tags)
+            self.tags.append(tag)
+        return index
+
+    def value(self, value, where):
+        if value is None:
+            self.out += _NONE
+        elif value is True:
+            self.out += _TRUE
+        elif value is False:
+            self.out += _FALSE
+        elif isinstance(value, (int, long) if pyLessThan3 else int):  # noqa: F821
+            self.out += _INT
+            self.varint(value * 2 if value >= 0 else -value * 2 - 1)
+        elif isinstance(value, float):
+            self.out += _FLOAT
+            self.out += struct.pack('>d', value)
+        elif isinstance(value, _text_type):
+            self.text(value)
+        elif isinstance(value, str):
+            # python 2 byte strings are restored as such, the gui does not mix them with unicode ones
+            self.out += _NATIVE_STR
+            self.text(value.decode('utf-8'))
+        elif isinstance(value, (bytes, bytearray)):
+            self.out += _BYTES
+            self.varint(len(value))
+            self.out += value
+        elif value is self.app:
+            self.out += _APP
+        elif id(value) in self.page_parts:
+            self.out += _PAGE
+            self.string(self.page_parts[id(value)])
+        elif _is_tag(value):
+            self.out += _TAG
+            self.varint(self.add_tag(value))
+        elif isinstance(value, gui._EventDictionary):
+            self.out += _EVENT_DICT
+            self.items(value, where)
+            onchange = value.__dict__.get('onchange')
+            if isinstance(onchange, gui.ClassEventConnector):
+                self.connector(onchange, where)
+            else:
+                self.out += _NONE
+        elif isinstance(value, gui.ClassEventConnector):
+            # the event of another object, its connector is stored with the object
+            self.out += _METHOD
+            self.value(value.event_source_instance, where)
+            self.string(value.event_name)
+        elif isinstance(value, collections.OrderedDict):
+            self.out += _ORDERED_DICT
+            self.items(value, where)
+        elif type(value) is dict:
+            self.out += _DICT
+            self.items(value, where)
+        elif type(value) in (list, tuple):
+            self.out += _LIST if type(value) is list else _TUPLE
+            self.varint(len(value))
+            for item in value:
+                self.value(item, where)
+        elif getattr(value, '__self__', None) is not None and hasattr(value, '__func__'):
+            # bound method, stored as owner and name
+            self.out += _METHOD
+            self.value(value.__self__, where)
+            self.string(value.__func__.__name__)
+        elif _importable(value):
+            name = _qualname(value)
+            if '<' in name:
+                raise ValueError('%s: %r cannot be stored in a snapshot' % (where, value))
+            self.out += _GLOBAL
+            self.string(value.__module__)
+            self.string(name)
+        else:
+            raise ValueError('%s: %r cannot be stored in a snapshot' % (where, value))
+
+    def items(self, mapping, where):
+        self.varint(len(mapping))
+        for key, item in mapping.items():
+            self.value(key, where)
+            self.value(item, where)
+
+    def connector(self, connector, where):
+        """ Stores an event connector of the object being stored, the listener by name """
+        self.out += _CONNECTOR
+        self.string(connector.event_name)
+        self.value(connector.callback, where)
+        self.value(tuple(connector.userdata), where)
+        self.value(connector.kwuserdata, where)
+
+    def dump(self, root, app_state):
+        self.value(root, 'root')
+        self.value(app_state, 'App')
+        # the widgets get appended to the table while their fields are stored
+        index = 0
+        while index < len(self.tags):
+            tag = self.tags[index]
+            where = '%s %s' % (type(tag).__name__, tag.identifier)
+            parent = tag.__dict__.get('_parent')
+            self.ids = (tag.identifier, parent.identifier if _is_tag(parent) else '')
+            self.string(self.ids[0])
+            self.string(self.ids[1])
+            # the connectors without listeners are created again at restore
+            fields = [(k, v) for k, v in tag.__dict__.items() if k not in _SKIPPED_FIELDS and not (
+                isinstance(v, gui.ClassEventConnector) and v.event_source_instance is tag and
+                v.event_name == k and _is_default_connector(v))]
+            self.varint(len(fields))
+            for key, value in fields:
+                self.string(key)
+                if isinstance(value, gui.ClassEventConnector) and value.event_source_instance is tag:
+                    self.connector(value, where)
+                else:
+                    self.value(value, where)
+            self.ids = None
+            index += 1
+        body = self.out
+        # the classes of the widgets precede the records, they are instantiated first
+        self.out = bytearray(_MAGIC)
+        self.strings = {}
+        self.varint(len(self.tags))
+        for tag in self.tags:
+            self.string(type(tag).__module__)
+            self.string(_qualname(type(tag)))
+        return bytes(self.out + body)
+
+
+def dumps(app):
+    """ Returns the snapshot of the widget tree of a session as bytes """
+    with app.update_lock:
+        # the other App attributes belong to the session (request, websockets, locks)
+        app_state = dict((name, app.__dict__[name]) for name in getattr(app, '_main_fields', ())
+                         if name in app.__dict__)
+        return _Writer(app).dump(app.root, app_state)
+
+
+class _Reader(object):
+
+    def __init__(self, app, data):
+        self.app = app
+        self.data = data
+        self.pos = 0
+        self.strings = []
+        self.tags = []
+        self.connectors = []
+        self.ids = None
+
+    def varint(self):
+        n = 0
+        shift = 0
+        data = self.data
+        while True:
+            byte = data[self.pos]
+            self.pos += 1
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    def code(self):
+        code = self.data[self.pos:self.pos + 1]
+        self.pos += 1
+        return code
+
+    def string(self):
+        code = self.code()
+        if code == _STR_REF:
+            return self.strings[self.varint()]
+        if code != _STR:
+            raise ValueError('invalid snapshot')
+        length = self.varint()
+        s = self.data[self.pos:self.pos + length].decode('utf-8')
+        self.pos += length
+        self.strings.append(s)
+        return s
+
+    def value(self):
+        code = self.code()
+        if code == _STR or code == _STR_REF:
+            self.pos -= 1
+            return self.string()
+        if code == _TEMPLATE:
+            return self.string().replace('\x01', self.ids[1]).replace('\x00', self.ids[0])
+        if code == _NATIVE_STR:
+            value = self.value()
+            return value.encode('utf-8') if pyLessThan3 else value
+        if code == _TAG:
+            return self.tags[self.varint()]
+        if code == _NONE:
+            return None
+        if code == _TRUE:
+            return True
+        if code == _FALSE:
+            return False
+        if code == _INT:
+            n = self.varint()
+            return n >> 1 if not n & 1 else -((n + 1) >> 1)
+        if code == _EVENT_DICT:
+            event_dict = gui._EventDictionary.__new__(gui._EventDictionary)
+            dict.update(event_dict, self.items(dict))
+            # the widgets get rendered again
+            event_dict.__version__ = 1
+            event_dict.__lastversion__ = 0
+            if self.code() == _CONNECTOR:
+                event_dict.onchange = self.connector(event_dict)
+            return event_dict
+        if code == _METHOD:
+            owner = self.value()
+            return _LateMethod(owner, self.string())
+        if code == _APP:
+            return self.app
+        if code == _PAGE:
+            name = self.string()
+            return self.app.page if name == 'page' else self.app.page.children[name]
+        if code == _DICT:
+            return self.items(dict)
+        if code == _ORDERED_DICT:
+            return self.items(collections.OrderedDict)
+        if code == _LIST or code == _TUPLE:
+            items = [self.value() for _ in range(self.varint())]
+            return items if code == _LIST else tuple(items)
+        if code == _FLOAT:
+            value = struct.unpack('>d', bytes(self.data[self.pos:self.pos + 8]))[0]
+            self.pos += 8
+            return value
+        if code == _BYTES:
+            length = self.varint()
+            value = bytes(self.data[self.pos:self.pos + length])
+            self.pos += length
+            return value
+        if code == _GLOBAL:
+            return _import(self.string(), self.string())
+        raise ValueError('invalid snapshot')
+
+    def items(self, mapping_type):
+        mapping = mapping_type()
+        for _ in range(self.varint()):
+            key = self.value()
+            mapping[key] = self.value()
+        return mapping
+
+    def connector(self, source, event_name=None):
+        """ Rebuilds an event connector of source, without running the event setup of the constructors.
+            The listener is read from the snapshot, unless event_name is given.
+        """
+        read = event_name is None
+        if read:
+            event_name = self.string()
+        method = getattr(type(source), event_name)
+        connector = gui.ClassEventConnector(source, event_name, method.__get__(source, type(source)))
+        if hasattr(method, '_event_info'):
+            connector._event_info = method._event_info
+        if read:
+            connector.callback = self.value()
+            connector.userdata = self.value()
+            connector.kwuserdata = self.value()
+            self.connectors.append(connector)
+        return connector
+
+    def load(self):
+        if bytes(self.data[:len(_MAGIC)]) != _MAGIC:
+            raise ValueError('invalid snapshot')
+        self.pos = len(_MAGIC)
+        # the widget instances are created upfront without calling their constructors,
+        # the records refer to each other
+        classes = [_import(self.string(), self.string(), widget=True) for _ in range(self.varint())]
+        self.tags = [cls.__new__(cls) for cls in classes]
+        self.strings = []
+        root = self.value()
+        app_state = self.value()
+        registry = self.app.runtime_instances
+        for tag in self.tags:
+            fields = tag.__dict__
+            self.ids = (self.string(), self.string())
+            for _ in range(self.varint()):
+                key = self.string()
+                if self.code() == _CONNECTOR:
+                    fields[key] = self.connector(tag)
+                else:
+                    self.pos -= 1
+                    fields[key] = self.value()
+            for event_name in _event_names(type(tag)):
+                if event_name not in fields:
+                    fields[event_name] = self.connector(tag, event_name)
+            tag._registry = registry
+            tag._backup_repr = ''
+        for connector in self.connectors:
+            if isinstance(connector.callback, _LateMethod):
+                connector.callback = connector.callback.resolve()
+            connector.userdata = _resolve(connector.userdata)
+            connector.kwuserdata = _resolve(connector.kwuserdata)
+        for tag in self.tags:
+            for key, value in tag.__dict__.items():
+                if isinstance(value, (_LateMethod, list, tuple, dict)):
+                    tag.__dict__[key] = _resolve(value)
+            tag._update_repr_attributes()
+            registry[tag.identifier] = tag
+        return root, _resolve(app_state)
+
+
+class _LateMethod(object):
+    """ A listener read from a snapshot, resolved once all the widgets are restored """
+
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def resolve(self):
+        return getattr(self.owner, self.name)
+
+
+def _resolve(value):
+    if isinstance(value, _LateMethod):
+        return value.resolve()
+    if type(value) is list:
+        return [_resolve(item) for item in value]
+    if type(value) is tuple:
+        return tuple(_resolve(item) for item in value)
+    if type(value) is dict:
+        return dict((k, _resolve(v)) for k, v in value.items())
+    return value
+
+
+def _importable(value):
+    """ Returns True for the values stored by name: widget and App classes, functions """
+    if isinstance(value, type):
+        return issubclass(value, (gui.Tag, App))
+    return type(value).__name__ == 'function'
+
+
+def _import(module, qualname, widget=False):
+    """ Returns the class or the function named by a snapshot, a widget class if widget is True.
+        Anything else raises ValueError.
+    """
+    obj = importlib.import_module(module)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name, None)
+    if widget and not (isinstance(obj, type) and issubclass(obj, gui.Tag)) or not _importable(obj):
+        raise ValueError('invalid snapshot: %s.%s cannot be restored' % (module, qualname))
+    return obj
+
+
+def loads(app, data):
+    """ Restores the widget tree of a snapshot as the root widget of app.
+        The App attributes set by main() are restored as well.
+    """
+    with app.update_lock:
+        root, app_state = _Reader(app, bytearray(data)).load()
+        app.__dict__.update(app_state)
+        app._main_fields = list(app_state)
+        # as returned by main(), the root gets parented by set_root_widget
+        root._parent = None
+        app.set_root_widget(root)
+        return root
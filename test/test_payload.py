@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Wire payload budgets.
+An App gets driven in-process through the websocket callback path, and the bytes
+of the messages sent to the client by each interaction are compared with the
+budgets stored in payload_budgets.json. Run this file directly to print the report
+of the bytes by widget class, or with --update to store the current sizes as budgets.
+"""
+
+import unittest
+import os.path
+import json
+import sys
+import remi.gui as gui
+import remi.server as server
+from remi.headless import AppDriver, parse_updates
+
+BUDGETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payload_budgets.json')
+# the budgets get stored with some headroom, the widget identifiers have no fixed length
+BUDGET_HEADROOM = 1.1
+
+
+class PayloadRecorder(object):
+    """ Dispatches the callbacks of the interactions as a client would,
+        and accounts the bytes of the messages that follow by widget class
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        # the interaction name -> {widget class or message kind: bytes}
+        self.report = {}
+
+    def interact(self, name, widget, function_name, **params):
+        self.driver.take_messages()
+        self.driver.dispatch(widget, function_name, **params)
+        # the changes made with the refresh disabled are accounted to the interaction too
+        self.driver.update(force=True)
+        sizes = {}
+        for message in self.driver.take_messages():
+            for key, size in self.classify(message):
+                sizes[key] = sizes.get(key, 0) + size
+        sizes['total'] = sum(sizes.values())
+        self.report[name] = sizes
+        return sizes
+
+    def classify(self, message):
+        """ Returns the (widget class or message kind, bytes) parts of a message """
+        kind = message[0]
+        if kind == server._MSG_UPDATE_BATCH:
+            parts = [(self.widget_class(identifier), len(json.dumps([identifier, html], ensure_ascii=False,
+                                                                     separators=(',', ':')).encode('utf-8')))
+                     for identifier, html in parse_updates([message])]
+            parts.append(('batch', len(message.encode('utf-8')) - sum(size for _, size in parts)))
+            return parts
+        if kind == server._MSG_UPDATE:
+            identifier = parse_updates([message])[0][0]
+            return [(self.widget_class(identifier), len(message.encode('utf-8')))]
+        names = {server._MSG_ACK: 'ack', server._MSG_JS: 'javascript', server._MSG_SHOW: 'show'}
+        return [(names.get(kind, 'other'), len(message.encode('utf-8')))]
+
+    def widget_class(self, identifier):
+        try:
+            return type(self.driver.get_widget(identifier)).__name__
+        except KeyError:
+            return 'unknown'
+
+
+class PayloadApp(server.App):
+    def main(self):
+        self.label = gui.Label('clicked 0 times')
+        self.button = gui.Button('click')
+        self.button.onclick.do(self.on_click)
+        self.text_input = gui.TextInput(hint='type here')
+        self.table = gui.TableWidget(10, 3)
+        self.add_row = gui.Button('add row')
+        self.add_row.onclick.do(self.on_add_row)
+        self.svg = gui.Svg(width=200, height=100)
+        self.polyline = gui.SvgPolyline(_maxlen=100)
+        for i in range(50):
+            self.polyline.add_coord(i, i % 10)
+        self.svg.append(self.polyline)
+        self.add_point = gui.Button('add point')
+        self.add_point.onclick.do(self.on_add_point)
+        self.clicks = 0
+        return gui.VBox(children=[self.label, self.button, self.text_input, self.table, self.add_row,
+                                  self.svg, self.add_point])
+
+    def on_click(self, emitter):
+        self.clicks += 1
+        self.label.set_text('clicked %d times' % self.clicks)
+
+    def on_add_row(self, emitter):
+        self.table.set_row_count(self.table.row_count + 1)
+
+    def on_add_point(self, emitter):
+        count = len(self.polyline.coordsX)
+        self.polyline.add_coord(count, count % 10)
+
+    def log_message(self, *args):
+        pass
+
+
+def record_interactions():
+    """ Runs the interactions on a new PayloadApp session, returns the PayloadRecorder report """
+    with AppDriver(PayloadApp) as driver:
+        app = driver.app
+        recorder = PayloadRecorder(driver)
+        recorder.interact('button_click', app.button, 'onclick')
+        recorder.interact('text_input_change', app.text_input, 'onchange', new_value='typed text')
+        recorder.interact('table_add_row', app.add_row, 'onclick')
+        recorder.interact('svg_add_point', app.add_point, 'onclick')
+    return recorder.report
+
+
+def format_report(report, budgets=None):
+    budgets = budgets or {}
+    lines = []
+    for name in sorted(report):
+        sizes = report[name]
+        lines.append('%-20s %6d bytes (budget %s): %s' % (
+            name, sizes['total'], budgets.get(name, '-'),
+            ', '.join('%s %d' % (key, size) for key, size in sorted(sizes.items()) if key != 'total')))
+    return '\n'.join(lines)
+
+
+def load_budgets():
+    with open(BUDGETS_FILE) as f:
+        return json.load(f)
+
+
+class TestPayloadBudget(unittest.TestCase):
+    def test_budgets(self):
+        budgets = load_budgets()
+        report = record_interactions()
+        self.assertEqual(sorted(report), sorted(budgets))
+        exceeded = [name for name in report if report[name]['total'] > budgets[name]]
+        self.assertEqual(exceeded, [], 'payload budgets exceeded:\n' + format_report(report, budgets))
+
+    def test_breakdown(self):
+        report = record_interactions()
+        # the click updates only the label
+        self.assertEqual(sorted(report['button_click']), ['Label', 'ack', 'total'])
+        self.assertEqual(sorted(report['text_input_change']), ['TextInput', 'ack', 'total'])
+        self.assertIn('TableWidget', report['table_add_row'])
+        self.assertIn('SvgPolyline', report['svg_add_point'])
+        self.assertNotIn('Svg', report['svg_add_point'])
+
+
+if __name__ == '__main__':
+    if '--update' in sys.argv:
+        report = record_interactions()
+        with open(BUDGETS_FILE, 'w') as f:
+            json.dump(dict((name, int(sizes['total'] * BUDGET_HEADROOM)) for name, sizes in report.items()),
+                      f, indent=2, sort_keys=True)
+            f.write('\n')
+    budgets = load_budgets() if os.path.exists(BUDGETS_FILE) else {}
+    print(format_report(record_interactions(), budgets))
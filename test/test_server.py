@@ -0,0 +1,1731 @@
+#!/usr/bin/env python
+
+import unittest
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+import os.path
+import io
+import json
+import shutil
+import tempfile
+import remi.gui as gui
+import remi.server as server
+from remi.headless import HeadlessWebSocket
+try:
+    from mock_server_and_request import MockServer, MockRequest
+except ValueError:
+    from .mock_server_and_request import MockServer, MockRequest
+
+examples_dir = os.path.realpath(os.path.join(os.path.abspath(\
+                                os.path.dirname(__file__)), '../examples'))
+sys.path.append(examples_dir)
+
+
+def http_get(address, path='/', headers='', version='HTTP/1.1'):
+    s = socket.create_connection(address)
+    s.settimeout(5)
+    s.sendall(('GET %s %s\r\nHost: localhost\r\nConnection: close\r\n%s\r\n' % (path, version, headers)).encode('utf-8'))
+    data = b''
+    while True:
+        chunk = s.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    s.close()
+    return data
+
+
+def session_cookie(response):
+    """ Returns the header sending back the session cookie set by response """
+    session = response.split(b'remi_session=')[1].split(b';')[0]
+    return 'Cookie: remi_session=%s\r\n' % session.decode('ascii')
+
+
+def client_frame(payload, opcode=0x1, fin=True, mask=b'\x11\x22\x33\x44'):
+    header = bytearray([(0x80 if fin else 0) | opcode])
+    length = len(payload)
+    if length <= 125:
+        header.append(0x80 | length)
+    elif length <= 65535:
+        header.append(0x80 | 126)
+        header += struct.pack('>H', length)
+    else:
+        header.append(0x80 | 127)
+        header += struct.pack('>Q', length)
+    # bytearray items are ints on Python 2 too
+    mask_bytes = bytearray(mask)
+    masked = bytearray(b ^ mask_bytes[i % 4] for i, b in enumerate(bytearray(payload)))
+    return bytes(header) + mask + bytes(masked)
+
+
+class TestWebSocketFrameDecoder(unittest.TestCase):
+    def test_unmask(self):
+        mask = b'\x01\x02\x03\x04'
+        payload = b'callback/123/onclick/'
+        masked = server.websocket_unmask(payload, mask)
+        self.assertNotEqual(masked, payload)
+        self.assertEqual(server.websocket_unmask(masked, mask), payload)
+        self.assertEqual(server.websocket_unmask(b'', mask), b'')
+
+    def test_lengths(self):
+        for size in (0, 125, 126, 65535, 65536, 200000):
+            payload = (b'0123456789' * (size // 10 + 1))[:size]
+            decoder = server.WebSocketFrameDecoder()
+            decoder.feed(client_frame(payload))
+            self.assertEqual(decoder.next_message(), (0x1, payload))
+            self.assertIsNone(decoder.next_message())
+
+    def test_partial_feed(self):
+        data = client_frame(b'hello') + client_frame(b'world')
+        decoder = server.WebSocketFrameDecoder()
+        messages = []
+        for i in range(len(data)):
+            decoder.feed(data[i:i + 1])
+            message = decoder.next_message()
+            if message is not None:
+                messages.append(message)
+        self.assertEqual(messages, [(0x1, b'hello'), (0x1, b'world')])
+
+    def test_fragments_and_control_frames(self):
+        decoder = server.WebSocketFrameDecoder()
+        decoder.feed(client_frame(b'first ', fin=False))
+        decoder.feed(client_frame(b'ping', opcode=0x9))
+        decoder.feed(client_frame(b'second ', opcode=0x0, fin=False))
+        decoder.feed(client_frame(b'third', opcode=0x0))
+        decoder.feed(client_frame(b'', opcode=0x8))
+        self.assertEqual(decoder.next_message(), (0x9, b'ping'))
+        self.assertEqual(decoder.next_message(), (0x1, b'first second third'))
+        self.assertEqual(decoder.next_message(), (0x8, b''))
+        self.assertIsNone(decoder.next_message())
+
+
+class TestCallbackMessages(unittest.TestCase):
+    def test_parse_parametrs(self):
+        self.assertEqual(server.parse_parametrs("10|par1='asd'|6|par2=1"), {'par1': "'asd'", 'par2': '1'})
+        self.assertEqual(server.parse_parametrs(""), {})
+        # field lengths are utf-8 byte lengths, as computed by the client
+        self.assertEqual(server.parse_parametrs(u"10|value=\u00e8\u00e0|3|b=2"), {'value': u'\u00e8\u00e0', 'b': '2'})
+
+    def test_legacy_callback(self):
+        self.assertEqual(server.parse_callback_message("callback/123/onchange/9|value=a/b"),
+                         ('123', 'onchange', {'value': 'a/b'}))
+        self.assertEqual(server.parse_callback_message("callback/123/onclick/"), ('123', 'onclick', {}))
+        self.assertIsNone(server.parse_callback_message("connected"))
+
+    def test_json_callback(self):
+        message = '{"id": "123", "fn": "onmousedown", "params": {"x": 10, "y": 2.5, "ok": true, "text": "a|b=c"}}'
+        self.assertEqual(server.parse_callback_message(message),
+                         ('123', 'onmousedown', {'x': '10', 'y': '2.5', 'ok': 'true', 'text': 'a|b=c'}))
+        self.assertEqual(server.parse_callback_message('{"id": "123", "fn": "onclick", "params": null}'),
+                         ('123', 'onclick', {}))
+
+
+class TestWebSocketDeflate(unittest.TestCase):
+    settings = {'level': 6, 'window_bits': 15, 'threshold': 100}
+
+    def test_negotiate(self):
+        deflate, response = server.WebSocketDeflate.negotiate(
+            'permessage-deflate; client_max_window_bits', self.settings)
+        self.assertTrue(deflate.context_takeover)
+        self.assertEqual(response, 'permessage-deflate')
+        deflate, response = server.WebSocketDeflate.negotiate(
+            'x-webkit-deflate-frame, permessage-deflate; server_max_window_bits=10; server_no_context_takeover',
+            self.settings)
+        self.assertEqual(deflate.window_bits, 10)
+        self.assertFalse(deflate.context_takeover)
+        self.assertEqual(response, 'permessage-deflate; server_no_context_takeover; server_max_window_bits=10')
+        # a window smaller than the compressor supports gets declined, the next offer is accepted
+        deflate, response = server.WebSocketDeflate.negotiate(
+            'permessage-deflate; server_max_window_bits=8, permessage-deflate; server_max_window_bits=9',
+            self.settings)
+        self.assertEqual(deflate.window_bits, 9)
+        self.assertEqual(response, 'permessage-deflate; server_max_window_bits=9')
+        self.assertEqual(server.WebSocketDeflate.negotiate('permessage-deflate; server_max_window_bits=8',
+                                                           self.settings), (None, None))
+        # the offers with unknown parameters get declined
+        deflate, response = server.WebSocketDeflate.negotiate(
+            'permessage-deflate; x-custom=1, permessage-deflate; server_max_window_bits=12', self.settings)
+        self.assertEqual(response, 'permessage-deflate; server_max_window_bits=12')
+        self.assertEqual(server.WebSocketDeflate.negotiate('permessage-deflate; mux', self.settings), (None, None))
+        self.assertEqual(server.WebSocketDeflate.negotiate('permessage-deflate', None), (None, None))
+        self.assertEqual(server.WebSocketDeflate.negotiate(None, self.settings), (None, None))
+
+    def test_context_takeover(self):
+        deflate = server.WebSocketDeflate(6, 15, 0)
+        client = zlib.decompressobj(-15)
+        message = b'<div id="1" class="Widget" style="margin:0px">some repetitive markup</div>' * 5
+        first = deflate.compress(message)
+        second = deflate.compress(message)
+        # the second message refers to the window of the first one
+        self.assertLess(len(second), len(first))
+        for compressed in (first, second):
+            self.assertEqual(client.decompress(compressed + b'\x00\x00\xff\xff'), message)
+
+    def test_compressed_client_message(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        data = compressor.compress(b'callback/1/onclick/') + compressor.flush(zlib.Z_SYNC_FLUSH)
+        frame = bytearray(client_frame(data[:-4]))
+        frame[0] |= 0x40
+        decoder = server.WebSocketFrameDecoder()
+        decoder.feed(bytes(frame))
+        self.assertRaises(ValueError, decoder.next_message)
+        decoder = server.WebSocketFrameDecoder()
+        decoder.deflate = server.WebSocketDeflate(6, 15, 0)
+        decoder.feed(bytes(frame))
+        self.assertEqual(decoder.next_message(), (0x1, b'callback/1/onclick/'))
+
+    def test_inflate_limit(self):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        data = compressor.compress(b'\x00' * 100001) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        frame = bytearray(client_frame(data[:-4]))
+        frame[0] |= 0x40
+        decoder = server.WebSocketFrameDecoder()
+        decoder.deflate = server.WebSocketDeflate(6, 15, 0)
+        decoder.deflate.max_message_size = 100000
+        decoder.feed(bytes(frame))
+        # the message is not inflated beyond the limit, the connection gets closed with 1009
+        self.assertEqual(decoder.next_message(), (0x8, b'\x03\xf1'))
+
+    def test_send_threshold(self):
+        sock = ShortWriteSocket()
+        handler = FrameWriterHandler(sock)
+        handler._decoder.deflate = server.WebSocketDeflate(6, 15, 100)
+        handler.send_frame(b'3')
+        self.assertEqual(sock.data, b'\x81\x013')
+        sock.data = b''
+        handler.send_frame(b'a' * 1000)
+        self.assertEqual(bytearray(sock.data)[0], 0xc1)
+        self.assertLess(len(sock.data), 100)
+
+
+class ShortWriteSocket(object):
+    """ Socket accepting at most max_write bytes per call """
+    def __init__(self, max_write=1000):
+        self.max_write = max_write
+        self.data = b''
+
+    def sendall(self, data):
+        self.data += bytes(data)
+
+    def sendmsg(self, buffers):
+        data = b''.join(memoryview(b).tobytes() for b in buffers)[:self.max_write]
+        self.data += data
+        return len(data)
+
+
+class FrameWriterHandler(server.WebSocketsHandler):
+    """ WebSocketsHandler writing frames to sock, without handshake """
+    def __init__(self, sock):
+        self._send_lock = threading.Lock()
+        self._decoder = server.WebSocketFrameDecoder()
+        self.request = sock
+
+
+class TestWebSocketFrameWriter(unittest.TestCase):
+    def make_handler(self, sock):
+        return FrameWriterHandler(sock)
+
+    def test_frame_header(self):
+        self.assertEqual(server.websocket_frame_header(5), b'\x81\x05')
+        self.assertEqual(server.websocket_frame_header(300), b'\x81\x7e\x01\x2c')
+        self.assertEqual(server.websocket_frame_header(70000, 0x2), b'\x82\x7f' + struct.pack('>Q', 70000))
+
+    def test_short_writes(self):
+        for size in (10, 5000, 100000):
+            sock = ShortWriteSocket()
+            payload = (b'abcdefg' * (size // 7 + 1))[:size]
+            self.make_handler(sock).send_frame(payload)
+            self.assertEqual(sock.data, server.websocket_frame_header(size) + payload)
+
+
+class UpdateApp(server.App):
+    def main(self):
+        self.labels = [gui.Label('label %d' % i) for i in range(3)]
+        return gui.VBox(children=self.labels)
+
+    def log_request(self, *args):
+        pass
+
+
+class TestGuiUpdate(unittest.TestCase):
+    def setUp(self):
+        # a new session is required to get the page built by UpdateApp
+        server.clients.clear()
+        self.app = UpdateApp(MockRequest(), ('0.0.0.0', 8888), MockServer())
+        # updates are collected and sent by the idle loop
+        self.app.update_interval = 1
+        self.ws_v1 = HeadlessWebSocket(self.app, 1)
+        self.ws_v2 = HeadlessWebSocket(self.app, 2)
+        self.app.websockets.update((self.ws_v1, self.ws_v2))
+
+    def tearDown(self):
+        self.app.websockets.clear()
+        self.app.on_close()
+
+    def flush(self):
+        self.ws_v1.flush()
+        self.ws_v2.flush()
+
+    def test_batch_update(self):
+        for i, label in enumerate(self.app.root.children.values()):
+            label.set_text(u'new text \u00e8 %d' % i)
+        self.app.do_gui_update()
+        self.flush()
+        self.assertEqual(len(self.ws_v2.messages), 1)
+        message = self.ws_v2.messages[0]
+        self.assertEqual(message[0], '4')
+        updates = json.loads(message[1:])
+        self.assertEqual(len(updates), 3)
+        for identifier, html in updates:
+            self.assertIn(identifier, html)
+            self.assertIn(u'new text \u00e8', html)
+        # legacy clients get a message for each widget
+        self.assertEqual(len(self.ws_v1.messages), 3)
+        for message in self.ws_v1.messages:
+            self.assertEqual(message[0], '1')
+            self.assertIn('%C3%A8', message)
+
+    def test_single_update(self):
+        list(self.app.root.children.values())[0].set_text('changed')
+        self.app.do_gui_update()
+        self.flush()
+        self.assertEqual(len(self.ws_v2.messages), 1)
+        self.assertEqual(self.ws_v2.messages[0][0], '1')
+        self.assertIn('>changed<', self.ws_v2.messages[0])
+
+    def test_render_does_not_wait_for_writer(self):
+        label = list(self.app.root.children.values())[0]
+        for i in range(5):
+            label.set_text('text %d' % i)
+            self.app.do_gui_update()
+        list(self.app.root.children.values())[1].set_text('other')
+        self.app.do_gui_update()
+        self.app.execute_javascript('console.log(1)')
+        self.assertEqual(self.ws_v2.messages, [])
+        self.flush()
+        # only the latest render of a widget gets sent, the consecutive updates are written together
+        self.assertEqual(len(self.ws_v2.messages), 2)
+        self.assertEqual(self.ws_v2.messages[0][0], '4')
+        updates = json.loads(self.ws_v2.messages[0][1:])
+        self.assertEqual(len(updates), 2)
+        self.assertIn('>text 4<', updates[0][1])
+        self.assertEqual(self.ws_v2.messages[1], '2console.log(1)')
+        self.assertEqual(len(self.ws_v1.messages), 3)
+
+    def test_ancestor_update(self):
+        label = list(self.app.root.children.values())[0]
+        label.set_text('changed')
+        self.app.do_gui_update()
+        self.app.root.style['color'] = 'red'
+        self.app.do_gui_update()
+        self.flush()
+        # the update of the container includes the label
+        self.assertEqual(len(self.ws_v2.messages), 1)
+        self.assertTrue(self.ws_v2.messages[0].startswith('1' + self.app.root.identifier + ','))
+        self.assertIn('>changed<', self.ws_v2.messages[0])
+
+
+class TestRuntimeRegistry(unittest.TestCase):
+    def setUp(self):
+        server.clients.clear()
+        self.app = UpdateApp(MockRequest(), ('0.0.0.0', 8888), MockServer())
+
+    def tearDown(self):
+        self.app.on_close()
+        server.clients.clear()
+
+    def test_session_registry(self):
+        label = self.app.labels[0]
+        self.assertIs(self.app.runtime_instances[label.identifier], label)
+        self.assertNotIn(label.identifier, server.runtimeInstances)
+        self.assertIs(self.app.get_widget(label.identifier), label)
+        # the widgets created outside of a session are in the global registry
+        orphan = gui.Label('orphan')
+        self.assertIn(orphan.identifier, server.runtimeInstances)
+        self.assertIs(self.app.get_widget(orphan.identifier), orphan)
+        self.assertRaises(KeyError, self.app.get_widget, 'missing')
+        with server.runtime_registry(self.app.runtime_instances):
+            widget = gui.Label('session')
+            widget.identifier = 'custom_id'
+            self.assertIs(server.get_method_by_id(label.identifier), label)
+        self.assertIs(self.app.runtime_instances['custom_id'], widget)
+        self.assertNotIn('custom_id', server.runtimeInstances)
+        self.assertIsNone(server.get_method_by_id(label.identifier))
+
+
+class SnapshotApp(server.App):
+    main_calls = 0
+
+    def main(self):
+        SnapshotApp.main_calls += 1
+        self.presses = 0
+        self.label = gui.Label('not pressed')
+        self.button = gui.Button('press')
+        self.button.onclick.do(self.on_press, 'once', js_stop_propagation=True)
+        self.text = gui.TextInput()
+        self.text.onchange.do(self.on_text_change)
+        return gui.VBox(children=[self.label, self.button, self.text], style={'width': '100px'})
+
+    def on_press(self, emitter, times):
+        self.presses += 1
+        self.label.set_text('pressed %s' % times)
+
+    def on_text_change(self, emitter, value):
+        self.label.set_text(value)
+
+    def log_request(self, *args):
+        pass
+
+
+class TimerSnapshotApp(SnapshotApp):
+    def main(self):
+        root = SnapshotApp.main(self)
+        self.timer = threading.Timer(60, lambda: None)
+        self.timer.start()
+        return root
+
+    def on_close(self):
+        self.timer.cancel()
+        SnapshotApp.on_close(self)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        server.clients.clear()
+        self.app = SnapshotApp(MockRequest(), ('0.0.0.0', 8888), MockServer())
+        server.clients.clear()
+        self.restored = SnapshotApp(MockRequest(), ('0.0.0.0', 8888), MockServer())
+
+    def tearDown(self):
+        self.app.on_close()
+        self.restored.on_close()
+        server.clients.clear()
+
+    def tree(self, app, widget=None):
+        """ Returns what gets rendered of a widget tree, the attributes and the style
+            regardless of their order (not kept by the python 2 dictionaries)
+        """
+        if widget is None:
+            widget = app.root
+            self.assertTrue(widget.repr())
+        attributes = sorted((name, value.replace(str(id(app)), 'APP')) for name, value in widget.attributes.items())
+        children = [self.tree(app, widget.children[key]) if isinstance(widget.children[key], gui.Tag)
+                    else widget.children[key] for key in widget._render_children_list]
+        return type(widget), attributes, sorted(widget.style.items()), children
+
+    def test_restore(self):
+        from remi import snapshot
+        self.app.label.set_text(u'changed \u00e8')
+        data = snapshot.dumps(self.app)
+        self.assertTrue(len(data) < len(self.app.root.repr()) * 2)
+        calls = SnapshotApp.main_calls
+        root = snapshot.loads(self.restored, data)
+        self.assertEqual(SnapshotApp.main_calls, calls)
+        self.assertIs(self.restored.root, root)
+        self.assertEqual(self.tree(self.restored), self.tree(self.app))
+        # the restored widgets belong to the new session and are wired to it
+        label = self.restored.label
+        self.assertIsNot(label, self.app.label)
+        self.assertIs(self.restored.get_widget(label.identifier), label)
+        self.assertIs(label.get_parent(), root)
+        self.restored.get_widget(self.restored.button.identifier).onclick()
+        self.assertEqual(label.get_text(), 'pressed once')
+        # the App attributes set by main() are restored too
+        self.assertEqual(self.restored.presses, 1)
+        self.assertEqual(self.app.presses, 0)
+        self.assertEqual(self.app.label.get_text(), u'changed \u00e8')
+        self.restored.text.onchange('typed')
+        self.assertEqual(label.get_text(), 'typed')
+        updates = []
+        self.restored.do_gui_update = lambda: updates.append(True)
+        root.style['width'] = '200px'
+        self.assertEqual(len(updates), 1)
+        # the widgets created later do not reuse the identifiers of the restored ones
+        self.assertNotIn(gui.Label('new').identifier, [label.identifier for label in (label, root)])
+
+    def test_unsupported(self):
+        from remi import snapshot
+        self.app.button.onclick.do(lambda emitter: None)
+        self.assertRaises(ValueError, snapshot.dumps, self.app)
+        self.app.button.onclick.do(self.app.on_press, 'once')
+        snapshot.dumps(self.app)
+        self.app.presses = threading.Lock()
+        self.assertRaises(ValueError, snapshot.dumps, self.app)
+        # the only classes stored are the widgets and the App classes
+        self.app.presses = dict
+        self.assertRaises(ValueError, snapshot.dumps, self.app)
+
+    def test_restricted_import(self):
+        from remi import snapshot
+        self.assertIs(snapshot._import('remi.gui', 'Label', widget=True), gui.Label)
+        self.assertIs(snapshot._import(__name__, 'SnapshotApp'), SnapshotApp)
+        self.assertIs(snapshot._import('remi.server', 'gzip_encode'), server.gzip_encode)
+        self.assertRaises(ValueError, snapshot._import, 'remi.server', 'App', widget=True)
+        self.assertRaises(ValueError, snapshot._import, 'remi.server', 'gzip_encode', widget=True)
+        self.assertRaises(ValueError, snapshot._import, 'os', 'system')
+        self.assertRaises(ValueError, snapshot._import, 'subprocess', 'Popen')
+        self.assertRaises(ValueError, snapshot._import, 'remi.server', 'missing')
+
+    def new_sessions(self, app_class, mock_server):
+        app_class.restore_new_sessions = True
+        try:
+            calls = SnapshotApp.main_calls
+            server.clients.clear()
+            app = app_class(MockRequest(), ('0.0.0.0', 8888), mock_server)
+            server.clients.clear()
+            other = app_class(MockRequest(), ('0.0.0.0', 8888), mock_server)
+        finally:
+            del app_class.restore_new_sessions
+        self.addCleanup(app.on_close)
+        self.addCleanup(other.on_close)
+        return app, other, SnapshotApp.main_calls - calls
+
+    def test_restore_new_sessions(self):
+        mock_server = MockServer()
+        mock_server.session_snapshots = {}
+        app, other, main_calls = self.new_sessions(SnapshotApp, mock_server)
+        self.assertEqual(main_calls, 1)
+        self.assertEqual(self.tree(other), self.tree(app))
+        other.button.onclick()
+        self.assertEqual(other.label.get_text(), 'pressed once')
+        self.assertEqual(app.label.get_text(), 'not pressed')
+        self.assertEqual((app.presses, other.presses), (0, 1))
+        # the snapshot belongs to the server, the App class is not changed
+        self.assertEqual(list(mock_server.session_snapshots), [SnapshotApp])
+        self.assertNotIn('restore_new_sessions', SnapshotApp.__dict__)
+
+    def test_restore_fallback(self):
+        mock_server = MockServer()
+        mock_server.session_snapshots = {}
+        # the threads started by main() would not run for the restored sessions
+        app, other, main_calls = self.new_sessions(TimerSnapshotApp, mock_server)
+        self.assertEqual(main_calls, 2)
+        self.assertIsNot(other.timer, app.timer)
+        self.assertEqual(mock_server.session_snapshots, {TimerSnapshotApp: None})
+        # restore_new_sessions is not changed on the class
+        self.assertNotIn('restore_new_sessions', TimerSnapshotApp.__dict__)
+        self.assertFalse(TimerSnapshotApp.restore_new_sessions)
+        app.on_close()
+        other.on_close()
+
+
+class TestWebSocketSendQueue(unittest.TestCase):
+    def test_groups(self):
+        queue = server.WebSocketSendQueue(10)
+        queue.put_message('3')
+        queue.put_updates([('1', 'a'), ('2', 'b')])
+        queue.put_updates([('3', 'c')])
+        queue.put_message('2js')
+        self.assertEqual(queue.get(), [(None, '3')])
+        self.assertEqual(queue.get(), [('1', 'a'), ('2', 'b'), ('3', 'c')])
+        self.assertEqual(queue.get(), [(None, '2js')])
+        self.assertEqual(queue.get(block=False), [])
+        queue.close()
+        self.assertIsNone(queue.get())
+
+    def test_drop_superseded(self):
+        queue = server.WebSocketSendQueue(3)
+        self.assertTrue(queue.put_updates([('1', 'a'), ('2', 'b')]))
+        self.assertTrue(queue.put_message('3'))
+        # the queue is full, the pending update of the same widget gets dropped
+        self.assertTrue(queue.put_updates([('1', 'A')]))
+        self.assertEqual(list(queue._entries), [('2', 'b'), (None, '3'), ('1', 'A')])
+        self.assertFalse(queue.put_updates([('4', 'd')]))
+
+    def test_descendants_superseded(self):
+        queue = server.WebSocketSendQueue(10)
+        queue.put_updates([('child', 'a'), ('other', 'b')], {'child': set(['parent', 'root']), 'other': set(['root'])})
+        queue.put_message('2js')
+        queue.put_updates([('parent', 'c')], {'parent': set(['root'])})
+        self.assertEqual(list(queue._entries), [('other', 'b'), (None, '2js'), ('parent', 'c')])
+        queue.put_message('0root,page', replaces_updates=True)
+        self.assertEqual(list(queue._entries), [(None, '2js'), (None, '0root,page')])
+
+    def test_disconnect_policy_keeps_updates(self):
+        queue = server.WebSocketSendQueue(10, 'disconnect')
+        queue.put_updates([('1', 'a')])
+        queue.put_updates([('1', 'b')])
+        self.assertEqual(queue.get(), [('1', 'a'), ('1', 'b')])
+
+    def test_disconnect(self):
+        ws = HeadlessWebSocket(queue_length=2, policy='disconnect')
+        ws.send_updates([('1', 'a')])
+        ws.send_updates([('1', 'b')])
+        self.assertFalse(ws.aborted)
+        ws.send_updates([('1', 'c')])
+        self.assertTrue(ws.aborted)
+        self.assertTrue(ws.send_queue.closed)
+        self.assertRaises(ValueError, server.WebSocketSendQueue, 10, 'unknown')
+
+    def test_writer_thread(self):
+        ws = HeadlessWebSocket()
+        ws.start_writer()
+        ws.send_message('3')
+        ws.send_message('2js')
+        for i in range(100):
+            if len(ws.messages) == 2:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(ws.messages, ['3', '2js'])
+        ws.send_queue.close()
+
+
+class TestStaticFileCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'style.css')
+        self.write(b'body { margin: 0px; }\n' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, content, mtime=1000000):
+        with open(self.filename, 'wb') as f:
+            f.write(content)
+        os.utime(self.filename, (mtime, mtime))
+
+    def test_cache(self):
+        cache = server.StaticFileCache()
+        static_file = cache.get(self.filename)
+        self.assertEqual(static_file.mimetype, 'text/css')
+        self.assertEqual(zlib.decompress(static_file.gzip_content, 16 + zlib.MAX_WBITS), static_file.content)
+        self.assertIs(cache.get(self.filename), static_file)
+        # modified files get reloaded
+        self.write(b'p {}', mtime=1000001)
+        reloaded = cache.get(self.filename)
+        self.assertEqual(reloaded.content, b'p {}')
+        self.assertIsNone(reloaded.gzip_content)
+        self.assertNotEqual(reloaded.etag, static_file.etag)
+        self.assertEqual(cache.size, 4)
+
+    def test_size_limit(self):
+        cache = server.StaticFileCache(max_size=3000, max_file_size=3000)
+        files = []
+        for i in range(4):
+            filename = os.path.join(self.dir, 'file%d.bin' % i)
+            with open(filename, 'wb') as f:
+                f.write(b'x' * 1000)
+            files.append(filename)
+        for filename in (files[0], files[1], files[2], files[0], files[3]):
+            cache.get(filename)
+        # the least recently used file got evicted
+        self.assertEqual(list(cache._files.keys()), [files[2], files[0], files[3]])
+        self.assertLessEqual(cache.size, 3000)
+        # files bigger than max_file_size are not loaded
+        cache = server.StaticFileCache(max_size=3000, max_file_size=100)
+        self.assertIsNone(cache.get(files[0]).content)
+        self.assertEqual(cache.size, 0)
+
+
+class MemorySink(io.BytesIO):
+    """ File object keeping its content after being closed """
+    def close(self):
+        self.content = self.getvalue()
+        io.BytesIO.close(self)
+
+
+def multipart_body(boundary, parts):
+    body = b'preamble'
+    for name, filename, content in parts:
+        body += b'\r\n--' + boundary + b'\r\nContent-Disposition: form-data; name="' + name + b'"'
+        if filename is not None:
+            body += b'; filename="' + filename + b'"\r\nContent-Type: application/octet-stream'
+        body += b'\r\n\r\n' + content
+    return body + b'\r\n--' + boundary + b'--\r\nepilogue'
+
+
+class TestMultipartParser(unittest.TestCase):
+    boundary = b'----WebKitFormBoundaryX3e7'
+
+    def parse(self, body, chunk_size, content_length=None):
+        sinks = []
+        def open_file(name, filename):
+            sinks.append(MemorySink())
+            return sinks[-1]
+        parser = server.MultipartParser(io.BytesIO(body), 'multipart/form-data; boundary=' + self.boundary.decode(),
+                                        content_length, open_file)
+        parser.chunk_size = chunk_size
+        return [(name, filename, value.content if value in sinks else value)
+                for name, filename, value in parser.parse()]
+
+    def test_parts(self):
+        # contents resembling the delimiter, split across the chunks
+        data = (b'\r\n--' + self.boundary[:-1] + b'\r\n\r\n--') * 50 + os.urandom(5000)
+        body = multipart_body(self.boundary, [(b'field', None, b'value'),
+                                              (b'upload_file', u'\u00e8.bin'.encode('utf-8'), data),
+                                              (b'empty', b'empty.txt', b'')])
+        for chunk_size in (1, 7, 100, 65536):
+            self.assertEqual(self.parse(body, chunk_size, len(body)),
+                             [('field', None, b'value'), ('upload_file', u'\u00e8.bin', data), ('empty', 'empty.txt', b'')])
+        self.assertEqual(len(self.parse(body, 100)), 3)
+
+    def test_errors(self):
+        body = multipart_body(self.boundary, [(b'upload_file', b'a.bin', b'x' * 1000)])
+        self.assertRaises(ValueError, self.parse, body[:500], 100)
+        body = multipart_body(self.boundary, [(b'field', None, b'x' * (server.MultipartParser.max_field_size + 1))])
+        self.assertRaises(ValueError, self.parse, body, 65536)
+        self.assertRaises(ValueError, server.MultipartParser, io.BytesIO(body), 'multipart/form-data', None, None)
+
+    def test_truncated_file_removed(self):
+        directory = tempfile.mkdtemp()
+        try:
+            body = multipart_body(self.boundary, [(b'upload_file', b'a.bin', b'x' * 1000)])
+            open_file = lambda name, filename: tempfile.NamedTemporaryFile(dir=directory, delete=False)
+            parser = server.MultipartParser(io.BytesIO(body[:500]), 'multipart/form-data; boundary=' +
+                                            self.boundary.decode(), None, open_file)
+            self.assertRaises(ValueError, list, parser.parse())
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestRangeHeader(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(server.parse_range_header('bytes=0-99,-100', 1000), [(0, 99), (900, 999)])
+        self.assertEqual(server.parse_range_header('bytes=500-', 1000), [(500, 999)])
+        self.assertEqual(server.parse_range_header('bytes=900-2000', 1000), [(900, 999)])
+        self.assertEqual(server.parse_range_header('bytes=-2000', 1000), [(0, 999)])
+        self.assertEqual(server.parse_range_header('bytes=1000-', 1000), [])
+        self.assertIsNone(server.parse_range_header(None, 1000))
+        self.assertIsNone(server.parse_range_header('items=0-1', 1000))
+        self.assertIsNone(server.parse_range_header('bytes=5-1', 1000))
+        self.assertIsNone(server.parse_range_header('bytes=a-b', 1000))
+
+
+class TestStaticFileRequests(unittest.TestCase):
+    def setUp(self):
+        self.server = server.Server(UpdateApp, start=False, start_browser=False, multiple_instance=True)
+        self.server.start()
+        self.address = self.server._sserver.server_address[:2]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def get(self, headers=''):
+        response = http_get(self.address, '/res:style.css', headers)
+        head, _, body = response.partition(b'\r\n\r\n')
+        return head.decode('latin-1'), body
+
+    def header(self, head, name):
+        for line in head.split('\r\n'):
+            if line.lower().startswith(name.lower() + ':'):
+                return line.split(':', 1)[1].strip()
+        return None
+
+    def test_conditional_requests(self):
+        head, body = self.get()
+        self.assertIn(' 200 ', head.split('\r\n')[0])
+        etag = self.header(head, 'ETag')
+        self.assertTrue(etag.startswith('"'))
+        self.assertEqual(int(self.header(head, 'Content-Length')), len(body))
+        head, body = self.get('If-None-Match: %s\r\n' % etag)
+        self.assertIn(' 304 ', head.split('\r\n')[0])
+        self.assertEqual(body, b'')
+        head, body = self.get('If-Modified-Since: %s\r\n' % self.header(head, 'Last-Modified'))
+        self.assertIn(' 304 ', head.split('\r\n')[0])
+        head, body = self.get('If-None-Match: "other"\r\n')
+        self.assertIn(' 200 ', head.split('\r\n')[0])
+
+    def test_ranges(self):
+        _, content = self.get()
+        head, body = self.get('Range: bytes=10-19\r\nAccept-Encoding: gzip\r\n')
+        self.assertIn(' 206 ', head.split('\r\n')[0])
+        self.assertEqual(self.header(head, 'Content-Range'), 'bytes 10-19/%d' % len(content))
+        self.assertIsNone(self.header(head, 'Content-Encoding'))
+        self.assertEqual(body, content[10:20])
+        head, body = self.get('Range: bytes=0-4,-5\r\n')
+        self.assertIn(' 206 ', head.split('\r\n')[0])
+        content_type = self.header(head, 'Content-type')
+        self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+        self.assertEqual(int(self.header(head, 'Content-Length')), len(body))
+        boundary = content_type.split('=')[1].encode('ascii')
+        parts = body.split(b'--' + boundary)
+        self.assertEqual(parts[-1], b'--\r\n')
+        self.assertTrue(parts[1].endswith(b'\r\n\r\n' + content[:5] + b'\r\n'))
+        self.assertIn(b'Content-Range: bytes %d-%d/%d' % (len(content) - 5, len(content) - 1, len(content)), parts[2])
+        head, body = self.get('Range: bytes=%d-\r\n' % len(content))
+        self.assertIn(' 416 ', head.split('\r\n')[0])
+        self.assertEqual(self.header(head, 'Content-Range'), 'bytes */%d' % len(content))
+        # the whole file is sent if it changed since the client got the first part
+        head, body = self.get('Range: bytes=10-19\r\nIf-Range: "other"\r\n')
+        self.assertIn(' 200 ', head.split('\r\n')[0])
+        self.assertEqual(body, content)
+
+    def test_gzip(self):
+        _, plain = self.get()
+        head, body = self.get('Accept-Encoding: gzip, deflate\r\n')
+        self.assertEqual(self.header(head, 'Content-Encoding'), 'gzip')
+        self.assertEqual(self.header(head, 'Vary'), 'Accept-Encoding')
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), plain)
+        head, _ = self.get('Accept-Encoding: gzip\r\nIf-None-Match: %s\r\n' % self.header(head, 'ETag'))
+        self.assertIn(' 304 ', head.split('\r\n')[0])
+        # gzip refused by its q-value
+        head, body = self.get('Accept-Encoding: gzip;q=0, deflate\r\n')
+        self.assertIsNone(self.header(head, 'Content-Encoding'))
+        self.assertEqual(body, plain)
+
+    def test_accepts_encoding(self):
+        self.assertTrue(server.accepts_encoding('gzip, deflate', 'gzip'))
+        self.assertTrue(server.accepts_encoding('deflate, GZIP;q=0.5', 'gzip'))
+        self.assertTrue(server.accepts_encoding('*', 'gzip'))
+        self.assertFalse(server.accepts_encoding('gzip;q=0', 'gzip'))
+        self.assertFalse(server.accepts_encoding('gzip; q=0.0, *', 'gzip'))
+        self.assertFalse(server.accepts_encoding('*;q=0', 'gzip'))
+        self.assertFalse(server.accepts_encoding('deflate, xgzip', 'gzip'))
+        self.assertFalse(server.accepts_encoding(None, 'gzip'))
+
+    def test_static_paths(self):
+        http_get(self.address, '/res:style.css')
+        http_get(self.address, '/res:style.css')
+        # the folders are collected by the first request
+        self.assertEqual(list(self.server._sserver.static_paths), [UpdateApp])
+
+
+class FilesApp(UpdateApp):
+    files_dir = None
+    downloader = None
+
+    def __init__(self, *args):
+        super(FilesApp, self).__init__(*args, static_file_path={'files': self.files_dir})
+
+    def main(self):
+        FilesApp.downloader = gui.FileDownloader('video', os.path.join(self.files_dir, 'video.mp4'))
+        return gui.VBox(children=[FilesApp.downloader])
+
+
+class UploadApp(UpdateApp):
+    def main(self):
+        self.uploader = gui.FileUploader(self.savepath)
+        self.uploader.ondata.do(self.on_data)
+        self.uploader.onprogress.do(self.on_progress)
+        self.received = []
+        self.progress = []
+        return gui.VBox(children=[self.uploader])
+
+    def on_data(self, emitter, filepath, filename):
+        self.received.append((filepath, filename))
+
+    def on_progress(self, emitter, filename, received, size):
+        self.progress.append((filename, received, size))
+
+
+class TestUpload(unittest.TestCase):
+    def setUp(self):
+        # single instance apps share the session 0
+        server.clients.clear()
+        UploadApp.savepath = tempfile.mkdtemp()
+        self.server = server.Server(UploadApp, start=False, start_browser=False)
+        self.server.start()
+        self.address = self.server._sserver.server_address[:2]
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(UploadApp.savepath)
+        server.clients.clear()
+
+    def test_upload(self):
+        http_get(self.address, '/')
+        app = list(server.clients.values())[-1]
+        boundary = b'boundary1234'
+        content = os.urandom(300000)
+        body = multipart_body(boundary, [(b'upload_file', b'firmware.bin', content)])
+        s = socket.create_connection(self.address)
+        s.settimeout(5)
+        s.sendall(b'POST / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\nfilename: firmware.bin\r\nlistener: ' +
+                  app.uploader.identifier.encode() + b'\r\nlistener_function: ondata\r\n' +
+                  b'Content-Type: multipart/form-data; boundary=' + boundary +
+                  b'\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        response = s.recv(1024)
+        s.close()
+        self.assertIn(b' 200 ', response)
+        saved = os.path.join(UploadApp.savepath, 'firmware.bin')
+        self.assertEqual(app.received, [(saved, 'firmware.bin')])
+        with open(saved, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        # the temporary file got renamed
+        self.assertEqual(os.listdir(UploadApp.savepath), ['firmware.bin'])
+
+    def test_truncated_upload(self):
+        http_get(self.address, '/')
+        app = list(server.clients.values())[-1]
+        boundary = b'boundary1234'
+        body = multipart_body(boundary, [(b'upload_file', b'firmware.bin', os.urandom(300000))])
+        s = socket.create_connection(self.address)
+        s.settimeout(5)
+        s.sendall(b'POST / HTTP/1.1\r\nHost: localhost\r\nfilename: firmware.bin\r\nlistener: ' +
+                  app.uploader.identifier.encode() + b'\r\nlistener_function: ondata\r\n' +
+                  b'Content-Type: multipart/form-data; boundary=' + boundary +
+                  b'\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body[:200000])
+        # the client goes away in the middle of the file
+        s.shutdown(socket.SHUT_WR)
+        response = s.recv(1024)
+        s.close()
+        self.assertIn(b' 400 ', response)
+        self.assertEqual(app.received, [])
+        self.assertEqual(os.listdir(UploadApp.savepath), [])
+
+    def post_chunk(self, app, upload_id, size, offset=None, data=b'', extra_headers='', content_length=None,
+                   status=b' 200 '):
+        s = socket.create_connection(self.address)
+        s.settimeout(5)
+        headers = 'POST / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\nfilename: %s\r\nlistener: %s\r\nlistener_function: ondata\r\n' \
+                  'upload-id: %s\r\nupload-size: %d\r\nContent-Length: %d\r\n' % \
+                  ('firm%20ware.bin', app.uploader.identifier, upload_id, size,
+                   len(data) if content_length is None else content_length)
+        if offset is not None:
+            headers += 'upload-offset: %d\r\n' % offset
+        s.sendall((headers + extra_headers + '\r\n').encode('ascii') + data)
+        # the client goes away, if the body is shorter than its length
+        s.shutdown(socket.SHUT_WR)
+        response = b''
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+        s.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        self.assertIn(status, head)
+        return json.loads(body.decode('utf-8')) if body else None
+
+    def test_chunked_upload(self):
+        http_get(self.address, '/')
+        app = list(server.clients.values())[-1]
+        content = os.urandom(250000)
+        chunk_size = 100000
+        self.assertEqual(self.post_chunk(app, 'id1', len(content)), {'received': [], 'complete': False})
+        # the last slice first, then an interrupted slice
+        status = self.post_chunk(app, 'id1', len(content), 200000, content[200000:])
+        self.assertEqual(status, {'received': [[200000, 250000]], 'complete': False})
+        # resuming, the client gets the received ranges and sends the missing slices in parallel
+        threads = [threading.Thread(target=self.post_chunk, args=(app, 'id1', len(content), offset,
+                                                                    content[offset:offset + chunk_size]))
+                   for offset in (0, chunk_size)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        saved = os.path.join(UploadApp.savepath, 'firm ware.bin')
+        self.assertEqual(app.received, [(saved, 'firm ware.bin')])
+        with open(saved, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.listdir(UploadApp.savepath), ['firm ware.bin'])
+        self.assertEqual(app.progress[0], ('firm ware.bin', 50000, 250000))
+        self.assertEqual(sorted(app.progress)[-1], ('firm ware.bin', 250000, 250000))
+        # a slice retried after the completion does not start the upload again
+        status = self.post_chunk(app, 'id1', len(content), 200000, content[200000:])
+        self.assertEqual(status, {'received': [[0, 250000]], 'complete': True})
+        self.assertEqual(app.received, [(saved, 'firm ware.bin')])
+        self.assertEqual(os.listdir(UploadApp.savepath), ['firm ware.bin'])
+        # empty files are completed by an empty slice
+        self.assertEqual(self.post_chunk(app, 'id2', 0, 0), {'received': [], 'complete': True})
+        self.assertEqual(os.path.getsize(os.path.join(UploadApp.savepath, 'firm ware.bin')), 0)
+
+    def test_truncated_slice(self):
+        http_get(self.address, '/')
+        app = list(server.clients.values())[-1]
+        content = os.urandom(100000)
+        # the client retries the slices answered with an error status
+        self.assertIsNone(self.post_chunk(app, 'id1', len(content), 0, content[:30000], content_length=50000,
+                                          status=b' 408 '))
+        self.assertEqual(self.post_chunk(app, 'id1', len(content)), {'received': [[0, 30000]], 'complete': False})
+        self.post_chunk(app, 'id1', len(content), 0, content[:50000])
+        self.post_chunk(app, 'id1', len(content), 50000, content[50000:])
+        with open(os.path.join(UploadApp.savepath, 'firm ware.bin'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_chunk_ranges(self):
+        upload = server.ChunkedUpload('key', 100, io.BytesIO())
+        upload.write(50, io.BytesIO(b'b' * 10), 10)
+        upload.write(0, io.BytesIO(b'a' * 10), 10)
+        upload.write(5, io.BytesIO(b'c' * 20), 20)
+        self.assertEqual(upload.ranges, [[0, 25], [50, 60]])
+        self.assertEqual(upload.received(), 35)
+        self.assertRaises(ValueError, upload.write, 95, io.BytesIO(b'x' * 10), 10)
+        self.assertRaises(IOError, upload.write, 70, io.BytesIO(b'x' * 5), 10)
+        self.assertEqual(upload.ranges, [[0, 25], [50, 60], [70, 75]])
+        self.assertFalse(upload.finish())
+
+    def test_ondata_content(self):
+        received = []
+        for ondata_content, expected in ((False, os.path.join(UploadApp.savepath, 'data.bin')), (True, b'data')):
+            uploader = gui.FileUploader(UploadApp.savepath, ondata_content=ondata_content)
+            uploader.ondata.do(lambda emitter, filedata, filename: received.append((filedata, filename)))
+            with uploader.open_upload('data.bin') as f:
+                f.write(b'data')
+            uploader.ondata(f.name, 'data.bin')
+            self.assertEqual(received.pop(), (expected, 'data.bin'))
+
+
+class TestUploadSessions(unittest.TestCase):
+    post_chunk = TestUpload.__dict__['post_chunk']
+
+    def setUp(self):
+        server.clients.clear()
+        UploadApp.savepath = tempfile.mkdtemp()
+        self.server = server.Server(UploadApp, start=False, start_browser=False, multiple_instance=True)
+        self.server.start()
+        self.address = self.server._sserver.server_address[:2]
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(UploadApp.savepath)
+        server.clients.clear()
+
+    def test_uploads_of_other_sessions(self):
+        cookie = session_cookie(http_get(self.address, '/'))
+        app = server.clients[int(cookie.split('=')[1].strip())]
+        other_cookie = session_cookie(http_get(self.address, '/'))
+        content = os.urandom(1000)
+        self.assertEqual(self.post_chunk(app, 'id1', len(content), 0, content[:500], cookie),
+                         {'received': [[0, 500]], 'complete': False})
+        # another session can neither query nor resume the upload
+        self.assertIsNone(self.post_chunk(app, 'id1', len(content), None, b'', other_cookie, status=b' 400 '))
+        self.assertIsNone(self.post_chunk(app, 'id1', len(content), 500, content[500:], other_cookie,
+                                          status=b' 400 '))
+        self.assertEqual([key[0] for key in server.ChunkedUpload._uploads if key[1] == app.uploader.identifier],
+                         [app.session])
+        self.assertEqual(app.received, [])
+        self.assertEqual(self.post_chunk(app, 'id1', len(content), 500, content[500:], cookie),
+                         {'received': [[0, 1000]], 'complete': True})
+        with open(os.path.join(UploadApp.savepath, 'firm ware.bin'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+
+class TestLargeStaticFile(unittest.TestCase):
+    """ Files bigger than the cache limit are sent from disk """
+    engine = 'threading'
+
+    def setUp(self):
+        FilesApp.files_dir = tempfile.mkdtemp()
+        self.content = os.urandom(3 * 1024 * 1024)
+        with open(os.path.join(FilesApp.files_dir, 'video.mp4'), 'wb') as f:
+            f.write(self.content)
+        self.server = server.Server(FilesApp, start=False, start_browser=False, multiple_instance=True,
+                                    engine=self.engine)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(FilesApp.files_dir)
+
+    def test_download(self):
+        response = http_get(self.server._sserver.server_address[:2], '/files:video.mp4')
+        head, _, body = response.partition(b'\r\n\r\n')
+        self.assertIn(b' 200 ', head)
+        self.assertIn(b'Content-Length: %d' % len(self.content), head)
+        self.assertEqual(body, self.content)
+        self.assertEqual(self.server._sserver.static_file_cache.size, 0)
+
+    def test_download_range(self):
+        address = self.server._sserver.server_address[:2]
+        cookie = session_cookie(http_get(address, '/'))
+        response = http_get(address, '/%s/download' % FilesApp.downloader.identifier,
+                            cookie + 'Range: bytes=1000-1999\r\n')
+        head, _, body = response.partition(b'\r\n\r\n')
+        self.assertIn(b' 206 ', head)
+        self.assertIn(b'Content-Range: bytes 1000-1999/%d' % len(self.content), head)
+        self.assertIn(b'Content-Disposition: attachment; filename="video.mp4"', head)
+        self.assertEqual(body, self.content[1000:2000])
+
+    def test_download_stream(self):
+        address = self.server._sserver.server_address[:2]
+        cookie = session_cookie(http_get(address, '/'))
+        FilesApp.downloader.stream = lambda: (iter([b'abc', u'd\u00e8', b'', b'f' * 70000]), {'Content-type': 'text/plain'})
+        path = '/%s/stream' % FilesApp.downloader.identifier
+        expected = b'abcd\xc3\xa8' + b'f' * 70000
+        head, _, body = http_get(address, path, cookie, version='HTTP/1.0').partition(b'\r\n\r\n')
+        self.assertIn(b' 200 ', head)
+        self.assertNotIn(b'Content-Length', head)
+        self.assertEqual(body, expected)
+        # HTTP/1.1 responses of unknown length use chunked transfer encoding
+        head, _, body = http_get(address, path, cookie).partition(b'\r\n\r\n')
+        self.assertIn(b'Transfer-Encoding: chunked', head)
+        data = b''
+        while True:
+            size, _, body = body.partition(b'\r\n')
+            size = int(size, 16)
+            data += body[:size]
+            self.assertEqual(body[size:size + 2], b'\r\n')
+            body = body[size + 2:]
+            if size == 0:
+                break
+        self.assertEqual(data, expected)
+        self.assertEqual(body, b'')
+
+    def test_text_result(self):
+        address = self.server._sserver.server_address[:2]
+        cookie = session_cookie(http_get(address, '/'))
+        path = '/%s/stream' % FilesApp.downloader.identifier
+        for content in (u'OK \u00e8', [u'OK ', b'\xc3\xa8']):
+            FilesApp.downloader.stream = lambda: (content, {'Content-type': 'text/plain'})
+            head, _, body = http_get(address, path, cookie).partition(b'\r\n\r\n')
+            self.assertIn(b'Content-Length: 5', head)
+            self.assertNotIn(b'Transfer-Encoding', head)
+            self.assertEqual(body, b'OK \xc3\xa8')
+        head, _, body = http_get(address, path, cookie + 'Range: bytes=1-2\r\n').partition(b'\r\n\r\n')
+        self.assertIn(b' 206 ', head)
+        self.assertEqual(body, b'K ')
+
+    def test_chunked_copy(self):
+        # TLS connections have no zero-copy path, the file gets copied in chunks
+        app = server.App.__new__(server.App)
+        app.connection = object()
+        app.wfile = io.BytesIO()
+        with open(os.path.join(FilesApp.files_dir, 'video.mp4'), 'rb') as f:
+            app._send_file(f, 100, 200000)
+        self.assertEqual(app.wfile.getvalue(), self.content[100:200100])
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio engine requires Python 3.5+")
+class TestLargeStaticFileAsyncio(TestLargeStaticFile):
+    engine = 'asyncio'
+
+
+class FakeSession(object):
+    def __init__(self, last_activity, websockets=(), memory=0):
+        self.last_activity = last_activity
+        self.websockets = set(websockets)
+        self.memory = memory
+        self.update_lock = threading.RLock()
+
+    def memory_usage(self):
+        # the reaper measures the session holding its update lock
+        assert self.update_lock._is_owned()
+        return self.memory
+
+
+class TestSessionReaper(unittest.TestCase):
+    def test_select(self):
+        sessions = [(1, FakeSession(10)), (2, FakeSession(20, websockets=[object()])),
+                    (3, FakeSession(30)), (4, FakeSession(95))]
+        reaper = server.SessionReaper(session_timeout=60)
+        self.assertEqual(reaper.select(sessions, 100), [1, 3])
+        # the connected sessions are not evicted by the idle timeout
+        self.assertEqual(reaper.select(sessions, 1000), [1, 3, 4])
+        reaper = server.SessionReaper(max_sessions=2)
+        self.assertEqual(reaper.select(sessions, 100), [1, 2])
+        self.assertEqual(reaper.select(sessions, 100, keep=1), [2, 3])
+        reaper = server.SessionReaper(max_memory=100)
+        sessions = [(1, FakeSession(10, memory=50)), (2, FakeSession(20, memory=40)), (3, FakeSession(30, memory=40))]
+        self.assertEqual(reaper.select(sessions, 100), [1])
+        self.assertEqual(reaper.select(sessions, 100, check_memory=False), [])
+        self.assertFalse(server.SessionReaper().enabled())
+
+    def test_eviction(self):
+        server.clients.clear()
+        self.server = server.Server(UpdateApp, start=False, start_browser=False, multiple_instance=True,
+                                    max_sessions=2, session_timeout=60)
+        self.server.start()
+        self.addCleanup(server.clients.clear)
+        self.addCleanup(self.server.stop)
+        address = self.server._sserver.server_address[:2]
+        http_get(address, '/')
+        first = list(server.clients.values())[0]
+        self.assertGreater(first.memory_usage(), 0)
+        time.sleep(0.01)
+        http_get(address, '/')
+        time.sleep(0.01)
+        # a request keeps the session active, the least recently active one gets evicted
+        http_get(address, '/', 'Cookie: remi_session=%s\r\n' % first.session)
+        http_get(address, '/')
+        self.assertEqual(len(server.clients), 2)
+        self.assertIn(first, server.clients.values())
+        others = [app for app in server.clients.values() if app is not first]
+        for app in server.clients.values():
+            self.assertFalse(app._stop_update_flag)
+        # idle sessions expire
+        first.last_activity -= 120
+        self.assertEqual(self.server._session_reaper.reap(), [first.session])
+        self.assertTrue(first._stop_update_flag)
+        self.assertEqual(list(server.clients.values()), others)
+
+    def test_memory_eviction(self):
+        server.clients.clear()
+        self.server = server.Server(UpdateApp, start=False, start_browser=False, multiple_instance=True,
+                                    max_sessions_memory=1)
+        self.server.start()
+        self.addCleanup(server.clients.clear)
+        self.addCleanup(self.server.stop)
+        address = self.server._sserver.server_address[:2]
+        http_get(address, '/')
+        time.sleep(0.01)
+        http_get(address, '/')
+        # the new sessions do not measure the others, the reaper thread does
+        sessions = sorted(server.clients)
+        self.assertEqual(len(sessions), 2)
+        self.assertEqual(self.server._session_reaper.reap(), sessions)
+
+
+def read_response(s):
+    """ Reads a response framed by its Content-Length from a persistent connection """
+    data = b''
+    while b'\r\n\r\n' not in data:
+        chunk = s.recv(65536)
+        if not chunk:
+            raise EOFError('connection closed')
+        data += chunk
+    head, _, body = data.partition(b'\r\n\r\n')
+    length = None
+    for line in head.split(b'\r\n'):
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':')[1])
+    assert length is not None, head
+    while len(body) < length:
+        body += s.recv(65536)
+    return head.decode('latin-1'), body
+
+
+class TestSessionIds(unittest.TestCase):
+    def test_unique(self):
+        ids = [server.new_session_id() for i in range(100)]
+        self.assertEqual(len(set(ids)), 100)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_affinity(self):
+        for i in range(10):
+            self.assertEqual(server.new_session_id((1, 3)) % 3, 1)
+
+
+class TestKeepAlive(unittest.TestCase):
+    engine = 'threading'
+
+    def setUp(self):
+        self.server = server.Server(UpdateApp, start=False, start_browser=False, multiple_instance=True,
+                                    engine=self.engine, keep_alive_timeout=1)
+        self.server.start()
+        self.address = self.server._sserver.server_address[:2]
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+
+    def test_persistent_connection(self):
+        cookie = session_cookie(http_get(self.address, '/'))
+        s = socket.create_connection(self.address)
+        s.settimeout(5)
+        for path, status in (('/', 200), ('/res:style.css', 200), ('/res:missing.css', 404),
+                             ('/nonexistent', 404), ('/res:style.css', 200)):
+            s.sendall(('GET %s HTTP/1.1\r\nHost: localhost\r\n%s\r\n' % (path, cookie)).encode('utf-8'))
+            head, body = read_response(s)
+            self.assertTrue(head.startswith('HTTP/1.1 %d ' % status), head)
+            if path == '/':
+                self.assertTrue(body.startswith(b'<!DOCTYPE html>'))
+                self.assertTrue(body.endswith(b'</html>'))
+        s.close()
+
+    def test_new_sessions(self):
+        server.clients.clear()
+        s = socket.create_connection(self.address)
+        s.settimeout(5)
+        request = b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        s.sendall(request + request)
+        head, _ = read_response(s)
+        # the handler of the connection became the App of the new session, it serves no other request
+        self.assertIn('Connection: close', head)
+        self.assertEqual(s.recv(1), b'')
+        s.close()
+        http_get(self.address, '/')
+        self.assertEqual(len(server.clients), 2)
+        first, second = server.clients.values()
+        self.assertIsNot(first, second)
+        self.assertIsNot(first.page, second.page)
+        server.clients.clear()
+
+    def test_idle_timeout(self):
+        s = socket.create_connection(self.address)
+        s.settimeout(5)
+        s.sendall(b'GET /res:style.css HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_response(s)
+        # the server closes the connection once idle for keep_alive_timeout
+        self.assertEqual(s.recv(1), b'')
+        s.close()
+
+    def test_stop_closes_idle_connections(self):
+        self.server.stop()
+        self.server = server.Server(UpdateApp, start=False, start_browser=False, multiple_instance=True,
+                                    engine=self.engine, keep_alive_timeout=30)
+        self.server.start()
+        s = socket.create_connection(self.server._sserver.server_address[:2])
+        s.settimeout(5)
+        s.sendall(b'GET /res:style.css HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        read_response(s)
+        started = time.time()
+        self.server.stop()
+        # the handler waiting for the next request does not outlive the server
+        self.assertEqual(s.recv(1), b'')
+        self.assertLess(time.time() - started, 3)
+        s.close()
+        self.server = None
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio engine requires Python 3.5+")
+class TestKeepAliveAsyncio(TestKeepAlive):
+    engine = 'asyncio'
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        from remi.metrics import Metrics
+        metrics = Metrics()
+        metrics.inc('remi_websocket_messages_received_total')
+        metrics.inc('remi_websocket_messages_received_total', 2)
+        for value in (0.0001, 0.003, 10):
+            metrics.observe('remi_callback_seconds', value, (('event', 'onclick'),))
+        metrics.add_collector(lambda: [('remi_sessions', 'gauge', {(): 3})])
+        samples = metrics.collect()
+        self.assertEqual(samples['remi_websocket_messages_received_total'], {(): 3})
+        histogram = samples['remi_callback_seconds'][(('event', 'onclick'),)]
+        self.assertEqual(histogram['count'], 3)
+        self.assertEqual(dict(histogram['buckets'])[0.0001], 1)
+        self.assertEqual(dict(histogram['buckets'])[0.005], 2)
+        self.assertEqual(dict(histogram['buckets'])[float('inf')], 3)
+        text = metrics.render()
+        self.assertIn('# TYPE remi_callback_seconds histogram\n', text)
+        self.assertIn('remi_callback_seconds_bucket{event="onclick",le="0.0001"} 1\n', text)
+        self.assertIn('remi_callback_seconds_bucket{event="onclick",le="+Inf"} 3\n', text)
+        self.assertIn('remi_callback_seconds_count{event="onclick"} 3\n', text)
+        self.assertIn('remi_websocket_messages_received_total 3\n', text)
+        self.assertIn('remi_sessions 3\n', text)
+
+    def test_disabled(self):
+        server.clients.clear()
+        app = UpdateApp(MockRequest(), ('0.0.0.0', 8888), MockServer())
+        app.labels[0].set_text('no metrics')
+        app.on_close()
+        self.assertIsNone(server.Server(UpdateApp, start=False).metrics)
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+    def setUp(self):
+        server.clients.clear()
+        self.server = server.Server(UpdateApp, start=False, start_browser=False, multiple_instance=True,
+                                    metrics=True)
+        self.server.start()
+        self.address = self.server._sserver.server_address[:2]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_metrics(self):
+        cookie = session_cookie(http_get(self.address, '/'))
+        http_get(self.address, '/res:style.css', cookie)
+        http_get(self.address, '/res:style.css', cookie)
+        app = server.clients[int(cookie.split('=')[1].strip())]
+        label = app.labels[0]
+        label.onclick.do(lambda emitter: emitter.set_text('clicked'))
+
+        s = socket.create_connection(self.address)
+        s.settimeout(5)
+        s.sendall(('GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                   'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n%s\r\n' %
+                   cookie).encode('utf-8'))
+        s.recv(4096)
+        s.sendall(client_frame(('callback/%s/onclick/' % label.identifier).encode('utf-8')))
+        deadline = time.time() + 5
+        while label.get_text() != 'clicked' and time.time() < deadline:
+            time.sleep(0.05)
+        # the update gets sent by the idle loop
+        time.sleep(0.3)
+
+        response = http_get(self.address, '/remi:metrics')
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 '))
+        self.assertNotIn(b'remi_session=', response)
+        text = response.split(b'\r\n\r\n', 1)[1].decode('utf-8')
+        self.assertIn('remi_sessions 1\n', text)
+        self.assertIn('remi_websockets 1\n', text)
+        self.assertIn('remi_websocket_messages_received_total 1\n', text)
+        self.assertIn('remi_callback_seconds_count{event="onclick"} 1\n', text)
+        self.assertIn('remi_static_cache_hits_total 1\n', text)
+        self.assertIn('remi_static_cache_misses_total 1\n', text)
+        self.assertIn('# TYPE remi_gui_update_bytes histogram\n', text)
+        self.assertIn('# TYPE remi_update_lock_wait_seconds histogram\n', text)
+        self.assertEqual(self.server.metrics.collect()['remi_callback_seconds'][(('event', 'onclick'),)]['count'], 1)
+        s.close()
+
+
+def slow_listener(emitter):
+    time.sleep(0.02)
+
+
+class TestCallbackProfiler(unittest.TestCase):
+    def setUp(self):
+        server.clients.clear()
+        self.app = UpdateApp(MockRequest(), ('0.0.0.0', 8888), MockServer())
+        self.profiler = server.CallbackProfiler(report_interval=None, cprofile_threshold=0.01)
+        self.app.server.profiler = self.profiler
+        self.ws = HeadlessWebSocket(self.app)
+
+    def tearDown(self):
+        self.app.on_close()
+
+    def test_listener_name(self):
+        label = self.app.labels[0]
+        self.assertEqual(server.listener_name(label.onclick), 'remi.gui.Widget.onclick')
+        label.onclick.do(slow_listener)
+        self.assertTrue(server.listener_name(label.onclick).endswith('.slow_listener'))
+        label.onclick.do(self.app.labels[1].onclick)
+        self.assertEqual(server.listener_name(label.onclick), 'remi.gui.Widget.onclick')
+        label.onclick.do(self.app.on_close)
+        self.assertEqual(server.listener_name(label.onclick), 'remi.server.App.on_close')
+
+    def test_dispatch(self):
+        label = self.app.labels[0]
+        label.onclick.do(slow_listener)
+        for i in range(3):
+            self.ws.on_message('callback/%s/onclick/' % label.identifier)
+        self.ws.on_message('callback/%s/onclick/' % self.app.labels[1].identifier)
+        top = self.profiler.top()
+        self.assertEqual(len(top), 2)
+        self.assertEqual((top[0]['widget_class'], top[0]['event'], top[0]['count']), ('Label', 'onclick', 3))
+        self.assertTrue(top[0]['listener'].endswith('.slow_listener'))
+        self.assertTrue(top[0]['wall'] >= 0.06)
+        self.assertTrue(top[0]['cpu'] < top[0]['wall'])
+        self.assertEqual(self.profiler.top(1, sort='count')[0]['count'], 3)
+        # the call following the first slow one got profiled
+        self.assertEqual(list(self.profiler.profiles), [('Label', 'onclick', top[0]['listener'])])
+        report = self.profiler.report()
+        self.assertIn('Label.onclick -> %s' % top[0]['listener'], report)
+        self.assertIn('cProfile of Label.onclick', report)
+        self.assertIn('sleep', report)
+
+    def test_report_url(self):
+        profiling_server = server.Server(UpdateApp, start=False, start_browser=False, profiler=True)
+        profiling_server.start()
+        try:
+            response = http_get(profiling_server._sserver.server_address[:2], '/remi:profile')
+        finally:
+            profiling_server.stop()
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 '))
+        self.assertIn(b'attachment; filename="remi_profile.txt"', response)
+        self.assertIn(b'widget.event -> listener', response)
+
+
+class ClickApp(UpdateApp):
+    def main(self):
+        self.label = gui.Label('clicks 0')
+        self.clicks = 0
+        self.button = gui.Button('click')
+        self.button.onclick.do(self.on_click)
+        self.text = gui.TextInput()
+        return gui.VBox(children=[self.label, self.button, self.text])
+
+    def on_click(self, emitter):
+        self.clicks += 1
+        self.label.set_text('clicks %d' % self.clicks)
+
+
+class TestLoadTest(unittest.TestCase):
+    def setUp(self):
+        server.clients.clear()
+        self.server = server.Server(ClickApp, start=False, start_browser=False, multiple_instance=True,
+                                    update_interval=0.01)
+        self.server.start()
+        self.address = self.server._sserver.server_address[:2]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_scrape(self):
+        from remi import loadtest
+        cookie, html = loadtest.http_get_page(self.address)
+        app = server.clients[int(cookie)]
+        callbacks = loadtest.scrape_callbacks(html)
+        self.assertIn((app.button.identifier, 'Button', 'onclick', False), callbacks)
+        self.assertIn((app.text.identifier, 'TextInput', 'onchange', True), callbacks)
+
+    def test_random(self):
+        from remi import loadtest
+        summary = loadtest.run(self.address, users=2, duration=0.5, ramp_up=0, seed=1)
+        self.assertEqual(summary['failed_users'], 0)
+        self.assertTrue(summary['callbacks'] > 0)
+        self.assertEqual(summary['ack']['count'], summary['callbacks'])
+        self.assertTrue(summary['update']['count'] > 0)
+        self.assertTrue(summary['ack']['p50'] <= summary['ack']['max'])
+        self.assertEqual(sum(app.clicks for app in server.clients.values()), summary['callbacks'])
+
+    def test_script(self):
+        from remi import loadtest
+        script = [{'widget': 'TextInput', 'event': 'onchange', 'params': {'new_value': 'typed'}},
+                  {'widget': 'Button', 'event': 'onclick'}]
+        # the value change has no update to wait for
+        summary = loadtest.run(self.address, users=1, duration=0.5, script=script, update_timeout=0.05, ramp_up=0)
+        self.assertTrue(summary['callbacks'] >= 2)
+        app = list(server.clients.values())[0]
+        self.assertEqual(app.text.get_value(), 'typed')
+        self.assertTrue(app.clicks > 0)
+
+    def test_percentile(self):
+        from remi import loadtest
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 0.5), 50)
+        self.assertEqual(loadtest.percentile(values, 0.99), 99)
+        self.assertEqual(loadtest.percentile(values, 1.0), 100)
+        self.assertIsNone(loadtest.percentile([], 0.5))
+
+
+class IdleClickApp(ClickApp):
+    def idle(self):
+        self.label.set_text('idle')
+
+
+class TestAppDriver(unittest.TestCase):
+    def setUp(self):
+        from remi.headless import AppDriver
+        self.driver = AppDriver(ClickApp)
+        self.app = self.driver.app
+
+    def tearDown(self):
+        self.driver.close()
+
+    def test_page(self):
+        from remi.headless import parse_show
+        self.assertIs(server.clients[self.app.session], self.app)
+        shown = parse_show(self.driver.take_messages())
+        self.assertEqual(len(shown), 1)
+        self.assertEqual(shown[0][0], self.app.root.identifier)
+        self.assertIn(self.app.button.identifier, shown[0][1])
+        self.assertEqual(self.driver.find_all(gui.Button), [self.app.button])
+
+    def test_dispatch(self):
+        from remi.headless import parse_updates, parse_javascript
+        self.driver.take_messages()
+        self.driver.dispatch(self.app.button, 'onclick')
+        self.app.execute_javascript('console.log(1)')
+        messages = self.driver.take_messages()
+        self.assertEqual(messages[0], '3')
+        self.assertEqual(parse_updates(messages), [(self.app.label.identifier, self.app.label.repr())])
+        self.assertEqual(parse_javascript(messages), ['console.log(1)'])
+        self.assertEqual(self.app.clicks, 1)
+
+    def test_parameters(self):
+        self.driver.dispatch(self.app.text.identifier, 'onchange', new_value=u'typed \u00e8')
+        self.assertEqual(self.app.text.get_value(), u'typed \u00e8')
+        # legacy format, the parameter lengths are in utf-8 bytes
+        self.driver.send('callback/%s/onchange/15|new_value=abc|d' % self.app.text.identifier)
+        self.assertEqual(self.app.text.get_value(), 'abc|d')
+
+    def test_errors(self):
+        self.assertRaises(AttributeError, self.driver.dispatch, self.app.button, 'missing')
+        self.assertRaises(KeyError, self.driver.dispatch, 'missing', 'onclick')
+        self.assertRaises(ValueError, self.driver.send, 'not a callback')
+
+    def test_idle(self):
+        from remi.headless import AppDriver, parse_updates
+        with AppDriver(IdleClickApp) as driver:
+            driver.take_messages()
+            driver.idle()
+            updates = parse_updates(driver.take_messages())
+            self.assertEqual(updates, [(driver.app.label.identifier, driver.app.label.repr())])
+        self.assertNotIn(driver.app.session, server.clients)
+
+    def test_protocol_v1(self):
+        from remi.headless import AppDriver, parse_updates
+        with AppDriver(ClickApp, protocol_version=1) as driver:
+            driver.take_messages()
+            driver.dispatch(driver.app.button, 'onclick')
+            updates = parse_updates(driver.take_messages())
+            self.assertEqual(updates, [(driver.app.label.identifier, server.to_websocket(driver.app.label.repr()))])
+
+
+@unittest.skipIf(sys.version_info < (3, 4) or not hasattr(os, 'fork'), "prefork requires fork")
+class TestPrefork(unittest.TestCase):
+    engine = 'threading'
+
+    def setUp(self):
+        self.server = server.Server(UpdateApp, start=False, start_browser=False, multiple_instance=True,
+                                    workers=2, engine=self.engine)
+        self.server.start()
+        self.address = self.server._sserver.server_address[:2]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_routing(self):
+        from remi.server_prefork import parse_head_session
+        self.assertEqual(parse_head_session(b'GET / HTTP/1.1\r\nCookie: a=1; remi_session=15\r\n\r\n'), 15)
+        self.assertIsNone(parse_head_session(b'GET / HTTP/1.1\r\nHost: x\r\n\r\n'))
+        self.assertEqual(self.server._sserver.worker_for(b'GET / HTTP/1.1\r\nCookie: remi_session=15\r\n\r\n'), 1)
+
+    def test_session_affinity(self):
+        cookies = [session_cookie(http_get(self.address, '/')) for i in range(4)]
+        sessions = [int(cookie.split('=')[1]) for cookie in cookies]
+        # the sessions get created round robin by the workers
+        self.assertEqual(sorted(session % 2 for session in sessions), [0, 0, 1, 1])
+        for cookie in cookies:
+            # a worker not owning the session would create a new one
+            self.assertEqual(session_cookie(http_get(self.address, '/', cookie)), cookie)
+        s = socket.create_connection(self.address)
+        s.settimeout(5)
+        s.sendall(('GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                   'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n%s\r\n' %
+                   cookies[1]).encode('utf-8'))
+        self.assertTrue(s.recv(4096).startswith(b'HTTP/1.1 101 '))
+        s.close()
+
+    def test_keep_alive_routing(self):
+        s = socket.create_connection(self.address)
+        s.settimeout(5)
+        s.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        head, _ = read_response(s)
+        # the next request could carry the session of another worker, it has to get routed again
+        self.assertIn('Connection: close', head)
+        self.assertEqual(s.recv(1), b'')
+        s.close()
+        cookie = session_cookie(head.encode('latin-1'))
+        s = socket.create_connection(self.address)
+        s.settimeout(5)
+        for i in range(2):
+            s.sendall(('GET / HTTP/1.1\r\nHost: localhost\r\n%s\r\n' % cookie).encode('utf-8'))
+            head, _ = read_response(s)
+            self.assertNotIn('Connection: close', head)
+            self.assertIn(cookie.split(': ')[1].strip(), head)
+        s.close()
+
+    def test_requires_multiple_instance(self):
+        self.assertRaises(ValueError, server.Server, UpdateApp, start=False, workers=2)
+
+
+@unittest.skipIf(sys.version_info < (3, 5) or not hasattr(os, 'fork'), "prefork requires fork")
+class TestPreforkAsyncio(TestPrefork):
+    engine = 'asyncio'
+
+
+class TestPreforkRequirements(unittest.TestCase):
+    def test_unsupported(self):
+        if sys.version_info >= (3, 4) and hasattr(os, 'fork'):
+            self.skipTest('prefork is supported')
+        # the error is raised by the constructor, not by the server thread
+        self.assertRaises(ValueError, server.Server, UpdateApp, start=False, multiple_instance=True, workers=2)
+
+    def test_worker_server(self):
+        server.clients.clear()
+        self.addCleanup(server.clients.clear)
+        worker = server.ThreadedHTTPServer(None, UpdateApp, None, True, True, 0.1, 1000, 1000, '', None, None, None,
+                                           None, None, 1000, 'drop_superseded', 0, 30, None, None, None)
+        # the worker has no listener, it serves the connections passed by the front process
+        self.assertFalse(worker.listening)
+        thread = threading.Thread(target=worker.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(worker.shutdown)
+        front = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        front.bind(('127.0.0.1', 0))
+        front.listen(1)
+        worker.server_address = front.getsockname()
+        client = socket.create_connection(front.getsockname())
+        client.settimeout(5)
+        worker.accept_connection(front.accept()[0])
+        client.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        head, _ = read_response(client)
+        self.assertTrue(head.startswith('HTTP/1.1 200 '))
+        client.close()
+        front.close()
+        worker.shutdown()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        for app in list(server.clients.values()):
+            app.on_close()
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio engine requires Python 3.5+")
+class TestAsyncioEngine(unittest.TestCase):
+    def setUp(self):
+        import helloworld_app
+        self.AppClass = helloworld_app.MyApp
+        self.AppClass.log_request = (lambda x,y:None)
+        self.server = server.Server(self.AppClass, start=False, start_browser=False,
+                                    multiple_instance=True, engine='asyncio')
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        del self.AppClass.log_request
+
+    def test_page(self):
+        response = http_get(self.server._sserver.server_address[:2])
+        self.assertTrue(response.startswith(b'HTTP/1.1 200'))
+        self.assertIn(b'remi_session=', response)
+        self.assertIn(b'Press me!', response)
+
+    def test_static_file(self):
+        response = http_get(self.server._sserver.server_address[:2], '/res:style.css')
+        self.assertTrue(response.startswith(b'HTTP/1.1 200'))
+        self.assertIn(b'text/css', response)
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, server.Server, self.AppClass, start=False, engine='unknown')
+
+
+class BlockingApp(UpdateApp):
+    release = threading.Event()
+
+    def main(self):
+        root = super(BlockingApp, self).main()
+        self.labels[0].onclick.do(self.on_click)
+        return root
+
+    def on_click(self, emitter):
+        emitter.set_text('clicked')
+
+    def block(self):
+        self.release.wait(5)
+        return [b'released', {}]
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio engine requires Python 3.5+")
+class TestAsyncioExecutors(unittest.TestCase):
+    def setUp(self):
+        from remi import server_asyncio
+        server.clients.clear()
+        self.http_workers = server_asyncio.AsyncioHTTPServer.http_workers
+        server_asyncio.AsyncioHTTPServer.http_workers = 1
+        BlockingApp.release.clear()
+        self.server = server.Server(BlockingApp, start=False, start_browser=False, multiple_instance=True,
+                                    engine='asyncio', update_interval=0.01)
+        self.server.start()
+        self.address = self.server._sserver.server_address[:2]
+
+    def tearDown(self):
+        from remi import server_asyncio
+        BlockingApp.release.set()
+        self.server.stop()
+        server_asyncio.AsyncioHTTPServer.http_workers = self.http_workers
+
+    def test_callbacks_not_blocked_by_http(self):
+        cookie = session_cookie(http_get(self.address, '/'))
+        app = server.clients[int(cookie.split('=')[1].strip())]
+        other_cookie = session_cookie(http_get(self.address, '/'))
+        other = server.clients[int(other_cookie.split('=')[1])]
+        # the only HTTP thread gets held by a request of the other session
+        responses = []
+        download = threading.Thread(target=lambda: responses.append(
+            http_get(self.address, '/%s/block' % id(other), other_cookie)))
+        download.start()
+        time.sleep(0.2)
+
+        s = socket.create_connection(self.address)
+        s.settimeout(5)
+        s.sendall(('GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                   'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n%s\r\n' %
+                   cookie).encode('utf-8'))
+        self.assertTrue(s.recv(4096).startswith(b'HTTP/1.1 101 '))
+        s.sendall(client_frame(('callback/%s/onclick/' % app.labels[0].identifier).encode('utf-8')))
+        deadline = time.time() + 2
+        while app.labels[0].get_text() != 'clicked' and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(app.labels[0].get_text(), 'clicked')
+        self.assertEqual(responses, [])
+        s.close()
+
+        BlockingApp.release.set()
+        download.join(5)
+        self.assertTrue(responses[0].endswith(b'released'))
+
+
+if __name__ == '__main__':
+    unittest.main()
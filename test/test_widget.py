@@ -299,6 +299,11 @@ class TestFileUploader(unittest.TestCase):
     def test_init(self):
         widget = gui.FileUploader()
         assertValidHTML(widget.repr())
+        # the positional arguments are the ones of the previous releases
+        widget = gui.FileUploader('./', True, chunk_size=1000, parallel_uploads=2, width=200)
+        self.assertEqual(widget.attributes['multiple'], 'multiple')
+        self.assertIn(',1000,2);', widget.attributes['onchange'])
+        self.assertEqual(widget.style['width'], '200px')
         
 class TestFileDownloader(unittest.TestCase):
     def test_init(self):
@@ -374,6 +379,36 @@ class TestSvgPath(unittest.TestCase):
         widget = gui.SvgPath(path_value='M 10 10 L 20 20 Z')
         assertValidHTML(widget.repr())
 
+class TestBenchmark(unittest.TestCase):
+    def test_run(self):
+        from remi import benchmark
+        benchmarks = benchmark.all_benchmarks(scale=0.01, examples=())
+        results = benchmark.run_benchmarks(benchmarks, repeat=2, name_filter='repr.')
+        self.assertIn('repr.full.wide_10', results)
+        self.assertIn('repr.incremental.touch_10', results)
+        self.assertTrue(all(name.startswith('repr.') for name in results))
+        result = results['repr.full.wide_10']
+        self.assertEqual(result['repeat'], 2)
+        self.assertTrue(0 < result['best'] <= result['median'])
+
+    def test_invalidate(self):
+        from remi import benchmark
+        root, labels = benchmark.wide_tree(10, groups=2)
+        changed = {}
+        root.repr(changed)
+        self.assertEqual(changed, {})
+        benchmark.invalidate(root)
+        root.repr(changed)
+        self.assertEqual(list(changed), [root])
+
+    def test_compare(self):
+        from remi import benchmark
+        baseline = {'a': {'best': 1.0}, 'b': {'best': 1.0}, 'c': {'best': 1.0}}
+        results = {'a': {'best': 1.05}, 'b': {'best': 1.5}, 'd': {'best': 1.0}}
+        rows, regressions = benchmark.compare(baseline, results, threshold=0.1)
+        self.assertEqual([row[0] for row in rows], ['a', 'b'])
+        self.assertEqual(regressions, ['b'])
+
 
 if __name__ == '__main__':
     unittest.main()